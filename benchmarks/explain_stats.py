@@ -0,0 +1,145 @@
+# -*-coding:utf8-*-
+"""
+Compare the plans behind ``/stats/parks`` across the schema migrations.
+
+Seeds a throwaway ``benchmark`` schema in the database configured through the POSTGRES_* environment variables
+with synthetic 15-minute readings and runs ``EXPLAIN (ANALYZE, BUFFERS)`` for:
+1. the daily aggregate over raw readings on the baseline schema,
+2. the same aggregate once the (park_name, timestamp) indexes exist,
+3. ``stats_by_park_and_date_stmt`` reading the daily rollup,
+4. the raw aggregate again, pruned to the monthly partitions of the queried range.
+
+Usage:
+    python -m benchmarks.explain_stats --rows 10000000
+"""
+import argparse
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import func as F
+from sqlalchemy import select, text
+from sqlalchemy.engine import Connection
+from sqlalchemy.sql.expression import Select
+from sqlalchemy.types import DATE
+
+from main.constraints import EnergyType, ParkName, Timezone
+from main.db import engine
+from main.db.migrations import migrate
+from main.db.models import EnergyReadingRow, ParkRow
+from main.db.queries import stats_by_park_and_date_stmt
+
+SCHEMA = "benchmark"
+START = datetime(2000, 1, 1)
+
+
+def raw_stats_by_park_and_date_stmt(start_date: date, end_date: date) -> Select:
+    """
+    Daily stats aggregated from the raw readings, as served before the daily rollup existed.
+    """
+    day = EnergyReadingRow.timestamp.cast(DATE)
+    return (
+        select(
+            ParkRow.name,
+            day.label("date"),
+            F.min(EnergyReadingRow.megawatts).label("min"),
+            F.max(EnergyReadingRow.megawatts).label("max"),
+            F.sum(EnergyReadingRow.megawatts).label("sum"),
+            F.count(EnergyReadingRow.megawatts).label("count"),
+        )
+        .join(EnergyReadingRow)
+        .where(ParkRow.name == ParkName.netterden.value)
+        .where(EnergyReadingRow.timestamp.between(start_date, end_date))
+        .group_by(ParkRow.name, day)
+        .order_by(day)
+        .limit(100)
+    )
+
+
+def seed(connection: Connection, rows: int) -> None:
+    timezones = list(Timezone)
+    energy_types = list(EnergyType)
+    connection.execute(
+        text("INSERT INTO parks (name, timezone, energy_type) VALUES (:name, :timezone, :energy_type)"),
+        [
+            {
+                "name": park.value,
+                "timezone": timezones[i % len(timezones)].value,
+                "energy_type": energy_types[i % len(energy_types)].value,
+            }
+            for i, park in enumerate(ParkName)
+        ],
+    )
+    connection.execute(
+        text(
+            """
+            INSERT INTO energy_readings (park_name, timestamp, megawatts)
+            SELECT p.name, ts, random() * 100
+            FROM parks AS p
+            CROSS JOIN generate_series(
+                CAST(:start AS TIMESTAMP),
+                CAST(:start AS TIMESTAMP) + make_interval(mins => 15 * (:per_park - 1)),
+                interval '15 minutes'
+            ) AS ts
+            """
+        ),
+        {"start": START, "per_park": rows // len(ParkName)},
+    )
+    connection.execute(text("ANALYZE"))
+
+
+def explain(connection: Connection, stmt: Select) -> str:
+    compiled = stmt.compile(dialect=connection.dialect, compile_kwargs={"render_postcompile": True})
+    rows = connection.exec_driver_sql(f"EXPLAIN (ANALYZE, BUFFERS) {compiled}", compiled.params).scalars()
+    connection.rollback()
+    return "\n".join(rows)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=10_000_000, help="Total number of readings to seed.")
+    parser.add_argument("--days", type=int, default=30, help="Width of the queried date range.")
+    parser.add_argument("--keep", action="store_true", help=f"Do not drop the {SCHEMA!r} schema afterwards.")
+    args = parser.parse_args()
+
+    start_date = START.date() + timedelta(days=365)
+    end_date = start_date + timedelta(days=args.days)
+
+    with engine.connect() as connection:
+        connection.execute(text(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE"))
+        connection.execute(text(f"CREATE SCHEMA {SCHEMA}"))
+        connection.execute(text(f"SET search_path TO {SCHEMA}"))
+        migrate(connection, target=1)
+        seed(connection, rows=args.rows)
+        connection.commit()
+
+        raw_stmt = raw_stats_by_park_and_date_stmt(start_date, end_date)
+        print(f"--- Raw readings, baseline schema, {args.rows} rows ---")
+        print(explain(connection, raw_stmt))
+
+        migrate(connection, target=3)
+        connection.execute(text("ANALYZE"))
+        connection.commit()
+        print(f"--- Raw readings, (park_name, timestamp) indexes, {args.rows} rows ---")
+        print(explain(connection, raw_stmt))
+
+        migrate(connection)
+        connection.execute(text("ANALYZE"))
+        connection.commit()
+        print(f"--- Daily rollup, {args.rows} rows ---")
+        print(
+            explain(
+                connection,
+                stats_by_park_and_date_stmt(
+                    offset=0, limit=100, park_names=[ParkName.netterden], start_date=start_date, end_date=end_date
+                ),
+            )
+        )
+        print(f"--- Raw readings, monthly partitions, {args.rows} rows ---")
+        print(explain(connection, raw_stmt))
+
+        if not args.keep:
+            connection.execute(text(f"DROP SCHEMA {SCHEMA} CASCADE"))
+            connection.commit()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,341 @@
+# -*-coding:utf8-*-
+"""
+Load test the read endpoints of ``start_api()``.
+
+Seeds a ``loadtest`` schema in the database configured through the POSTGRES_* environment variables with
+15-minute readings for N parks over Y years, then sends a weighted mix of ``/parks``, ``/parks/energy-readings`` and
+``/stats/*`` requests at a fixed concurrency. Requests go to the app in process, or to a running server with ``--url``
+(which must then use the seeded schema, e.g. ``--schema public``). Existing rows are kept, and only a schema created
+by the run is dropped afterwards.
+
+Reports p50/p95/p99 latency and RPS per route and writes them as JSON, so runs of different commits can be compared
+with ``--baseline``. Set ``CACHE_URL=none://`` to measure the endpoints without the response cache.
+
+Usage:
+    python -m benchmarks.loadtest --parks 5 --years 2 --requests 5000 --concurrency 32 \
+        --mix parks=1,energy-readings=4,stats-parks=3,stats-energy-types=2 --output results.json
+    python -m benchmarks.loadtest --skip-seed --keep --baseline results.json
+    python -m benchmarks.loadtest --replay traffic.jsonl  # one {"path": ..., "params": {...}} per line
+"""
+
+import argparse
+import asyncio
+from datetime import date, datetime, timedelta
+import json
+import random
+import subprocess
+from time import perf_counter
+from typing import Any, Callable, Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+import httpx
+from sqlalchemy import bindparam, create_engine, text
+from sqlalchemy.engine import Connection
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.orm import Session
+
+from main import start_api
+from main.constraints import EnergyType, ParkName, Timezone
+from main.db import (
+    ASYNC_DB_URL,
+    DB_URL,
+    POOL_OPTIONS,
+    get_async_session,
+    get_read_session,
+    get_read_sessionmaker,
+    get_session,
+)
+from main.db.bulk import refresh_energy_readings_daily
+from main.db.migrations import migrate
+from main.db.partitions import ensure_energy_readings_partitions
+
+SCHEMA = "loadtest"
+START = datetime(2000, 1, 1)
+DEFAULT_MIX = "parks=1,energy-readings=4,stats-parks=3,stats-energy-types=2"
+
+Params = Dict[str, Any]
+
+
+class Dataset(NamedTuple):
+    park_names: List[str]
+    start: date
+    end: date
+
+
+class Sample(NamedTuple):
+    route: str
+    status: int
+    latency: float
+    cached: bool
+
+
+def random_window(rng: random.Random, dataset: Dataset, days: int) -> Params:
+    span = max((dataset.end - dataset.start).days - days, 0)
+    start_date = dataset.start + timedelta(days=rng.randint(0, span))
+    return {"start_date": start_date.isoformat(), "end_date": (start_date + timedelta(days=days)).isoformat()}
+
+
+def random_parks(rng: random.Random, dataset: Dataset) -> Params:
+    return {"park_names": rng.sample(dataset.park_names, rng.randint(1, len(dataset.park_names)))}
+
+
+# Route name -> (path, query params generator)
+ROUTES: Dict[str, Tuple[str, Callable[[random.Random, Dataset, int], Params]]] = {
+    "parks": ("/parks", lambda rng, dataset, days: {}),
+    "energy-readings": (
+        "/parks/energy-readings",
+        lambda rng, dataset, days: {**random_parks(rng, dataset), **random_window(rng, dataset, 1), "limit": 100},
+    ),
+    "stats-parks": (
+        "/stats/parks",
+        lambda rng, dataset, days: {**random_parks(rng, dataset), **random_window(rng, dataset, days), "limit": 100},
+    ),
+    "stats-energy-types": (
+        "/stats/energy_types",
+        lambda rng, dataset, days: {**random_window(rng, dataset, days), "limit": 100},
+    ),
+}
+
+
+def parse_mix(mix: str) -> Dict[str, int]:
+    weights = {}
+    for item in mix.split(","):
+        name, _, weight = item.partition("=")
+        if name not in ROUTES:
+            raise argparse.ArgumentTypeError(f"Unknown route {name!r}, choose from {', '.join(ROUTES)}")
+        weights[name] = int(weight or 1)
+    return weights
+
+
+def seed(connection: Connection, parks: int, years: float) -> None:
+    """
+    Insert the parks and their readings, keeping rows that already exist, and refresh the daily rollup.
+    """
+    timezones = list(Timezone)
+    energy_types = list(EnergyType)
+    park_names = [park.value for park in list(ParkName)[:parks]]
+    end = START + timedelta(days=round(365 * years))
+    connection.execute(
+        text(
+            "INSERT INTO parks (name, timezone, energy_type) VALUES (:name, :timezone, :energy_type) "
+            "ON CONFLICT DO NOTHING"
+        ),
+        [
+            {"name": name, "timezone": timezones[i % len(timezones)].value, "energy_type": energy_types[i % 2].value}
+            for i, name in enumerate(park_names)
+        ],
+    )
+    ensure_energy_readings_partitions(Session(bind=connection), START.date(), end.date())
+    connection.execute(
+        text(
+            """
+            INSERT INTO energy_readings (park_name, timestamp, megawatts)
+            SELECT p.name, ts, random() * 100
+            FROM parks AS p
+            CROSS JOIN generate_series(CAST(:start AS TIMESTAMP), CAST(:end AS TIMESTAMP), interval '15 minutes') AS ts
+            WHERE p.name IN :park_names AND ts < :end
+            ON CONFLICT DO NOTHING
+            """
+        ).bindparams(bindparam("park_names", expanding=True)),
+        {"start": START, "end": end, "park_names": park_names},
+    )
+    refresh_energy_readings_daily(Session(bind=connection))
+    connection.execute(text("ANALYZE"))
+
+
+def existing_dataset(connection: Connection) -> Dataset:
+    park_names = list(connection.execute(text("SELECT name FROM parks ORDER BY name")).scalars())
+    start, end = connection.execute(
+        text("SELECT min(timestamp)::date, max(timestamp)::date FROM energy_readings")
+    ).one()
+    return Dataset(park_names=park_names, start=start, end=end)
+
+
+def gen_requests(
+    rng: random.Random, dataset: Dataset, weights: Dict[str, int], days: int, replay: Optional[List[Dict]]
+) -> Iterator[Tuple[str, str, Params]]:
+    """
+    Yield (route, path, params) forever, either drawn from the weighted mix or cycling over the replayed requests.
+    """
+    while True:
+        if replay:
+            for item in replay:
+                yield item["path"], item["path"], item.get("params", {})
+            continue
+        route = rng.choices(list(weights), weights=list(weights.values()))[0]
+        path, gen_params = ROUTES[route]
+        yield route, path, gen_params(rng, dataset, days)
+
+
+async def run_load(
+    client: httpx.AsyncClient, requests: Iterator[Tuple[str, str, Params]], total: int, concurrency: int
+) -> Tuple[List[Sample], float]:
+    samples: List[Sample] = []
+    remaining = total
+
+    async def worker() -> None:
+        nonlocal remaining
+        while remaining > 0:
+            remaining -= 1
+            route, path, params = next(requests)
+            start = perf_counter()
+            response = await client.get(path, params=params)
+            samples.append(
+                Sample(route, response.status_code, perf_counter() - start, response.headers.get("X-Cache") == "HIT")
+            )
+
+    start = perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return samples, perf_counter() - start
+
+
+def percentile(latencies: List[float], q: float) -> float:
+    ordered = sorted(latencies)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))] if ordered else 0.0
+
+
+def summarize(samples: List[Sample], elapsed: float) -> Dict[str, Dict[str, float]]:
+    by_route: Dict[str, List[Sample]] = {"all": samples}
+    for sample in samples:
+        by_route.setdefault(sample.route, []).append(sample)
+    summary = {}
+    for route, route_samples in sorted(by_route.items()):
+        latencies = [sample.latency for sample in route_samples]
+        summary[route] = {
+            "requests": len(route_samples),
+            "errors": sum(sample.status >= 400 for sample in route_samples),
+            "cache_hits": sum(sample.cached for sample in route_samples),
+            "rps": round(len(route_samples) / elapsed, 2) if elapsed else 0.0,
+            "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+            "p95_ms": round(percentile(latencies, 0.95) * 1000, 3),
+            "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+        }
+    return summary
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_summary(summary: Dict[str, Dict[str, float]], baseline: Optional[Dict[str, Dict[str, float]]]) -> None:
+    print(f"{'route':<20}{'requests':>10}{'errors':>8}{'hits':>8}{'rps':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for route, stats in summary.items():
+        line = (
+            f"{route:<20}{stats['requests']:>10}{stats['errors']:>8}{stats['cache_hits']:>8}{stats['rps']:>10}"
+            f"{stats['p50_ms']:>10}{stats['p95_ms']:>10}{stats['p99_ms']:>10}"
+        )
+        if baseline and route in baseline and baseline[route]["p95_ms"]:
+            previous = baseline[route]
+            line += (
+                f"  p95 {stats['p95_ms'] / previous['p95_ms'] - 1:+.1%} rps {stats['rps'] / previous['rps'] - 1:+.1%}"
+            )
+        print(line)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--parks", type=int, default=len(ParkName), help="Number of parks to seed.")
+    parser.add_argument("--years", type=float, default=1, help="Years of 15-minute readings to seed per park.")
+    parser.add_argument("--requests", type=int, default=2000, help="Number of measured requests.")
+    parser.add_argument("--warmup", type=int, default=100, help="Number of requests sent before measuring.")
+    parser.add_argument("--concurrency", type=int, default=16, help="Number of requests in flight.")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix(DEFAULT_MIX), help=f"Default: {DEFAULT_MIX}.")
+    parser.add_argument("--days", type=int, default=30, help="Width of the date range of /stats requests.")
+    parser.add_argument("--replay", help="JSON lines file of requests to replay instead of the mix.")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed of the request mix.")
+    parser.add_argument("--url", help="Base URL of a running server. The app runs in process by default.")
+    parser.add_argument("--schema", default=SCHEMA, help="Schema holding the dataset.")
+    parser.add_argument("--skip-seed", action="store_true", help="Reuse the dataset already in the schema.")
+    parser.add_argument("--keep", action="store_true", help="Do not drop the schema afterwards, if it was created.")
+    parser.add_argument("--output", help="Write the results to this JSON file.")
+    parser.add_argument("--baseline", help="JSON results of a previous run to compare with.")
+    args = parser.parse_args()
+    if args.parks > len(ParkName):
+        parser.error(f"--parks must be at most {len(ParkName)}")
+
+    engine = create_engine(DB_URL, future=True, connect_args={"options": f"-csearch_path={args.schema}"})
+    with engine.connect() as connection:
+        created = not connection.execute(
+            text("SELECT EXISTS (SELECT FROM pg_namespace WHERE nspname = :schema)"), {"schema": args.schema}
+        ).scalar_one()
+        if not args.skip_seed:
+            connection.execute(text(f"CREATE SCHEMA IF NOT EXISTS {args.schema}"))
+            migrate(connection)
+            seed(connection, parks=args.parks, years=args.years)
+            connection.commit()
+        dataset = existing_dataset(connection)
+    print(f"Dataset: {len(dataset.park_names)} parks from {dataset.start} to {dataset.end}")
+
+    replay = None
+    if args.replay:
+        with open(args.replay) as f:
+            replay = [json.loads(line) for line in f if line.strip()]
+    requests = gen_requests(random.Random(args.seed), dataset, args.mix, args.days, replay)
+
+    async def run() -> Tuple[List[Sample], float]:
+        if args.url:
+            client = httpx.AsyncClient(base_url=args.url, timeout=60)
+        else:
+            async_engine = create_async_engine(
+                ASYNC_DB_URL, connect_args={"server_settings": {"search_path": args.schema}}, **POOL_OPTIONS
+            )
+            sessionmaker = async_sessionmaker(async_engine, expire_on_commit=False)
+
+            async def get_loadtest_async_session():
+                async with sessionmaker() as session:
+                    yield session
+
+            def get_loadtest_session():
+                with Session(engine, future=True) as session:
+                    yield session
+
+            api = start_api()
+            api.dependency_overrides[get_session] = get_loadtest_session
+            api.dependency_overrides[get_async_session] = get_loadtest_async_session
+            api.dependency_overrides[get_read_session] = get_loadtest_async_session
+            api.dependency_overrides[get_read_sessionmaker] = lambda: sessionmaker
+            client = httpx.AsyncClient(app=api, base_url="http://loadtest", timeout=60)
+        async with client:
+            await run_load(client, requests, args.warmup, args.concurrency)
+            return await run_load(client, requests, args.requests, args.concurrency)
+
+    samples, elapsed = asyncio.run(run())
+    summary = summarize(samples, elapsed)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["routes"]
+    print_summary(summary, baseline)
+
+    if args.output:
+        results = {
+            "commit": git_commit(),
+            "created_at": datetime.now().isoformat(timespec="seconds"),
+            "target": args.url or "in-process",
+            "parameters": {
+                key: value
+                for key, value in vars(args).items()
+                if key not in ("output", "baseline", "skip_seed", "keep")
+            },
+            "dataset": {
+                "parks": len(dataset.park_names),
+                "start": dataset.start.isoformat(),
+                "end": dataset.end.isoformat(),
+            },
+            "elapsed_seconds": round(elapsed, 3),
+            "routes": summary,
+        }
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if created and not args.keep:
+        with engine.connect() as connection:
+            connection.execute(text(f"DROP SCHEMA {args.schema} CASCADE"))
+            connection.commit()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+# -*-coding:utf8-*-
+"""
+Compare the per-request overhead of the query string and compression middlewares.
+
+Drives both pipelines directly over ASGI, without a server or database, for a few typical requests:
+1. the previous pipeline: ``GZipMiddleware`` and the query string filter re-encoding it with ``parse_qsl`` and
+   ``urlencode`` on every request,
+2. the current pipeline: ``CompressionMiddleware`` and ``FilterEmptyQueryParamsMiddleware``.
+
+The app behind them answers at once, so the times are the cost of the middlewares alone.
+
+Usage:
+    python -m benchmarks.middleware --requests 20000
+"""
+
+import argparse
+import asyncio
+from time import perf_counter
+from typing import Dict, List, Tuple
+from urllib.parse import parse_qsl, urlencode
+
+from starlette.middleware.gzip import GZipMiddleware
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from main.middleware import CompressionMiddleware, FilterEmptyQueryParamsMiddleware
+
+BODIES = {
+    "/parks": b'[{"name":"Netterden","timezone":"Europe/Amsterdam","energy_type":"Wind"}]',
+    "/stats/parks": b"[" + b",".join(b'{"name":"Netterden","min":1.0,"max":2.0,"count":96}' for _ in range(100)) + b"]",
+    "/metrics": b"\n".join(b'http_requests_total{path="/parks"} 1.0' for _ in range(100)),
+}
+# Name -> path, query string and Accept-Encoding
+REQUESTS: Dict[str, Tuple[str, bytes, bytes]] = {
+    "small json": ("/parks", b"energy_types=Wind&limit=100", b"gzip, br"),
+    "empty params": ("/parks", b"energy_types=&timezones=&limit=100", b"gzip, br"),
+    "stats page": ("/stats/parks", b"park_names=Netterden&start_date=2020-01-01&end_date=2020-12-31", b"gzip, br"),
+    "metrics scrape": ("/metrics", b"", b"gzip"),
+}
+
+
+class PreviousFilterEmptyQueryParamsMiddleware:
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope and scope.get("query_string"):
+            filtered_query_params = parse_qsl(qs=scope["query_string"].decode("latin-1"), keep_blank_values=False)
+            scope["query_string"] = urlencode(filtered_query_params).encode("latin-1")
+        await self.app(scope, receive, send)
+
+
+async def app(scope: Scope, receive: Receive, send: Send) -> None:
+    body = BODIES[scope["path"]]
+    content_type = b"text/plain" if scope["path"] == "/metrics" else b"application/json"
+    headers = [(b"content-type", content_type), (b"content-length", str(len(body)).encode())]
+    await send({"type": "http.response.start", "status": 200, "headers": headers})
+    await send({"type": "http.response.body", "body": body})
+
+
+async def receive() -> Message:
+    return {"type": "http.request", "body": b"", "more_body": False}
+
+
+async def send(message: Message) -> None:
+    pass
+
+
+async def time_requests(pipeline: ASGIApp, path: str, query_string: bytes, accept_encoding: bytes, n: int) -> float:
+    headers: List[Tuple[bytes, bytes]] = [(b"host", b"localhost"), (b"accept-encoding", accept_encoding)]
+    start = perf_counter()
+    for _ in range(n):
+        scope = {"type": "http", "method": "GET", "path": path, "query_string": query_string, "headers": headers}
+        await pipeline(scope, receive, send)
+    return (perf_counter() - start) / n
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=20_000, help="Number of timed requests per case.")
+    args = parser.parse_args()
+
+    pipelines = {
+        "previous": GZipMiddleware(PreviousFilterEmptyQueryParamsMiddleware(app)),
+        "current": CompressionMiddleware(FilterEmptyQueryParamsMiddleware(app)),
+    }
+    for name, (path, query_string, accept_encoding) in REQUESTS.items():
+        for pipeline_name, pipeline in pipelines.items():
+            seconds = asyncio.run(time_requests(pipeline, path, query_string, accept_encoding, args.requests))
+            print(f"{name:<16}{pipeline_name:<10}{seconds * 1e6:>10.2f} us per request")
+
+
+if __name__ == "__main__":
+    main()
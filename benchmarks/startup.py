@@ -0,0 +1,85 @@
+# -*-coding:utf8-*-
+"""
+Measure the startup cost of the processes the app runs, each in a fresh interpreter.
+
+- ``server``: import ``main.entrypoint``, i.e. build the app. Paid once by the gunicorn master (``main.server``).
+- ``ingest worker``: import ``main.ingest``, paid by every ingestion process spawned on the first batch upload.
+- ``migrations``: import ``main.db.migrations``, paid by ``make migrate``.
+- ``prepare database``: migrations and partitions on an up to date schema, what every restart costs (``--db``).
+
+The slowest direct imports of ``main`` modules are listed from ``python -X importtime``.
+
+Usage:
+    python -m benchmarks.startup --runs 5 --db
+"""
+
+import argparse
+from collections import defaultdict
+import statistics
+import subprocess
+import sys
+from typing import Dict, List, Tuple
+
+MODULES = {
+    "server": "main.entrypoint",
+    "ingest worker": "main.ingest",
+    "migrations": "main.db.migrations",
+}
+TIMED_IMPORT = "from time import perf_counter; start = perf_counter(); import {module}; print(perf_counter() - start)"
+TIMED_PREPARE = (
+    "from time import perf_counter; from main.db import prepare_database; start = perf_counter(); "
+    "prepare_database(); print(perf_counter() - start)"
+)
+
+
+def run(code: str, *options: str) -> Tuple[float, str]:
+    result = subprocess.run([sys.executable, *options, "-c", code], capture_output=True, text=True, check=True)
+    return float(result.stdout.strip().splitlines()[-1]), result.stderr
+
+
+def direct_imports(importtime: str) -> Dict[Tuple[str, str], int]:
+    """
+    Cumulative microseconds of the imports done by ``main`` modules themselves, from ``-X importtime`` output.
+    """
+    rows = []
+    for line in importtime.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        rows.append((len(name) - len(name.lstrip()), int(cumulative), name.strip()))
+    # Imports are listed after the ones they trigger, with a deeper indent: walk backwards to find the importers
+    imports, importers = {}, []
+    for depth, cumulative, name in reversed(rows):
+        while importers and importers[-1][0] >= depth:
+            importers.pop()
+        if importers and importers[-1][1].startswith("main"):
+            imports[(importers[-1][1], name)] = cumulative
+        importers.append((depth, name))
+    return imports
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5, help="Number of fresh interpreters per measure.")
+    parser.add_argument("--top", type=int, default=10, help="Number of slowest imports listed.")
+    parser.add_argument("--db", action="store_true", help="Also time preparing the database (POSTGRES_* variables).")
+    args = parser.parse_args()
+
+    timings: Dict[str, List[float]] = defaultdict(list)
+    for _ in range(args.runs):
+        for name, module in MODULES.items():
+            timings[name].append(run(TIMED_IMPORT.format(module=module))[0])
+        if args.db:
+            timings["prepare database"].append(run(TIMED_PREPARE)[0])
+    for name, seconds in timings.items():
+        print(f"{name:<18}{statistics.median(seconds) * 1000:>10.1f} ms (median of {len(seconds)})")
+
+    _, importtime = run(TIMED_IMPORT.format(module=MODULES["server"]), "-X", "importtime")
+    print("\nSlowest imports of the server:")
+    imports = sorted(direct_imports(importtime).items(), key=lambda item: item[1], reverse=True)
+    for (importer, name), microseconds in imports[: args.top]:
+        print(f"{importer:<24}{name:<40}{microseconds / 1000:>10.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
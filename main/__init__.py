@@ -1,33 +1,51 @@
 # -*-coding:utf8-*-
 from contextlib import asynccontextmanager
 import os
+from typing import TYPE_CHECKING
 
-from fastapi import FastAPI
-from fastapi.middleware import Middleware
-from fastapi.middleware.gzip import GZipMiddleware
-from starlette_exporter import PrometheusMiddleware, handle_metrics
+if TYPE_CHECKING:
+    from fastapi import FastAPI
 
-from main.db import create_db_and_tables
-from main.middleware import FilterEmptyQueryParamsMiddleware
+# The app is only imported by start_api, so that ingestion workers and the CLIs (e.g. ``python -m
+# main.db.migrations``), which import ``main.*`` modules, do not pay for FastAPI and the routers.
 
 
 @asynccontextmanager
-async def lifespan(app: FastAPI):
+async def lifespan(app: "FastAPI"):
+    from main.db import create_db_and_tables
+
     async with create_db_and_tables():
         yield
+    app.state.ingest_pool.shutdown(cancel_futures=True)
+
+
+def start_api() -> "FastAPI":
+    from fastapi import Depends, FastAPI
+    from fastapi.middleware import Middleware
+    from starlette_exporter import PrometheusMiddleware, handle_metrics
 
+    from main.cache import ResponseCacheMiddleware, create_cache_backend
+    from main.db import get_read_pools
+    from main.ingest import create_ingest_pool
+    from main.metrics import track_route
+    from main.middleware import AdmissionControlMiddleware, CompressionMiddleware, FilterEmptyQueryParamsMiddleware
 
-def start_api() -> FastAPI:
+    cache = create_cache_backend()
     api = FastAPI(
         title="Energy company case REST API",
         version=os.environ.get("VERSION", "0.1.0"),
         lifespan=lifespan,
+        dependencies=[Depends(track_route)],
         middleware=[
-            Middleware(GZipMiddleware),
+            Middleware(CompressionMiddleware),
             Middleware(FilterEmptyQueryParamsMiddleware),  # NOTE: see https://github.com/tiangolo/fastapi/issues/1147
             Middleware(PrometheusMiddleware),
+            Middleware(ResponseCacheMiddleware, backend=cache),
+            Middleware(AdmissionControlMiddleware, get_pools=get_read_pools),
         ],
     )
+    api.state.cache = cache
+    api.state.ingest_pool = create_ingest_pool()  # Workers are only started by the first batch upload
 
     from main.routers.core import router as core
 
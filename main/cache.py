@@ -0,0 +1,392 @@
+# -*-coding:utf8-*-
+"""
+Response cache for the core read endpoints.
+
+Responses are cached by path, normalized query string and ``Accept`` header. Each entry is tagged with the parks and
+date range it was filtered by, so an upload only evicts the entries it can affect. Every response gets an ``ETag`` and
+a matching ``If-None-Match`` is answered with ``304 Not Modified``.
+
+Backends are selected with ``CACHE_URL``:
+    ``memory://`` (default with one server worker): per process LRU, bounded by ``CACHE_MAX_ENTRIES``. Refused with
+    several workers (``WEB_CONCURRENCY``), as an upload would only evict the entries of the worker handling it.
+    ``redis://host:port/db``: shared between processes, needs the optional ``redis`` package.
+    ``none://`` (default with several server workers): nothing is stored, ETags are still computed.
+Entries expire after ``CACHE_TTL`` seconds.
+
+With read replicas, the reads following an upload may be served by a replica that has not replayed it yet. Responses
+computed within ``DB_REPLICA_MAX_LAG`` seconds of an invalidation are therefore not stored, as a healthy replica may
+lag that long.
+"""
+
+import base64
+from collections import OrderedDict
+from datetime import date, timedelta
+from hashlib import sha256
+import json
+import os
+from time import monotonic
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple
+from urllib.parse import parse_qsl, urlencode
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.requests import Request
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from main.db import WORKERS
+from main.db.replicas import REPLICA_HOSTS, REPLICA_MAX_LAG
+
+CACHE_HEADER = "X-Cache"
+# Path -> whether the response depends on energy readings. Park uploads clear every entry.
+CACHED_PATHS = {
+    "/parks": False,
+    "/parks/energy-readings": True,
+    "/stats/parks": True,
+    "/stats/energy_types": True,
+    "/stats": True,
+}
+# Readings are compared against date bounds in different ways (timestamps, inclusive dates, local dates), so
+# invalidation also evicts entries whose range ends or starts one day away from the uploaded range.
+INVALIDATION_MARGIN = timedelta(days=1)
+
+
+class CacheTags(NamedTuple):
+    readings: bool
+    park_names: Tuple[str, ...] = ()  # Empty means any park
+    start_date: Optional[date] = None
+    end_date: Optional[date] = None
+
+    def matches(self, park_name: str, first: date, last: date) -> bool:
+        """
+        Whether readings of ``park_name`` between ``first`` and ``last`` may change the cached response.
+        """
+        if not self.readings or (self.park_names and park_name not in self.park_names):
+            return False
+        if self.start_date and self.start_date > last + INVALIDATION_MARGIN:
+            return False
+        if self.end_date and self.end_date < first - INVALIDATION_MARGIN:
+            return False
+        return True
+
+
+class CacheEntry(NamedTuple):
+    status: int
+    headers: List[Tuple[str, str]]
+    body: bytes
+    etag: str
+    tags: CacheTags
+
+
+def dump_entry(entry: CacheEntry) -> str:
+    tags = entry.tags
+    return json.dumps(
+        {
+            "status": entry.status,
+            "headers": entry.headers,
+            "body": base64.b64encode(entry.body).decode(),
+            "etag": entry.etag,
+            "tags": [
+                tags.readings,
+                tags.park_names,
+                tags.start_date.isoformat() if tags.start_date else None,
+                tags.end_date.isoformat() if tags.end_date else None,
+            ],
+        }
+    )
+
+
+def load_entry(data: str | bytes) -> CacheEntry:
+    raw = json.loads(data)
+    readings, park_names, start_date, end_date = raw["tags"]
+    return CacheEntry(
+        status=raw["status"],
+        headers=[(name, value) for name, value in raw["headers"]],
+        body=base64.b64decode(raw["body"]),
+        etag=raw["etag"],
+        tags=CacheTags(
+            readings=readings,
+            park_names=tuple(park_names),
+            start_date=date.fromisoformat(start_date) if start_date else None,
+            end_date=date.fromisoformat(end_date) if end_date else None,
+        ),
+    )
+
+
+class CacheBackend:
+    """
+    Backend interface. Stores nothing, which is what ``none://`` uses.
+    """
+
+    async def version(self) -> int:
+        return 0
+
+    async def get(self, key: str) -> Optional[CacheEntry]:
+        return None
+
+    async def set(self, key: str, entry: CacheEntry, version: int) -> None:
+        return None
+
+    async def invalidate(self, park_name: str, first: date, last: date) -> int:
+        return 0
+
+    async def clear(self) -> None:
+        return None
+
+
+class MemoryCache(CacheBackend):
+    """
+    Per process LRU cache with a time to live.
+
+    ``version`` is bumped on every invalidation, and ``set`` ignores responses computed before the last one, so a
+    request racing with an upload cannot store stale data. It also ignores responses for ``settle`` seconds after
+    an invalidation, while the read replicas may not have the upload yet.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 1024,
+        ttl: float = 60,
+        settle: float = 0,
+        clock: Callable[[], float] = monotonic,
+    ) -> None:
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.settle = settle
+        self.clock = clock
+        self.entries: OrderedDict[str, Tuple[float, CacheEntry]] = OrderedDict()
+        self.generation = 0
+        self.settles_at = 0.0
+
+    async def version(self) -> int:
+        return self.generation
+
+    async def get(self, key: str) -> Optional[CacheEntry]:
+        item = self.entries.get(key)
+        if item is None:
+            return None
+        expires_at, entry = item
+        if expires_at <= self.clock():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return entry
+
+    async def set(self, key: str, entry: CacheEntry, version: int) -> None:
+        if version != self.generation or self.clock() < self.settles_at:
+            return
+        self.entries[key] = (self.clock() + self.ttl, entry)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    async def invalidate(self, park_name: str, first: date, last: date) -> int:
+        self.generation += 1
+        self.settles_at = self.clock() + self.settle
+        keys = [key for key, (_, entry) in self.entries.items() if entry.tags.matches(park_name, first, last)]
+        for key in keys:
+            del self.entries[key]
+        return len(keys)
+
+    async def clear(self) -> None:
+        self.generation += 1
+        self.settles_at = self.clock() + self.settle
+        self.entries.clear()
+
+
+class RedisCache(CacheBackend):
+    """
+    Cache shared between processes through a Redis protocol server.
+
+    Entries are indexed in one set per park (``*`` for entries not filtered by park), so invalidation only loads the
+    entries of the uploaded park. Invalidations set a ``settling`` key expiring after ``settle`` seconds, during
+    which nothing is stored.
+    """
+
+    def __init__(self, client: Any, ttl: int = 60, settle: float = 0, prefix: str = "energy-api:cache") -> None:
+        self.client = client
+        self.ttl = ttl
+        self.settle = settle
+        self.prefix = prefix
+
+    def _key(self, *parts: str) -> str:
+        return ":".join((self.prefix, *parts))
+
+    async def version(self) -> int:
+        return int(await self.client.get(self._key("version")) or 0)
+
+    async def get(self, key: str) -> Optional[CacheEntry]:
+        data = await self.client.get(self._key("entry", key))
+        return load_entry(data) if data else None
+
+    async def set(self, key: str, entry: CacheEntry, version: int) -> None:
+        if version != await self.version() or await self.client.exists(self._key("settling")):
+            return
+        await self.client.set(self._key("entry", key), dump_entry(entry), ex=self.ttl)
+        for park_name in entry.tags.park_names or ("*",):
+            index = self._key("park", park_name)
+            await self.client.sadd(index, key)
+            await self.client.expire(index, self.ttl)
+
+    async def _settle(self) -> None:
+        if self.settle > 0:
+            await self.client.set(self._key("settling"), 1, px=int(self.settle * 1000))
+
+    async def invalidate(self, park_name: str, first: date, last: date) -> int:
+        await self.client.incr(self._key("version"))
+        await self._settle()
+        deleted = 0
+        for index in (self._key("park", park_name), self._key("park", "*")):
+            keys = sorted(k.decode() if isinstance(k, bytes) else k for k in await self.client.smembers(index))
+            if not keys:
+                continue
+            values = await self.client.mget([self._key("entry", key) for key in keys])
+            stale = [
+                key
+                for key, data in zip(keys, values)
+                if not data or load_entry(data).tags.matches(park_name, first, last)
+            ]
+            if stale:
+                deleted += await self.client.delete(*(self._key("entry", key) for key in stale))
+                await self.client.srem(index, *stale)
+        return deleted
+
+    async def clear(self) -> None:
+        await self.client.incr(self._key("version"))
+        await self._settle()
+        keys = [key async for key in self.client.scan_iter(match=self._key("*"))]
+        kept = (self._key("version"), self._key("settling"))
+        keys = [key for key in keys if (key.decode() if isinstance(key, bytes) else key) not in kept]
+        if keys:
+            await self.client.delete(*keys)
+
+
+def create_cache_backend(url: Optional[str] = None, ttl: Optional[int] = None) -> CacheBackend:
+    """
+    Cache backend from ``CACHE_URL``, ``CACHE_TTL`` and ``CACHE_MAX_ENTRIES``, waiting ``DB_REPLICA_MAX_LAG`` after
+    invalidations when reads go to replicas. Without ``CACHE_URL``, ``memory://`` with one server worker and
+    ``none://`` with several.
+    """
+    url = url or os.environ.get("CACHE_URL") or ("memory://" if WORKERS == 1 else "none://")
+    ttl = ttl if ttl is not None else int(os.environ.get("CACHE_TTL", 60))
+    settle = REPLICA_MAX_LAG if REPLICA_HOSTS else 0
+    if url.startswith("memory://"):
+        if WORKERS > 1:
+            raise ValueError(
+                f"CACHE_URL={url} is per process and would serve stale responses with WEB_CONCURRENCY={WORKERS}: "
+                "use redis:// or none://"
+            )
+        return MemoryCache(max_entries=int(os.environ.get("CACHE_MAX_ENTRIES", 1024)), ttl=ttl, settle=settle)
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        try:
+            from redis.asyncio import from_url
+        except ImportError as exc:
+            raise RuntimeError("CACHE_URL points to Redis but the optional 'redis' package is not installed") from exc
+        return RedisCache(from_url(url), ttl=ttl, settle=settle)
+    if url.startswith("none://"):
+        return CacheBackend()
+    raise ValueError(f"Unsupported CACHE_URL: {url}")
+
+
+def get_cache(request: Request) -> CacheBackend:
+    """
+    Return the response cache of the application.
+    """
+    return getattr(request.app.state, "cache", None) or CacheBackend()
+
+
+def cache_key(scope: Scope) -> str:
+    query = sorted(parse_qsl(scope["query_string"].decode("latin-1")))
+    accept = Headers(scope=scope).get("accept", "")
+    return sha256(f"{scope['path']}?{urlencode(query)}\n{accept}".encode()).hexdigest()
+
+
+def cache_tags(scope: Scope) -> CacheTags:
+    params: Dict[str, List[str]] = {}
+    for name, value in parse_qsl(scope["query_string"].decode("latin-1")):
+        params.setdefault(name, []).append(value)
+
+    def parse_date(name: str) -> Optional[date]:
+        try:
+            return date.fromisoformat(params[name][0][:10])
+        except (KeyError, ValueError):
+            return None
+
+    return CacheTags(
+        readings=CACHED_PATHS[scope["path"]],
+        park_names=tuple(sorted(set(params.get("park_names", [])))),
+        start_date=parse_date("start_date"),
+        end_date=parse_date("end_date"),
+    )
+
+
+def if_none_match(scope: Scope, etag: str) -> bool:
+    values = Headers(scope=scope).get("if-none-match")
+    if not values:
+        return False
+    candidates = [value.strip().removeprefix("W/") for value in values.split(",")]
+    return "*" in candidates or etag in candidates
+
+
+class ResponseCacheMiddleware:
+    """
+    Serve cached responses of ``CACHED_PATHS`` and answer conditional requests with ``304 Not Modified``.
+
+    Only successful ``GET`` responses are stored. The body is stored before compression, since the
+    ``CompressionMiddleware`` wraps this one.
+    """
+
+    def __init__(self, app: ASGIApp, backend: Optional[CacheBackend] = None) -> None:
+        self.app = app
+        self.backend = backend or CacheBackend()
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or scope["method"] != "GET" or scope["path"] not in CACHED_PATHS:
+            await self.app(scope, receive, send)
+            return
+
+        key = cache_key(scope)
+        entry = await self.backend.get(key)
+        if entry is not None:
+            await self.send_entry(scope, send, entry, hit=True)
+            return
+
+        version = await self.backend.version()
+        start: Optional[Message] = None
+        chunks: List[bytes] = []
+
+        async def buffer(message: Message) -> None:
+            nonlocal start
+            if message["type"] == "http.response.start":
+                start = message
+            elif message["type"] == "http.response.body":
+                chunks.append(message.get("body", b""))
+
+        await self.app(scope, receive, buffer)
+        assert start is not None
+        body = b"".join(chunks)
+        headers = [(name.decode("latin-1"), value.decode("latin-1")) for name, value in start.get("headers", [])]
+        entry = CacheEntry(
+            status=start["status"],
+            headers=headers,
+            body=body,
+            etag=f'"{sha256(body).hexdigest()[:32]}"',
+            tags=cache_tags(scope),
+        )
+        if entry.status == 200:
+            await self.backend.set(key, entry, version)
+        await self.send_entry(scope, send, entry, hit=False)
+
+    async def send_entry(self, scope: Scope, send: Send, entry: CacheEntry, hit: bool) -> None:
+        status, body = entry.status, entry.body
+        headers = MutableHeaders(
+            raw=[(name.encode("latin-1"), value.encode("latin-1")) for name, value in entry.headers]
+        )
+        if status == 200:
+            headers["ETag"] = entry.etag
+            headers["Cache-Control"] = "no-cache"
+            if if_none_match(scope, entry.etag):
+                status, body = 304, b""
+                del headers["content-length"]
+                del headers["content-type"]
+        headers[CACHE_HEADER] = "HIT" if hit else "MISS"
+        await send({"type": "http.response.start", "status": status, "headers": headers.raw})
+        await send({"type": "http.response.body", "body": body})
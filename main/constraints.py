@@ -20,3 +20,37 @@ class Timezone(str, Enum):
     istanbul = "Europe/Istanbul"
     volgograd = "Europe/Volgograd"
     vienna = "Europe/Vienna"
+
+
+class ExportFormat(str, Enum):
+    ndjson = "ndjson"
+    csv = "csv"
+    arrow = "arrow"
+    parquet = "parquet"
+
+
+class TzMode(str, Enum):
+    local = "local"
+    utc = "utc"
+
+
+class Bucket(str, Enum):
+    fifteen_minutes = "15min"
+    hour = "hour"
+    day = "day"
+    week = "week"
+    month = "month"
+
+
+class StatsView(str, Enum):
+    parks = "parks"
+    energy_types = "energy_types"
+    timezones = "timezones"
+    all = "all"
+
+
+class JobStatus(str, Enum):
+    queued = "queued"
+    running = "running"
+    succeeded = "succeeded"
+    failed = "failed"
@@ -1,11 +1,21 @@
 # -*-coding:utf8-*-
 from contextlib import asynccontextmanager
+import logging
 import os
+from typing import List
 
 from sqlalchemy import create_engine
+from sqlalchemy.engine import Engine
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.orm import Session
+from sqlalchemy.pool import Pool
 
-from main.db.models import Base
+from main.db.migrations import migrate
+from main.db.partitions import ensure_upcoming_energy_readings_partitions
+from main.db.replicas import REPLICA_HOSTS, ReadRouter, replica_name, replica_url
+from main.metrics import InstrumentedAsyncAdaptedQueuePool, InstrumentedQueuePool, instrument_engine
+
+logger = logging.getLogger(__name__)
 
 username = os.environ.get("POSTGRES_USER")
 password = os.environ.get("POSTGRES_PASSWORD")
@@ -13,16 +23,83 @@ dbname = os.environ.get("POSTGRES_DB")
 host = os.environ.get("POSTGRES_HOST")
 port = os.environ.get("POSTGRES_PORT", 5432)
 DB_URL = f"postgresql+psycopg2://{username}:{password}@{host}:{port}/{dbname}"
-engine = create_engine(DB_URL, future=True)
+ASYNC_DB_URL = f"postgresql+asyncpg://{username}:{password}@{host}:{port}/{dbname}"
+
+RUN_MIGRATIONS_ON_STARTUP = os.environ.get("RUN_MIGRATIONS_ON_STARTUP", "true").lower() in ("1", "true", "yes")
+# Pool sizes are for the whole server, split between its worker processes, see main.server
+WORKERS = int(os.environ.get("WEB_CONCURRENCY", 1))
+
+POOL_OPTIONS = {
+    "pool_size": max(int(os.environ.get("DB_POOL_SIZE", 5)) // WORKERS, 1),
+    "max_overflow": int(os.environ.get("DB_MAX_OVERFLOW", 10)) // WORKERS,
+    "pool_timeout": float(os.environ.get("DB_POOL_TIMEOUT", 30)),
+    "pool_recycle": int(os.environ.get("DB_POOL_RECYCLE", -1)),
+    "pool_pre_ping": os.environ.get("DB_POOL_PRE_PING", "false").lower() in ("1", "true", "yes"),
+}
+
+engine = create_engine(DB_URL, future=True, poolclass=InstrumentedQueuePool, **POOL_OPTIONS)
+async_engine = create_async_engine(ASYNC_DB_URL, poolclass=InstrumentedAsyncAdaptedQueuePool, **POOL_OPTIONS)
+instrument_engine(engine)
+instrument_engine(async_engine.sync_engine)
+async_session_factory = async_sessionmaker(async_engine, expire_on_commit=False)
+replica_engines = [
+    create_async_engine(replica_url(ASYNC_DB_URL, host), poolclass=InstrumentedAsyncAdaptedQueuePool, **POOL_OPTIONS)
+    for host in REPLICA_HOSTS
+]
+for replica_engine in replica_engines:
+    replica_engine.pool.pool_name = f"replica {replica_name(replica_engine)}"  # type:ignore[attr-defined]
+    instrument_engine(replica_engine.sync_engine)
+read_router = ReadRouter(async_engine, replica_engines)
+
+
+def prepare_database() -> None:
+    """
+    Apply pending schema migrations, create the upcoming ``energy_readings`` partitions and fail the ingestion jobs
+    interrupted by the last shutdown.
+    """
+    with engine.begin() as connection:
+        migrate(connection)
+    with Session(engine, future=True) as session:
+        ensure_upcoming_energy_readings_partitions(session)
+        session.commit()
+    clean_up_interrupted_jobs()
+
+
+def clean_up_interrupted_jobs() -> None:
+    """
+    Fail the ingestion jobs interrupted by the last shutdown, see ``main.jobs.fail_interrupted_jobs``.
+    """
+    from main.jobs import fail_interrupted_jobs  # Imports the ingestion code, which imports this module
+
+    with engine.begin() as connection:
+        if count := fail_interrupted_jobs(connection):
+            logger.warning("Marked %d ingestion jobs interrupted by the last shutdown failed", count)
 
 
 @asynccontextmanager
 async def create_db_and_tables():
     """
-    Initialize tables.
+    Prepare the database, unless ``RUN_MIGRATIONS_ON_STARTUP`` is off (e.g. done once by the server before starting
+    its workers), then check the read replicas while the app runs.
+    """
+    if RUN_MIGRATIONS_ON_STARTUP:
+        prepare_database()
+    async with read_router.monitor():
+        yield
+
+
+def get_engine() -> Engine:
+    """
+    Return the sync engine, for work handed over to other processes (they connect with its URL).
     """
-    Base.metadata.create_all(engine)
-    yield
+    return engine
+
+
+def get_read_pools() -> List[Pool]:
+    """
+    Return the pools of the engines serving reads, read by the admission control. Disposing an engine replaces it.
+    """
+    return read_router.pools()
 
 
 def get_session():
@@ -31,3 +108,27 @@ def get_session():
     """
     with Session(engine, future=True) as session:
         yield session
+
+
+async def get_async_session():
+    """
+    Yield async session on the primary
+    """
+    async with async_session_factory() as session:
+        yield session
+
+
+async def get_read_session():
+    """
+    Yield async session on the next healthy read replica, or the primary without replicas
+    """
+    async with read_router.session() as session:
+        yield session
+
+
+def get_read_sessionmaker() -> async_sessionmaker[AsyncSession]:
+    """
+    Return the session factory of the next healthy read replica, or of the primary without replicas, for responses
+    that outlive the request dependencies (e.g. streaming).
+    """
+    return read_router.sessionmaker()
@@ -0,0 +1,472 @@
+# -*-coding:utf8-*-
+from datetime import date, datetime, timedelta
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Mapping, NamedTuple, Optional, Sequence, Tuple
+
+from sqlalchemy import Table, literal_column, or_, select, text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.exc import NoResultFound
+from sqlalchemy.orm import Session
+
+from main.db.models import StationRow
+from main.db.partitions import Partition, detach_energy_readings_partition, ensure_energy_readings_partitions
+
+STAGING_TABLE = "energy_readings_staging"
+MEASUREMENTS_STAGING_TABLE = "measurements_staging"
+READINGS_LOCK_KEY = 20240302
+COPY_BUFFER_SIZE = 64 * 1024
+
+
+def days_of(source: str, tz_modes: Sequence[str] = ("utc", "local")) -> str:
+    """
+    SQL query returning the ``(park_name, tz_mode, date, timezone)`` days of the readings in ``source``, in UTC and/or
+    in the timezone of the park. Readings are stored as UTC.
+    """
+    modes = ", ".join(f"('{tz_mode}')" for tz_mode in tz_modes)
+    return f"""
+        SELECT DISTINCT
+            s.park_name,
+            m.tz_mode,
+            CASE m.tz_mode
+                WHEN 'utc' THEN s.timestamp::date
+                ELSE (s.timestamp AT TIME ZONE 'UTC' AT TIME ZONE p.timezone)::date
+            END AS date,
+            p.timezone
+        FROM {source} AS s
+        JOIN parks AS p ON p.name = s.park_name
+        CROSS JOIN (VALUES {modes}) AS m (tz_mode)
+    """
+
+
+ALL_DAYS = days_of("energy_readings")
+
+
+class UpsertCounts(NamedTuple):
+    inserted: int
+    updated: int
+    unchanged: int
+
+    def __add__(self, other: "UpsertCounts") -> "UpsertCounts":  # type:ignore[override]
+        return UpsertCounts(*(a + b for a, b in zip(self, other)))
+
+
+class CopyBuffer:
+    """
+    Minimal file-like adapter so psycopg2's ``copy_expert`` can pull encoded lines lazily from an iterator.
+
+    psycopg2 reports errors raised while reading as a cancelled query, so the original one is kept in ``error``.
+    """
+
+    def __init__(self, lines: Iterator[str], encoding: str = "utf8") -> None:
+        self.lines = lines
+        self.encoding = encoding
+        self.buffer = b""
+        self.error: Optional[Exception] = None
+
+    def read(self, size: int = -1) -> bytes:
+        while size < 0 or len(self.buffer) < size:
+            try:
+                line: Optional[str] = next(self.lines, None)
+            except Exception as exc:
+                self.error = exc
+                raise
+            if line is None:
+                break
+            self.buffer += line.encode(self.encoding)
+        if size < 0:
+            size = len(self.buffer)
+        chunk, self.buffer = self.buffer[:size], self.buffer[size:]
+        return chunk
+
+
+def gen_energy_reading_copy_lines(park_name: str, rows: Iterable[Dict[str, str]]) -> Iterator[str]:
+    """
+    Validate CSV rows and yield them as tab separated lines in COPY text format.
+    """
+    for row in rows:
+        timestamp = datetime.fromisoformat(row["datetime"])
+        megawatts = float(row["MW"])
+        yield f"{park_name}\t{timestamp.isoformat()}\t{megawatts!r}\n"
+
+
+def parse_aemet_number(value: Optional[str]) -> Optional[float]:
+    """
+    AEMET decimal value, written with a decimal comma in the OpenData files. ``Ip`` (less than 0.1 mm of
+    precipitation) is 0, ``Acum`` (accumulated over several days) and ``Varias`` are unknown for the day.
+    """
+    value = (value or "").strip()
+    if value == "Ip":
+        return 0.0
+    if not value or value in ("Acum", "Varias"):
+        return None
+    return float(value.replace(",", "."))
+
+
+def parse_aemet_direction(value: Optional[str]) -> Optional[int]:
+    """
+    AEMET wind direction, in tens of degrees. ``99`` is variable, ``88`` is no data.
+    """
+    value = (value or "").strip()
+    return int(value) if value.isdigit() and value not in ("88", "99") else None
+
+
+def parse_aemet_time(value: Optional[str]) -> Optional[str]:
+    """
+    AEMET time of day, ``HH:MM`` or ``Varias`` when reached several times.
+    """
+    return (value or "").strip() or None
+
+
+# AEMET column -> measurements column and parser, in COPY order
+MEASUREMENT_COLUMNS: List[Tuple[str, str, Callable[[Optional[str]], Any]]] = [
+    ("TMEDIA", "avg_temp", parse_aemet_number),
+    ("TMIN", "min_temp", parse_aemet_number),
+    ("TMAX", "max_temp", parse_aemet_number),
+    ("HORATMIN", "min_temp_time", parse_aemet_time),
+    ("HORATMAX", "max_temp_time", parse_aemet_time),
+    ("PRECIPITACION", "precipitation", parse_aemet_number),
+    ("DIR", "wind_direction", parse_aemet_direction),
+    ("VELMEDIA", "avg_wind_speed", parse_aemet_number),
+    ("RACHA", "max_gust", parse_aemet_number),
+    ("HORARACHA", "max_gust_time", parse_aemet_time),
+    ("SOL", "sunshine", parse_aemet_number),
+    ("PRESMAX", "max_pressure", parse_aemet_number),
+    ("HORAPRESMAX", "max_pressure_time", parse_aemet_time),
+    ("PRESMIN", "min_pressure", parse_aemet_number),
+    ("HORAPRESMIN", "min_pressure_time", parse_aemet_time),
+    ("HRMEDIA", "avg_humidity", parse_aemet_number),
+    ("HRMAX", "max_humidity", parse_aemet_number),
+    ("HORAHRMAX", "max_humidity_time", parse_aemet_time),
+    ("HRMIN", "min_humidity", parse_aemet_number),
+    ("HORAHRMIN", "min_humidity_time", parse_aemet_time),
+]
+
+
+def gen_measurement_copy_lines(
+    rows: Iterable[Dict[str, str]], station_ids: Mapping[str, int], station_code: Optional[str] = None
+) -> Iterator[str]:
+    """
+    Parse AEMET daily rows and yield them as tab separated lines in COPY text format.
+
+    Rows belong to their ``INDICATIVO`` station, or to ``station_code`` for every row when given. ``FECHA`` and the
+    station are required, missing or empty measurement columns are nulls.
+
+    Raises:
+        KeyError: if a row has no ``FECHA``, or no ``INDICATIVO`` without ``station_code``.
+        NoResultFound: for a station not in ``station_ids``.
+    """
+    for row in rows:
+        code = station_code or row["INDICATIVO"]
+        if code not in station_ids:
+            raise NoResultFound(f"No station with code {code!r}")
+        values = [parse(row.get(aemet_column)) for aemet_column, _, parse in MEASUREMENT_COLUMNS]
+        fields = [str(station_ids[code]), date.fromisoformat(row["FECHA"]).isoformat()]
+        fields += ["\\N" if value is None else value if isinstance(value, str) else repr(value) for value in values]
+        yield "\t".join(fields) + "\n"
+
+
+def upsert_rows(session: Session, table: Table, rows: List[Dict[str, Any]], index_elements: List[str]) -> UpsertCounts:
+    """
+    Batch ``INSERT ... ON CONFLICT DO UPDATE`` of rows into a table.
+
+    Rows sharing the same conflict key are collapsed (last one wins) and counted once, and rows whose values did not
+    change are left untouched so they are reported as unchanged.
+
+    Args:
+        session: The database session. The caller owns the transaction and must commit.
+        table: The target table.
+        rows: Column name to value mappings.
+        index_elements: Columns of the unique constraint used as conflict target.
+
+    Returns:
+        The number of inserted, updated and unchanged distinct rows.
+    """
+    if not rows:
+        return UpsertCounts(inserted=0, updated=0, unchanged=0)
+    unique_rows = list({tuple(row[name] for name in index_elements): row for row in rows}.values())
+    stmt = pg_insert(table)
+    update_columns = [c.name for c in table.columns if c.name in rows[0] and c.name not in index_elements]
+    stmt = stmt.on_conflict_do_update(
+        index_elements=index_elements,
+        set_={name: stmt.excluded[name] for name in update_columns},
+        where=or_(*(table.c[name].is_distinct_from(stmt.excluded[name]) for name in update_columns)),
+    ).returning(literal_column("xmax = 0"))
+    inserted_flags = session.execute(stmt, unique_rows).scalars().all()
+    inserted = sum(inserted_flags)
+    updated = len(inserted_flags) - inserted
+    return UpsertCounts(inserted=inserted, updated=updated, unchanged=len(unique_rows) - inserted - updated)
+
+
+def stage_energy_readings(session: Session, park_name: str, rows: Iterable[Dict[str, str]]) -> int:
+    """
+    Stream energy readings into a temporary staging table with ``COPY ... FROM STDIN``, parsing them on the way.
+
+    The staging table is dropped when the transaction ends, see ``merge_staged_energy_readings``.
+
+    Args:
+        session: The database session. The caller owns the transaction and must commit.
+        park_name: The name of the park to associate the energy readings with.
+        rows: Parsed CSV rows with ``datetime`` and ``MW`` columns.
+
+    Returns:
+        The number of staged readings.
+    """
+    session.execute(
+        text(
+            f"CREATE TEMPORARY TABLE {STAGING_TABLE} ("
+            "seq BIGINT GENERATED ALWAYS AS IDENTITY, park_name VARCHAR(50), timestamp TIMESTAMP, megawatts FLOAT"
+            ") ON COMMIT DROP"
+        )
+    )
+    dbapi_connection = session.connection().connection.dbapi_connection
+    buffer = CopyBuffer(gen_energy_reading_copy_lines(park_name, rows))
+    with dbapi_connection.cursor() as cursor:
+        try:
+            cursor.copy_expert(
+                f"COPY {STAGING_TABLE} (park_name, timestamp, megawatts) FROM STDIN", buffer, size=COPY_BUFFER_SIZE
+            )
+        except Exception as exc:
+            if buffer.error is not None:
+                raise buffer.error from exc  # e.g. KeyError on a missing column
+            raise
+        return cursor.rowcount
+
+
+def merge_staged_energy_readings(session: Session, park_name: str, total: int) -> UpsertCounts:
+    """
+    Merge the staged readings of a park into ``energy_readings``.
+
+    A single ``INSERT ... SELECT ... ON CONFLICT (park_name, timestamp) DO UPDATE`` collapses repeated readings (last
+    one wins), the monthly partitions of the readings are created if missing, and the daily rollup is refreshed for
+    their days. Merges of the same park wait for each other, so concurrent uploads cannot leave a stale rollup.
+
+    Args:
+        session: The database session. The caller owns the transaction and must commit.
+        park_name: The park of the staged readings.
+        total: The number of staged readings, see ``stage_energy_readings``.
+
+    Returns:
+        The number of inserted, updated and unchanged readings.
+    """
+    session.execute(
+        text("SELECT pg_advisory_xact_lock(:key, hashtext(:park_name))"),
+        {"key": READINGS_LOCK_KEY, "park_name": park_name},
+    )
+    first, last = staged_energy_readings_date_range(session)
+    if first and last:
+        ensure_energy_readings_partitions(session, first, last)
+    inserted, updated = session.execute(
+        text(
+            f"""
+            WITH upserted AS (
+                INSERT INTO energy_readings (park_name, timestamp, megawatts)
+                SELECT DISTINCT ON (park_name, timestamp) park_name, timestamp, megawatts
+                FROM {STAGING_TABLE}
+                ORDER BY park_name, timestamp, seq DESC
+                ON CONFLICT (park_name, timestamp) DO UPDATE SET megawatts = EXCLUDED.megawatts
+                WHERE energy_readings.megawatts IS DISTINCT FROM EXCLUDED.megawatts
+                RETURNING park_name, timestamp
+            )
+            -- Partitioned tables cannot return xmax, the join sees the readings as they were before the upsert
+            SELECT count(*) FILTER (WHERE r.park_name IS NULL), count(*) FILTER (WHERE r.park_name IS NOT NULL)
+            FROM upserted AS u
+            LEFT JOIN energy_readings AS r ON r.park_name = u.park_name AND r.timestamp = u.timestamp
+            """
+        )
+    ).one()
+    if inserted or updated:
+        refresh_energy_readings_daily(session, days=days_of(STAGING_TABLE))
+    return UpsertCounts(inserted=inserted, updated=updated, unchanged=total - inserted - updated)
+
+
+def copy_energy_readings(session: Session, park_name: str, rows: Iterable[Dict[str, str]]) -> UpsertCounts:
+    """
+    Bulk upsert energy readings with ``COPY ... FROM STDIN`` through a temporary staging table.
+
+    Rows are streamed straight into the staging table, then merged into ``energy_readings``, see
+    ``merge_staged_energy_readings``. Constraint violations surface as regular SQLAlchemy errors.
+
+    Args:
+        session: The database session. The caller owns the transaction and must commit.
+        park_name: The name of the park to associate the energy readings with.
+        rows: Parsed CSV rows with ``datetime`` and ``MW`` columns.
+
+    Returns:
+        The number of inserted, updated and unchanged readings.
+    """
+    total = stage_energy_readings(session, park_name, rows)
+    return merge_staged_energy_readings(session, park_name, total)
+
+
+def get_station_ids(session: Session) -> Dict[str, int]:
+    """
+    Map of station codes to ids, so a file of any number of stations is resolved without a query per row.
+    """
+    rows = session.execute(select(StationRow.code, StationRow.id).order_by(StationRow.id))
+    return {code: station_id for code, station_id in rows}
+
+
+def copy_measurements(
+    session: Session, rows: Iterable[Dict[str, str]], station_code: Optional[str] = None
+) -> UpsertCounts:
+    """
+    Bulk upsert AEMET daily measurements with ``COPY ... FROM STDIN`` through a temporary staging table.
+
+    Station codes are resolved from one lookup of every station, so files with decades of days for many stations
+    load in one pass. A single ``INSERT ... SELECT ... ON CONFLICT (station_id, date) DO UPDATE`` then merges the
+    staged rows, collapsing repeated days (last one wins) and leaving unchanged ones untouched.
+
+    Args:
+        session: The database session. The caller owns the transaction and must commit.
+        rows: Parsed AEMET CSV rows, see ``gen_measurement_copy_lines``.
+        station_code: The station of every row, instead of their ``INDICATIVO`` column.
+
+    Returns:
+        The number of inserted, updated and unchanged measurements.
+    """
+    columns = ["station_id", "date", *(column for _, column, _ in MEASUREMENT_COLUMNS)]
+    session.execute(
+        text(
+            f"CREATE TEMPORARY TABLE {MEASUREMENTS_STAGING_TABLE} ("
+            "seq BIGINT GENERATED ALWAYS AS IDENTITY, LIKE measurements"
+            ") ON COMMIT DROP"
+        )
+    )
+    session.execute(text(f"ALTER TABLE {MEASUREMENTS_STAGING_TABLE} DROP COLUMN id"))
+    dbapi_connection = session.connection().connection.dbapi_connection
+    buffer = CopyBuffer(gen_measurement_copy_lines(rows, get_station_ids(session), station_code))
+    with dbapi_connection.cursor() as cursor:
+        try:
+            cursor.copy_expert(
+                f"COPY {MEASUREMENTS_STAGING_TABLE} ({', '.join(columns)}) FROM STDIN", buffer, size=COPY_BUFFER_SIZE
+            )
+        except Exception as exc:
+            if buffer.error is not None:
+                raise buffer.error from exc  # e.g. KeyError on a missing column, NoResultFound on an unknown station
+            raise
+        total = cursor.rowcount
+    update_columns = columns[2:]
+    inserted, updated = session.execute(
+        text(
+            f"""
+            WITH upserted AS (
+                INSERT INTO measurements ({", ".join(columns)})
+                SELECT DISTINCT ON (station_id, date) {", ".join(columns)}
+                FROM {MEASUREMENTS_STAGING_TABLE}
+                ORDER BY station_id, date, seq DESC
+                ON CONFLICT (station_id, date) DO UPDATE
+                SET ({", ".join(update_columns)}) = ROW({", ".join(f"EXCLUDED.{c}" for c in update_columns)})
+                WHERE ({", ".join(f"measurements.{c}" for c in update_columns)})
+                    IS DISTINCT FROM ({", ".join(f"EXCLUDED.{c}" for c in update_columns)})
+                RETURNING xmax = 0 AS inserted
+            )
+            SELECT count(*) FILTER (WHERE inserted), count(*) FILTER (WHERE NOT inserted) FROM upserted
+            """
+        )
+    ).one()
+    return UpsertCounts(inserted=inserted, updated=updated, unchanged=total - inserted - updated)
+
+
+def staged_energy_readings_date_range(session: Session) -> Tuple[Optional[date], Optional[date]]:
+    """
+    First and last day of the readings staged by ``stage_energy_readings``, before the transaction commits.
+    """
+    first, last = session.execute(text(f"SELECT min(timestamp)::date, max(timestamp)::date FROM {STAGING_TABLE}")).one()
+    return first, last
+
+
+def refresh_energy_readings_daily(
+    session: Session, days: str = ALL_DAYS, params: Optional[Dict[str, Any]] = None
+) -> None:
+    """
+    Recompute the ``energy_readings_daily`` rollup for the given days.
+
+    Each day is turned into a ``[lower, upper)`` UTC timestamp range, so readings are read through the
+    (park_name, timestamp) index and local days spanning a DST change get their 23 or 25 hours.
+
+    Args:
+        session: The database session. The caller owns the transaction and must commit.
+        days: SQL query returning the ``(park_name, tz_mode, date, timezone)`` days to refresh, see ``days_of``.
+            Every day with readings by default.
+        params: Bind parameters of ``days``.
+    """
+    session.execute(
+        text(
+            f"""
+            INSERT INTO energy_readings_daily (park_name, tz_mode, date, min, max, sum, sum_squares, count)
+            SELECT d.park_name, d.tz_mode, d.date,
+                min(r.megawatts), max(r.megawatts), sum(r.megawatts), sum(r.megawatts ^ 2), count(r.megawatts)
+            FROM (
+                SELECT
+                    days.park_name,
+                    days.tz_mode,
+                    days.date,
+                    CASE days.tz_mode
+                        WHEN 'utc' THEN days.date::timestamp
+                        ELSE days.date::timestamp AT TIME ZONE days.timezone AT TIME ZONE 'UTC'
+                    END AS lower,
+                    CASE days.tz_mode
+                        WHEN 'utc' THEN (days.date + 1)::timestamp
+                        ELSE (days.date + 1)::timestamp AT TIME ZONE days.timezone AT TIME ZONE 'UTC'
+                    END AS upper
+                FROM ({days}) AS days
+            ) AS d
+            JOIN energy_readings AS r
+            ON r.park_name = d.park_name AND r.timestamp >= d.lower AND r.timestamp < d.upper
+            GROUP BY d.park_name, d.tz_mode, d.date
+            ON CONFLICT (park_name, tz_mode, date) DO UPDATE
+            SET min = EXCLUDED.min, max = EXCLUDED.max, sum = EXCLUDED.sum, sum_squares = EXCLUDED.sum_squares,
+                count = EXCLUDED.count
+            """
+        ),
+        params or {},
+    )
+
+
+def refresh_local_energy_readings_daily(session: Session, park_names: Iterable[str]) -> None:
+    """
+    Recompute the local days of the ``energy_readings_daily`` rollup of parks whose timezone changed, as their local
+    days moved. Takes the locks of ``merge_staged_energy_readings`` on those parks, so concurrent merges don't
+    refresh days in the previous timezone.
+
+    Args:
+        session: The database session. The caller owns the transaction and must commit.
+        park_names: The parks whose timezone changed.
+    """
+    park_names = sorted(set(park_names))  # Always locked in the same order
+    for park_name in park_names:
+        session.execute(
+            text("SELECT pg_advisory_xact_lock(:key, hashtext(:park_name))"),
+            {"key": READINGS_LOCK_KEY, "park_name": park_name},
+        )
+    session.execute(
+        text("DELETE FROM energy_readings_daily WHERE tz_mode = 'local' AND park_name = ANY(:park_names)"),
+        {"park_names": park_names},
+    )
+    readings = "(SELECT park_name, timestamp FROM energy_readings WHERE park_name = ANY(:park_names))"
+    refresh_energy_readings_daily(session, days=days_of(readings, ("local",)), params={"park_names": park_names})
+
+
+def drop_energy_readings_month(session: Session, partition: Partition) -> None:
+    """
+    Drop the readings of a month by detaching its partition, and bring the daily rollup in line.
+
+    The detach is committed first, as it locks ``energy_readings`` against every read until the transaction ends.
+    Rollup days of that month are then deleted, and the days next to it are recomputed from the remaining readings,
+    since local days of a park can straddle the month boundary.
+
+    Args:
+        session: The database session. The caller must commit the rollup changes.
+        partition: The partition of the month, see ``partition_of``.
+    """
+    detach_energy_readings_partition(session, partition)
+    session.commit()
+    lower, upper = partition.start - timedelta(days=1), partition.end + timedelta(days=1)
+    session.execute(
+        text("DELETE FROM energy_readings_daily WHERE date >= :lower AND date < :upper"),
+        {"lower": lower, "upper": upper},
+    )
+    neighbours = (
+        "(SELECT park_name, timestamp FROM energy_readings "
+        f"WHERE timestamp >= '{lower - timedelta(days=1)}' AND timestamp < '{upper + timedelta(days=1)}')"
+    )
+    refresh_energy_readings_daily(session, days=days_of(neighbours))
@@ -0,0 +1,351 @@
+# -*-coding:utf8-*-
+"""
+Minimal, ordered schema migrations.
+
+Each migration is a list of SQL statements applied once, inside a single transaction guarded by an advisory lock,
+and recorded in the ``schema_migrations`` table. Append new migrations at the end; never edit applied ones.
+"""
+from typing import List, NamedTuple, Optional, Sequence
+
+from sqlalchemy import text
+from sqlalchemy.engine import Connection
+
+MIGRATIONS_LOCK_KEY = 20240301
+
+
+class Migration(NamedTuple):
+    version: int
+    name: str
+    statements: Sequence[str]
+
+
+MIGRATIONS: List[Migration] = [
+    Migration(
+        version=1,
+        name="baseline",
+        statements=[
+            """
+            CREATE TABLE IF NOT EXISTS parks (
+                name VARCHAR(50) NOT NULL,
+                timezone VARCHAR(50) NOT NULL,
+                energy_type VARCHAR(50) NOT NULL,
+                PRIMARY KEY (name)
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS stations (
+                id SERIAL NOT NULL,
+                code VARCHAR NOT NULL,
+                name VARCHAR NOT NULL,
+                province VARCHAR NOT NULL,
+                latitude VARCHAR NOT NULL,
+                longitude VARCHAR NOT NULL,
+                altitude VARCHAR NOT NULL,
+                PRIMARY KEY (id)
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS energy_readings (
+                id SERIAL NOT NULL,
+                megawatts FLOAT NOT NULL,
+                timestamp TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+                park_name VARCHAR(50) NOT NULL,
+                PRIMARY KEY (id),
+                FOREIGN KEY (park_name) REFERENCES parks (name)
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS measurements (
+                id SERIAL NOT NULL,
+                station_id INTEGER NOT NULL,
+                date DATE NOT NULL,
+                avg_temp FLOAT NOT NULL,
+                min_temp FLOAT NOT NULL,
+                max_temp FLOAT NOT NULL,
+                PRIMARY KEY (id),
+                FOREIGN KEY (station_id) REFERENCES stations (id)
+            )
+            """,
+        ],
+    ),
+    Migration(
+        version=2,
+        name="energy_readings_park_name_timestamp_indexes",
+        statements=[
+            # Keep the latest reading for duplicated (park_name, timestamp) pairs before enforcing uniqueness
+            """
+            DELETE FROM energy_readings AS a
+            USING energy_readings AS b
+            WHERE a.park_name = b.park_name AND a.timestamp = b.timestamp AND a.id < b.id
+            """,
+            # The unique constraint is backed by the composite (park_name, timestamp) btree index
+            """
+            ALTER TABLE energy_readings
+            ADD CONSTRAINT uq_energy_readings_park_name_timestamp UNIQUE (park_name, timestamp)
+            """,
+            "CREATE INDEX ix_energy_readings_timestamp_brin ON energy_readings USING brin (timestamp)",
+        ],
+    ),
+    Migration(
+        version=3,
+        name="measurements_station_id_date_unique",
+        statements=[
+            """
+            DELETE FROM measurements AS a
+            USING measurements AS b
+            WHERE a.station_id = b.station_id AND a.date = b.date AND a.id < b.id
+            """,
+            "ALTER TABLE measurements ADD CONSTRAINT uq_measurements_station_id_date UNIQUE (station_id, date)",
+        ],
+    ),
+    Migration(
+        version=4,
+        name="energy_readings_daily",
+        statements=[
+            """
+            CREATE TABLE energy_readings_daily (
+                park_name VARCHAR(50) NOT NULL,
+                date DATE NOT NULL,
+                min FLOAT NOT NULL,
+                max FLOAT NOT NULL,
+                sum FLOAT NOT NULL,
+                count INTEGER NOT NULL,
+                PRIMARY KEY (park_name, date),
+                FOREIGN KEY (park_name) REFERENCES parks (name)
+            )
+            """,
+            """
+            INSERT INTO energy_readings_daily (park_name, date, min, max, sum, count)
+            SELECT park_name, timestamp::date, min(megawatts), max(megawatts), sum(megawatts), count(megawatts)
+            FROM energy_readings
+            GROUP BY park_name, timestamp::date
+            """,
+        ],
+    ),
+    Migration(
+        version=5,
+        name="energy_readings_daily_tz_mode",
+        statements=[
+            # Existing rows were cut at UTC midnight
+            "ALTER TABLE energy_readings_daily ADD COLUMN tz_mode VARCHAR(5) NOT NULL DEFAULT 'utc'",
+            "ALTER TABLE energy_readings_daily ALTER COLUMN tz_mode DROP DEFAULT",
+            """
+            ALTER TABLE energy_readings_daily
+            DROP CONSTRAINT energy_readings_daily_pkey,
+            ADD PRIMARY KEY (park_name, tz_mode, date)
+            """,
+            # Readings are stored as UTC, local days follow the park's timezone
+            """
+            INSERT INTO energy_readings_daily (park_name, tz_mode, date, min, max, sum, count)
+            SELECT r.park_name, 'local', (r.timestamp AT TIME ZONE 'UTC' AT TIME ZONE p.timezone)::date,
+                min(r.megawatts), max(r.megawatts), sum(r.megawatts), count(r.megawatts)
+            FROM energy_readings AS r
+            JOIN parks AS p ON p.name = r.park_name
+            GROUP BY r.park_name, (r.timestamp AT TIME ZONE 'UTC' AT TIME ZONE p.timezone)::date
+            """,
+        ],
+    ),
+    Migration(
+        version=6,
+        name="energy_readings_daily_sum_squares",
+        statements=[
+            # Keeps the variance mergeable across days
+            "ALTER TABLE energy_readings_daily ADD COLUMN sum_squares FLOAT NOT NULL DEFAULT 0",
+            "ALTER TABLE energy_readings_daily ALTER COLUMN sum_squares DROP DEFAULT",
+            """
+            UPDATE energy_readings_daily AS d
+            SET sum_squares = s.sum_squares
+            FROM (
+                SELECT r.park_name, 'utc' AS tz_mode, r.timestamp::date AS date, sum(r.megawatts ^ 2) AS sum_squares
+                FROM energy_readings AS r
+                GROUP BY r.park_name, r.timestamp::date
+                UNION ALL
+                SELECT r.park_name, 'local', (r.timestamp AT TIME ZONE 'UTC' AT TIME ZONE p.timezone)::date,
+                    sum(r.megawatts ^ 2)
+                FROM energy_readings AS r
+                JOIN parks AS p ON p.name = r.park_name
+                GROUP BY r.park_name, (r.timestamp AT TIME ZONE 'UTC' AT TIME ZONE p.timezone)::date
+            ) AS s
+            WHERE d.park_name = s.park_name AND d.tz_mode = s.tz_mode AND d.date = s.date
+            """,
+        ],
+    ),
+    Migration(
+        version=7,
+        name="energy_readings_monthly_partitions",
+        statements=[
+            # The primary key and unique constraints of a partitioned table must include the partition key
+            "ALTER TABLE energy_readings RENAME TO energy_readings_unpartitioned",
+            "ALTER TABLE energy_readings_unpartitioned DROP CONSTRAINT energy_readings_pkey",
+            "ALTER TABLE energy_readings_unpartitioned DROP CONSTRAINT uq_energy_readings_park_name_timestamp",
+            "DROP INDEX ix_energy_readings_timestamp_brin",
+            "ALTER SEQUENCE energy_readings_id_seq OWNED BY NONE",
+            """
+            CREATE TABLE energy_readings (
+                id INTEGER NOT NULL DEFAULT nextval('energy_readings_id_seq'),
+                megawatts FLOAT NOT NULL,
+                timestamp TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+                park_name VARCHAR(50) NOT NULL,
+                PRIMARY KEY (id, timestamp),
+                CONSTRAINT uq_energy_readings_park_name_timestamp UNIQUE (park_name, timestamp),
+                FOREIGN KEY (park_name) REFERENCES parks (name)
+            ) PARTITION BY RANGE (timestamp)
+            """,
+            "ALTER SEQUENCE energy_readings_id_seq OWNED BY energy_readings.id",
+            "CREATE INDEX ix_energy_readings_timestamp_brin ON energy_readings USING brin (timestamp)",
+            "CREATE TABLE energy_readings_default PARTITION OF energy_readings DEFAULT",
+            """
+            DO $$
+            DECLARE
+                month DATE;
+            BEGIN
+                FOR month IN SELECT DISTINCT date_trunc('month', timestamp)::date FROM energy_readings_unpartitioned
+                LOOP
+                    EXECUTE format(
+                        'CREATE TABLE %I PARTITION OF energy_readings FOR VALUES FROM (%L) TO (%L)',
+                        'energy_readings_' || to_char(month, 'YYYY_MM'),
+                        month,
+                        (month + interval '1 month')::date
+                    );
+                END LOOP;
+            END
+            $$
+            """,
+            """
+            INSERT INTO energy_readings (id, megawatts, timestamp, park_name)
+            SELECT id, megawatts, timestamp, park_name FROM energy_readings_unpartitioned
+            """,
+            "DROP TABLE energy_readings_unpartitioned",
+        ],
+    ),
+    Migration(
+        version=8,
+        name="ingestion_jobs",
+        statements=[
+            """
+            CREATE TABLE ingestion_jobs (
+                id UUID NOT NULL,
+                park_name VARCHAR(50) NOT NULL,
+                filename VARCHAR NOT NULL,
+                status VARCHAR(10) NOT NULL,
+                total_bytes BIGINT NOT NULL,
+                processed_bytes BIGINT NOT NULL DEFAULT 0,
+                rows_processed BIGINT NOT NULL DEFAULT 0,
+                inserted INTEGER,
+                updated INTEGER,
+                unchanged INTEGER,
+                error VARCHAR,
+                created_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now(),
+                started_at TIMESTAMP WITH TIME ZONE,
+                finished_at TIMESTAMP WITH TIME ZONE,
+                PRIMARY KEY (id)
+            )
+            """,
+        ],
+    ),
+    Migration(
+        version=9,
+        name="measurements_aemet_columns",
+        statements=[
+            """
+            ALTER TABLE measurements
+                ALTER COLUMN avg_temp DROP NOT NULL,
+                ALTER COLUMN min_temp DROP NOT NULL,
+                ALTER COLUMN max_temp DROP NOT NULL,
+                ADD COLUMN min_temp_time VARCHAR,
+                ADD COLUMN max_temp_time VARCHAR,
+                ADD COLUMN precipitation FLOAT,
+                ADD COLUMN wind_direction SMALLINT,
+                ADD COLUMN avg_wind_speed FLOAT,
+                ADD COLUMN max_gust FLOAT,
+                ADD COLUMN max_gust_time VARCHAR,
+                ADD COLUMN sunshine FLOAT,
+                ADD COLUMN max_pressure FLOAT,
+                ADD COLUMN max_pressure_time VARCHAR,
+                ADD COLUMN min_pressure FLOAT,
+                ADD COLUMN min_pressure_time VARCHAR,
+                ADD COLUMN avg_humidity FLOAT,
+                ADD COLUMN max_humidity FLOAT,
+                ADD COLUMN max_humidity_time VARCHAR,
+                ADD COLUMN min_humidity FLOAT,
+                ADD COLUMN min_humidity_time VARCHAR
+            """,
+        ],
+    ),
+    Migration(
+        version=10,
+        name="parks_station_id",
+        statements=[
+            "ALTER TABLE parks ADD COLUMN station_id INTEGER REFERENCES stations (id)",
+            # Measurements are read by station code, their (station_id, date) unique index covers the date ranges
+            "CREATE INDEX ix_stations_code ON stations (code)",
+        ],
+    ),
+    Migration(
+        version=11,
+        name="stations_code_unique",
+        statements=[
+            # Station uploads are upserted on the code
+            "DROP INDEX ix_stations_code",
+            "CREATE UNIQUE INDEX ix_stations_code ON stations (code)",
+        ],
+    ),
+    Migration(
+        version=12,
+        name="ingestion_jobs_spool_path",
+        statements=[
+            # Spooled files of the jobs interrupted by a restart are removed on startup
+            "ALTER TABLE ingestion_jobs ADD COLUMN spool_path VARCHAR",
+        ],
+    ),
+]
+
+
+def migrate(connection: Connection, target: Optional[int] = None) -> List[int]:
+    """
+    Apply pending migrations up to ``target`` (all of them by default).
+
+    Args:
+        connection: A connection with an open transaction, e.g. from ``engine.begin()``.
+        target: Last migration version to apply.
+
+    Returns:
+        The versions applied by this call.
+    """
+    wanted = {migration.version for migration in MIGRATIONS if target is None or migration.version <= target}
+    # Up to date, the common case of a restart: don't queue on the lock behind the other starting processes
+    if connection.execute(text("SELECT to_regclass('schema_migrations')")).scalar() is not None:
+        if wanted <= set(connection.execute(text("SELECT version FROM schema_migrations")).scalars()):
+            return []
+    connection.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": MIGRATIONS_LOCK_KEY})
+    connection.execute(
+        text(
+            """
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INTEGER NOT NULL PRIMARY KEY,
+                name VARCHAR NOT NULL,
+                applied_at TIMESTAMP NOT NULL DEFAULT now()
+            )
+            """
+        )
+    )
+    applied = set(connection.execute(text("SELECT version FROM schema_migrations")).scalars())
+    versions = []
+    for migration in MIGRATIONS:
+        if migration.version in applied or (target is not None and migration.version > target):
+            continue
+        for statement in migration.statements:
+            connection.execute(text(statement))
+        connection.execute(
+            text("INSERT INTO schema_migrations (version, name) VALUES (:version, :name)"),
+            {"version": migration.version, "name": migration.name},
+        )
+        versions.append(migration.version)
+    return versions
+
+
+if __name__ == "__main__":
+    from main.db import engine
+
+    with engine.begin() as connection:
+        print(f"Applied migrations: {migrate(connection)}")
@@ -1,10 +1,11 @@
 # -*-coding:utf8-*-
 from datetime import date, datetime
-from typing import List
+from typing import List, Optional
+from uuid import UUID
 
-from sqlalchemy import ForeignKey
+from sqlalchemy import DDL, ForeignKey, Index, UniqueConstraint, event, func
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
-from sqlalchemy.types import FLOAT, TIMESTAMP, Integer, String
+from sqlalchemy.types import DATE, FLOAT, TIMESTAMP, BigInteger, Integer, SmallInteger, String, Uuid
 
 
 class Base(DeclarativeBase):
@@ -17,26 +18,63 @@ class ParkRow(Base):
     name: Mapped[str] = mapped_column(String(50), primary_key=True)
     timezone: Mapped[str] = mapped_column(String(50))
     energy_type: Mapped[str] = mapped_column(String(50))
+    # Nearby weather station, see ``/stats/parks/weather``
+    station_id: Mapped[Optional[int]] = mapped_column(ForeignKey("stations.id"))
     energy_readings: Mapped[List["EnergyReadingRow"]] = relationship(
         "EnergyReadingRow", back_populates="park", cascade="all, delete-orphan"
     )
 
 
 class EnergyReadingRow(Base):
+    """
+    Energy readings, partitioned by month of ``timestamp``, see ``main.db.partitions``.
+    """
+
     __tableschema__ = "public"
     __tablename__ = "energy_readings"
-    id: Mapped[Integer] = mapped_column(Integer, primary_key=True)
+    __table_args__ = (
+        UniqueConstraint("park_name", "timestamp", name="uq_energy_readings_park_name_timestamp"),
+        Index("ix_energy_readings_timestamp_brin", "timestamp", postgresql_using="brin"),
+        {"postgresql_partition_by": "RANGE (timestamp)"},
+    )
+    id: Mapped[Integer] = mapped_column(Integer, primary_key=True, autoincrement=True)
     megawatts: Mapped[float] = mapped_column(FLOAT)
-    timestamp: Mapped[datetime] = mapped_column(TIMESTAMP)
+    timestamp: Mapped[datetime] = mapped_column(TIMESTAMP, primary_key=True)
     park_name: Mapped[str] = mapped_column(String(50), ForeignKey("parks.name"))
     park: Mapped["ParkRow"] = relationship("ParkRow", back_populates="energy_readings")
 
 
+event.listen(
+    EnergyReadingRow.__table__,
+    "after_create",
+    DDL("CREATE TABLE energy_readings_default PARTITION OF energy_readings DEFAULT"),
+)
+
+
+class EnergyReadingDailyRow(Base):
+    """
+    Daily rollup of energy readings, maintained by the admin uploads for the days they touch.
+
+    Days are cut in UTC (``tz_mode="utc"``) and in the park's timezone (``tz_mode="local"``).
+    """
+
+    __tableschema__ = "public"
+    __tablename__ = "energy_readings_daily"
+    park_name: Mapped[str] = mapped_column(String(50), ForeignKey("parks.name"), primary_key=True)
+    tz_mode: Mapped[str] = mapped_column(String(5), primary_key=True)
+    date: Mapped[date] = mapped_column(DATE, primary_key=True)
+    min: Mapped[float] = mapped_column(FLOAT)
+    max: Mapped[float] = mapped_column(FLOAT)
+    sum: Mapped[float] = mapped_column(FLOAT)
+    sum_squares: Mapped[float] = mapped_column(FLOAT)
+    count: Mapped[int] = mapped_column(Integer)
+
+
 class StationRow(Base):
     __tableschema__ = "public"
     __tablename__ = "stations"
     id: Mapped[int] = mapped_column(primary_key=True)
-    code: Mapped[str]
+    code: Mapped[str] = mapped_column(index=True, unique=True)
     name: Mapped[str]
     province: Mapped[str]
     latitude: Mapped[str]
@@ -49,11 +87,54 @@ class StationRow(Base):
 class MeasurementRow(Base):
     __tableschema__ = "public"
     __tablename__ = "measurements"
+    __table_args__ = (UniqueConstraint("station_id", "date", name="uq_measurements_station_id_date"),)
     id: Mapped[int] = mapped_column(primary_key=True)
     station_id: Mapped[str] = mapped_column(ForeignKey("stations.id"))
     date: Mapped[date]
-    avg_temp: Mapped[float]
-    min_temp: Mapped[float]
-    max_temp: Mapped[float]
+    # Daily AEMET values, null when the station did not report them
+    avg_temp: Mapped[Optional[float]]
+    min_temp: Mapped[Optional[float]]
+    max_temp: Mapped[Optional[float]]
+    min_temp_time: Mapped[Optional[str]]
+    max_temp_time: Mapped[Optional[str]]
+    precipitation: Mapped[Optional[float]]
+    wind_direction: Mapped[Optional[int]] = mapped_column(SmallInteger)
+    avg_wind_speed: Mapped[Optional[float]]
+    max_gust: Mapped[Optional[float]]
+    max_gust_time: Mapped[Optional[str]]
+    sunshine: Mapped[Optional[float]]
+    max_pressure: Mapped[Optional[float]]
+    max_pressure_time: Mapped[Optional[str]]
+    min_pressure: Mapped[Optional[float]]
+    min_pressure_time: Mapped[Optional[str]]
+    avg_humidity: Mapped[Optional[float]]
+    max_humidity: Mapped[Optional[float]]
+    max_humidity_time: Mapped[Optional[str]]
+    min_humidity: Mapped[Optional[float]]
+    min_humidity_time: Mapped[Optional[str]]
 
     station: Mapped["StationRow"] = relationship("StationRow", back_populates="measurements")
+
+
+class IngestionJobRow(Base):
+    """
+    Background load of one uploaded file, updated by the worker running it. See ``main.jobs``.
+    """
+
+    __tableschema__ = "public"
+    __tablename__ = "ingestion_jobs"
+    id: Mapped[UUID] = mapped_column(Uuid, primary_key=True)
+    park_name: Mapped[str] = mapped_column(String(50))
+    filename: Mapped[str] = mapped_column(String)
+    status: Mapped[str] = mapped_column(String(10))
+    total_bytes: Mapped[int] = mapped_column(BigInteger)
+    processed_bytes: Mapped[int] = mapped_column(BigInteger, server_default="0")
+    rows_processed: Mapped[int] = mapped_column(BigInteger, server_default="0")
+    inserted: Mapped[Optional[int]] = mapped_column(Integer)
+    updated: Mapped[Optional[int]] = mapped_column(Integer)
+    unchanged: Mapped[Optional[int]] = mapped_column(Integer)
+    error: Mapped[Optional[str]] = mapped_column(String)
+    spool_path: Mapped[Optional[str]] = mapped_column(String)  # Removed once the job is done
+    created_at: Mapped[datetime] = mapped_column(TIMESTAMP(timezone=True), server_default=func.now())
+    started_at: Mapped[Optional[datetime]] = mapped_column(TIMESTAMP(timezone=True))
+    finished_at: Mapped[Optional[datetime]] = mapped_column(TIMESTAMP(timezone=True))
@@ -0,0 +1,155 @@
+# -*-coding:utf8-*-
+"""
+Monthly range partitions of ``energy_readings``.
+
+``energy_readings`` is partitioned by ``timestamp``, one ``energy_readings_YYYY_MM`` partition per month, so date
+filtered queries only scan the months they cover and old months are dropped by detaching their partition. Readings
+of months without a partition land in ``energy_readings_default``, which is meant to stay empty: partitions are
+created on startup for the coming ``DB_PARTITIONS_AHEAD`` months, and by the uploads for the months they load.
+"""
+
+from datetime import date, timedelta
+import os
+import re
+from typing import Iterator, List, NamedTuple, Optional
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+PARTITIONED_TABLE = "energy_readings"
+DEFAULT_PARTITION = "energy_readings_default"
+PARTITIONS_AHEAD = int(os.environ.get("DB_PARTITIONS_AHEAD", 3))
+PARTITIONS_LOCK_KEY = 20240303
+# Range bound of a partition, as rendered by pg_get_expr, e.g. FOR VALUES FROM ('2020-03-01 00:00:00') TO (...)
+PARTITION_BOUND = re.compile(r"FOR VALUES FROM \('([^']+)'\) TO \('([^']+)'\)")
+
+
+class Partition(NamedTuple):
+    name: str
+    start: date
+    end: date  # Exclusive
+
+
+def month_start(day: date) -> date:
+    return day.replace(day=1)
+
+
+def next_month(day: date) -> date:
+    return (month_start(day) + timedelta(days=32)).replace(day=1)
+
+
+def partition_of(day: date) -> Partition:
+    """
+    Partition holding the readings of the month of ``day``.
+    """
+    start = month_start(day)
+    return Partition(name=f"{PARTITIONED_TABLE}_{start:%Y_%m}", start=start, end=next_month(start))
+
+
+def gen_partitions(first: date, last: date) -> Iterator[Partition]:
+    """
+    Yield the monthly partitions covering ``first`` to ``last``, both inclusive.
+    """
+    day = month_start(first)
+    while day <= last:
+        yield partition_of(day)
+        day = next_month(day)
+
+
+def list_energy_readings_partitions(session: Session) -> List[Partition]:
+    """
+    Range partitions currently attached to ``energy_readings``, ordered by start. Their bounds are read from the
+    catalog rather than their name, so partitions attached by hand are listed too. The default partition, and
+    partitions unbounded on a side, are left out.
+    """
+    rows = session.execute(
+        text(
+            """
+            SELECT c.relname, pg_get_expr(c.relpartbound, c.oid)
+            FROM pg_inherits AS i
+            JOIN pg_class AS c ON c.oid = i.inhrelid
+            WHERE i.inhparent = CAST(:table AS regclass)
+            """
+        ),
+        {"table": PARTITIONED_TABLE},
+    ).all()
+    partitions = []
+    for name, bound in rows:
+        match = PARTITION_BOUND.match(bound or "")
+        if match:
+            start, end = (date.fromisoformat(value[:10]) for value in match.groups())
+            partitions.append(Partition(name=name, start=start, end=end))
+    return sorted(partitions, key=lambda partition: partition.start)
+
+
+def ensure_energy_readings_partitions(session: Session, first: date, last: Optional[date] = None) -> List[Partition]:
+    """
+    Create the missing monthly partitions covering ``first`` to ``last`` (inclusive, ``first`` only by default).
+
+    Readings of those months already sitting in the default partition are moved into the new partition before it is
+    attached, since Postgres refuses to attach a range the default partition has rows for. Partitions are created
+    under an advisory lock held until the transaction ends, so callers loading a lot of data should create them in
+    a short transaction of their own first.
+
+    Args:
+        session: The database session. The caller owns the transaction and must commit.
+        first: A day of the first month.
+        last: A day of the last month.
+
+    Returns:
+        The partitions created by this call.
+    """
+    wanted = list(gen_partitions(first, last or first))
+
+    def missing() -> List[Partition]:
+        existing = list_energy_readings_partitions(session)
+        return [p for p in wanted if not any(e.start <= p.start and p.end <= e.end for e in existing)]
+
+    if not missing():
+        return []
+    # Concurrent uploads of the same months would otherwise race to create the same partitions
+    session.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": PARTITIONS_LOCK_KEY})
+    created = []
+    for partition in missing():
+        session.execute(text(f"CREATE TABLE {partition.name} (LIKE {PARTITIONED_TABLE} INCLUDING DEFAULTS)"))
+        session.execute(
+            text(
+                f"""
+                WITH moved AS (
+                    DELETE FROM {DEFAULT_PARTITION}
+                    WHERE timestamp >= :start AND timestamp < :end
+                    RETURNING id, megawatts, timestamp, park_name
+                )
+                INSERT INTO {partition.name} (id, megawatts, timestamp, park_name)
+                SELECT id, megawatts, timestamp, park_name FROM moved
+                """
+            ),
+            {"start": partition.start, "end": partition.end},
+        )
+        session.execute(
+            text(
+                f"ALTER TABLE {PARTITIONED_TABLE} ATTACH PARTITION {partition.name} "
+                f"FOR VALUES FROM ('{partition.start}') TO ('{partition.end}')"
+            )
+        )
+        created.append(partition)
+    return created
+
+
+def ensure_upcoming_energy_readings_partitions(session: Session, today: Optional[date] = None) -> List[Partition]:
+    """
+    Create the partitions of the current month and of the ``PARTITIONS_AHEAD`` following ones.
+    """
+    first = today or date.today()
+    last = first
+    for _ in range(PARTITIONS_AHEAD):
+        last = next_month(last)
+    return ensure_energy_readings_partitions(session, first, last)
+
+
+def detach_energy_readings_partition(session: Session, partition: Partition) -> None:
+    """
+    Detach and drop the partition of a month. Instant whatever its size, the daily rollup is left to the caller.
+    """
+    session.execute(text(f"ALTER TABLE {PARTITIONED_TABLE} DETACH PARTITION {partition.name}"))
+    session.execute(text(f"DROP TABLE {partition.name}"))
@@ -1,15 +1,22 @@
-from datetime import date, datetime
-from typing import List, NamedTuple, Optional, Sequence
+from datetime import date, datetime, timedelta
+from typing import AsyncIterator, List, NamedTuple, Optional, Sequence, Tuple
 
 from sqlalchemy import func as F
-from sqlalchemy import select
-from sqlalchemy.engine import RowMapping
-from sqlalchemy.orm import Session
-from sqlalchemy.sql.expression import Select
-from sqlalchemy.types import DATE
+from sqlalchemy import and_, case, literal_column, select, tuple_
+from sqlalchemy.engine import Row, RowMapping
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import InstrumentedAttribute, Session
+from sqlalchemy.sql.expression import ColumnElement, Select
+from sqlalchemy.types import DATE, TIMESTAMP
 
-from main.constraints import EnergyType, ParkName, Timezone
-from main.db.models import EnergyReadingRow, ParkRow
+from main.constraints import Bucket, EnergyType, ParkName, Timezone, TzMode
+from main.db.models import EnergyReadingDailyRow, EnergyReadingRow, MeasurementRow, ParkRow, StationRow
+
+
+ROLLUP_BUCKETS = {Bucket.day, Bucket.week, Bucket.month}
+BUCKET_ORIGIN = "TIMESTAMP '2000-01-01'"
+PERCENTILES = {"p50": 0.5, "p90": 0.9, "p99": 0.99}
+MEASUREMENT_VALUES = [c for c in MeasurementRow.__table__.columns if c.name not in ("id", "station_id", "date")]
 
 
 class ParkEnergyReadingsRow(NamedTuple):
@@ -46,27 +53,52 @@ def add_park_and_energy_readings_where_condition(
     return stmt
 
 
-def select_parks(
-    session: Session, timezones: List[Timezone], energy_types: List[EnergyType], offset: int, limit: int
-) -> Sequence[RowMapping]:
+def add_park_and_daily_rollup_where_condition(
+    stmt: Select,
+    park_names: List[ParkName] = [],
+    timezones: List[Timezone] = [],
+    energy_types: List[EnergyType] = [],
+    start_date: Optional[date] = None,
+    end_date: Optional[date] = None,
+    tz_mode: TzMode = TzMode.utc,
+) -> Select:
+    """
+    Compound select statement with where conditions over the daily rollup. Date bounds are inclusive, and in the
+    calendar of ``tz_mode``.
+    """
+    stmt = add_park_and_energy_readings_where_condition(
+        stmt=stmt, park_names=park_names, timezones=timezones, energy_types=energy_types
+    )
+    stmt = stmt.where(EnergyReadingDailyRow.tz_mode == tz_mode.value)
+    if start_date:
+        stmt = stmt.where(EnergyReadingDailyRow.date >= start_date)
+    if end_date:
+        stmt = stmt.where(EnergyReadingDailyRow.date <= end_date)
+    return stmt
+
+
+def parks_stmt(timezones: List[Timezone], energy_types: List[EnergyType], offset: int, limit: int) -> Select:
     stmt = select(ParkRow.name, ParkRow.timezone, ParkRow.energy_type).offset(offset).limit(limit)
     if timezones:
         stmt = stmt.where(ParkRow.timezone.in_(timezones))
     if energy_types:
         stmt = stmt.where(ParkRow.energy_type.in_(energy_types))
-    return session.execute(stmt).mappings().all()
+    return stmt.execution_options(query_name="parks")
 
 
-def select_parks_with_energy_readings(
-    session: Session,
+def parks_with_energy_readings_stmt(
     offset: int,
-    limit: int,
+    limit: Optional[int],
     park_names: List[ParkName] = [],
     timezones: List[Timezone] = [],
     energy_types: List[EnergyType] = [],
     start_date: Optional[date] = None,
     end_date: Optional[date] = None,
-) -> Sequence[ParkEnergyReadingsRow]:
+    after: Optional[Tuple[str, datetime]] = None,
+) -> Select:
+    """
+    Readings ordered by (park_name, timestamp). ``after`` is the sort key of the last row of the previous page.
+    """
     stmt = (
         select(
             ParkRow.name, ParkRow.timezone, ParkRow.energy_type, EnergyReadingRow.megawatts, EnergyReadingRow.timestamp
@@ -74,8 +106,12 @@ def select_parks_with_energy_readings(
         .offset(offset)
         .limit(limit)
         .join(EnergyReadingRow)
+        .order_by(EnergyReadingRow.park_name, EnergyReadingRow.timestamp)
+        .execution_options(query_name="parks_with_energy_readings")
     )
-    stmt = add_park_and_energy_readings_where_condition(
+    if after:
+        stmt = stmt.where(tuple_(EnergyReadingRow.park_name, EnergyReadingRow.timestamp) > tuple_(*after))
+    return add_park_and_energy_readings_where_condition(
         stmt=stmt,
         park_names=park_names,
         timezones=timezones,
@@ -83,12 +119,30 @@ def select_parks_with_energy_readings(
         start_date=start_date,
         end_date=end_date,
     )
-    results = session.execute(stmt).mappings().all()
-    return [ParkEnergyReadingsRow(**row) for row in results]
 
 
-def select_stats_by_park_and_date(
-    session: Session,
+def bucket_expression(bucket: Bucket, timestamp: ColumnElement) -> ColumnElement:
+    """
+    Start of the bucket holding ``timestamp``.
+
+    Constants are rendered inline: with bound parameters the grouped and selected expressions would not be equal.
+    """
+    if bucket == Bucket.fifteen_minutes:
+        return F.date_bin(literal_column("interval '15 minutes'"), timestamp, literal_column(BUCKET_ORIGIN))
+    return F.date_trunc(literal_column(f"'{bucket.value}'"), timestamp)
+
+
+def local_timestamp(tz_mode: TzMode) -> ColumnElement:
+    """
+    Reading timestamps in the calendar of ``tz_mode``. Readings are stored as UTC.
+    """
+    if tz_mode == TzMode.local:
+        return F.timezone(ParkRow.timezone, F.timezone(literal_column("'UTC'"), EnergyReadingRow.timestamp))
+    return EnergyReadingRow.timestamp
+
+
+def stats_stmt(
+    key: InstrumentedAttribute,
     offset: int,
     limit: int,
     park_names: List[ParkName] = [],
@@ -96,64 +150,303 @@ def select_stats_by_park_and_date(
     energy_types: List[EnergyType] = [],
     start_date: Optional[date] = None,
     end_date: Optional[date] = None,
-) -> Sequence[RowMapping]:
-    stmt = (
-        select(
-            ParkRow.name,
-            EnergyReadingRow.timestamp.cast(DATE).label("date"),
+    after: Optional[Tuple[str, datetime]] = None,
+    tz_mode: TzMode = TzMode.utc,
+    bucket: Bucket = Bucket.day,
+    percentiles: bool = False,
+) -> Select:
+    """
+    Stats of the readings grouped by a ``ParkRow`` column and a time bucket, ordered by (key, bucket).
+
+    Day, week and month buckets merge the daily rollup: min of mins, max of maxes, sum of sums and counts, with the
+    standard deviation derived from the sum of squares. Shorter buckets and percentiles need the raw readings.
+    Date bounds are inclusive days in the calendar of ``tz_mode``, so buckets at the edges may be partial. ``after``
+    is the sort key of the last row of the previous page.
+    """
+    if bucket in ROLLUP_BUCKETS and not percentiles:
+        bucket_start = bucket_expression(bucket, F.cast(EnergyReadingDailyRow.date, TIMESTAMP))
+        count = F.sum(EnergyReadingDailyRow.count)
+        total = F.sum(EnergyReadingDailyRow.sum)
+        sum_squares = F.sum(EnergyReadingDailyRow.sum_squares)
+        variance = (sum_squares - total * total / count) / F.nullif(count - 1, 0)  # NULL for a single reading
+        stmt = select(
+            key,
+            bucket_start.label("bucket"),
+            F.min(EnergyReadingDailyRow.min).label("min"),
+            F.max(EnergyReadingDailyRow.max).label("max"),
+            total.label("sum"),
+            sum_squares.label("sum_squares"),
+            count.label("count"),
+            (total / count).label("avg"),
+            # GREATEST ignores NULLs, so single reading buckets need their own case, NULL as stddev_samp's
+            case((count > 1, F.sqrt(F.greatest(variance, 0)))).label("stddev"),
+        ).join(EnergyReadingDailyRow)
+        stmt = add_park_and_daily_rollup_where_condition(
+            stmt=stmt,
+            park_names=park_names,
+            timezones=timezones,
+            energy_types=energy_types,
+            start_date=start_date,
+            end_date=end_date,
+            tz_mode=tz_mode,
+        )
+    else:
+        timestamp = local_timestamp(tz_mode)
+        bucket_start = bucket_expression(bucket, timestamp)
+        stmt = select(
+            key,
+            bucket_start.label("bucket"),
             F.min(EnergyReadingRow.megawatts).label("min"),
             F.max(EnergyReadingRow.megawatts).label("max"),
             F.sum(EnergyReadingRow.megawatts).label("sum"),
+            F.sum(F.power(EnergyReadingRow.megawatts, 2)).label("sum_squares"),
             F.count(EnergyReadingRow.megawatts).label("count"),
+            F.avg(EnergyReadingRow.megawatts).label("avg"),
+            F.stddev_samp(EnergyReadingRow.megawatts).label("stddev"),
+        ).join(EnergyReadingRow)
+        if percentiles:
+            stmt = stmt.add_columns(
+                *(
+                    F.percentile_cont(fraction).within_group(EnergyReadingRow.megawatts).label(name)
+                    for name, fraction in PERCENTILES.items()
+                )
+            )
+        stmt = add_park_and_energy_readings_where_condition(
+            stmt=stmt, park_names=park_names, timezones=timezones, energy_types=energy_types
+        )
+        # Local days are within a day of the UTC ones, the UTC bounds keep the (park_name, timestamp) index usable
+        if start_date:
+            stmt = stmt.where(EnergyReadingRow.timestamp >= start_date - timedelta(days=1), timestamp >= start_date)
+        if end_date:
+            end = end_date + timedelta(days=1)
+            stmt = stmt.where(EnergyReadingRow.timestamp < end + timedelta(days=1), timestamp < end)
+    if after:
+        stmt = stmt.where(tuple_(key, bucket_start) > tuple_(*after))
+    stmt = stmt.add_columns(F.cast(bucket_start, DATE).label("date"))
+    return stmt.group_by(key, bucket_start).order_by(key, bucket_start).offset(offset).limit(limit)
+
+
+def park_partials_stmt(**kwargs) -> Select:
+    """
+    Mergeable per (park, bucket) aggregates with the park's timezone and energy type, see ``merge_partials``. One scan
+    serves every view built from them. See ``stats_stmt`` for the accepted filters, percentiles are not mergeable.
+    """
+    stmt = stats_stmt(ParkRow.name, **kwargs).add_columns(ParkRow.timezone, ParkRow.energy_type)
+    return stmt.execution_options(query_name="park_partials")
+
+
+def stats_by_park_and_date_stmt(**kwargs) -> Select:
+    """
+    Park stats ordered by (park_name, bucket). See ``stats_stmt`` for the accepted filters.
+    """
+    return stats_stmt(ParkRow.name, **kwargs).execution_options(query_name="stats_by_park_and_date")
+
+
+def stats_by_energy_type_and_date_stmt(**kwargs) -> Select:
+    """
+    Energy type stats ordered by (energy_type, bucket). See ``stats_stmt`` for the accepted filters.
+
+    With ``tz_mode=local`` each park contributes the buckets of its own timezone.
+    """
+    return stats_stmt(ParkRow.energy_type, **kwargs).execution_options(query_name="stats_by_energy_type_and_date")
+
+
+def stations_stmt(codes: List[str], offset: int, limit: int) -> Select:
+    stmt = (
+        select(
+            StationRow.code,
+            StationRow.name,
+            StationRow.province,
+            StationRow.latitude,
+            StationRow.longitude,
+            StationRow.altitude,
         )
+        .order_by(StationRow.code)
         .offset(offset)
         .limit(limit)
-        .join(EnergyReadingRow)
     )
-    stmt = add_park_and_energy_readings_where_condition(
-        stmt=stmt,
-        park_names=park_names,
-        timezones=timezones,
-        energy_types=energy_types,
-        start_date=start_date,
-        end_date=end_date,
-    )
-    stmt = stmt.group_by(ParkRow.name, EnergyReadingRow.timestamp.cast(DATE))
-    stmt = stmt.order_by(EnergyReadingRow.timestamp.cast(DATE))
-    return session.execute(stmt).mappings().all()
+    if codes:
+        stmt = stmt.where(StationRow.code.in_(codes))
+    return stmt.execution_options(query_name="stations")
 
 
-def select_stats_by_energy_type_and_date(
-    session: Session,
+def measurements_stmt(
     offset: int,
     limit: int,
+    station_codes: List[str] = [],
+    start_date: Optional[date] = None,
+    end_date: Optional[date] = None,
+    after: Optional[Tuple[str, date]] = None,
+) -> Select:
+    """
+    Daily measurements ordered by (station_code, date). Date bounds are inclusive. ``after`` is the sort key of the last
+    row of the previous page.
+
+    Stations are found through their code index, and the days of each through the (station_id, date) unique index.
+    """
+    stmt = (
+        select(StationRow.code.label("station_code"), MeasurementRow.date, *MEASUREMENT_VALUES)
+        .join(StationRow)
+        .order_by(StationRow.code, MeasurementRow.date)
+        .offset(offset)
+        .limit(limit)
+    )
+    if station_codes:
+        stmt = stmt.where(StationRow.code.in_(station_codes))
+    if start_date:
+        stmt = stmt.where(MeasurementRow.date >= start_date)
+    if end_date:
+        stmt = stmt.where(MeasurementRow.date <= end_date)
+    if after:
+        stmt = stmt.where(tuple_(StationRow.code, MeasurementRow.date) > tuple_(*after))
+    return stmt.execution_options(query_name="measurements")
+
+
+def park_weather_correlation_stmt(
     park_names: List[ParkName] = [],
     timezones: List[Timezone] = [],
     energy_types: List[EnergyType] = [],
     start_date: Optional[date] = None,
     end_date: Optional[date] = None,
-) -> Sequence[RowMapping]:
+    tz_mode: TzMode = TzMode.local,
+) -> Select:
+    """
+    Correlation of the daily production of each park with the weather of its station, ordered by park.
+
+    Production days come from the daily rollup and are paired with the measurements of the same day, so any range is
+    a single aggregate over one row per day and park, read through the primary key of the rollup and the
+    (station_id, date) index of the measurements. Parks without a station are left out. Days missing a measurement
+    are left out of its correlation. Date bounds are inclusive days in the calendar of ``tz_mode``.
+    """
+    production = EnergyReadingDailyRow.sum
     stmt = (
         select(
-            ParkRow.energy_type,
-            EnergyReadingRow.timestamp.cast(DATE).label("date"),
-            F.min(EnergyReadingRow.megawatts).label("min"),
-            F.max(EnergyReadingRow.megawatts).label("max"),
-            F.sum(EnergyReadingRow.megawatts).label("sum"),
-            F.count(EnergyReadingRow.megawatts).label("count"),
+            ParkRow.name,
+            StationRow.code.label("station_code"),
+            F.count(MeasurementRow.avg_temp).label("days"),
+            F.avg(production).label("avg_production"),
+            F.avg(MeasurementRow.avg_temp).label("avg_temp"),
+            F.corr(production, MeasurementRow.avg_temp).label("temperature_correlation"),
+            F.regr_slope(production, MeasurementRow.avg_temp).label("temperature_slope"),
+            F.corr(production, MeasurementRow.sunshine).label("sunshine_correlation"),
+            F.corr(production, MeasurementRow.avg_wind_speed).label("wind_speed_correlation"),
         )
-        .offset(offset)
-        .limit(limit)
-        .join(EnergyReadingRow)
+        .select_from(ParkRow)
+        .join(StationRow, StationRow.id == ParkRow.station_id)
+        .join(EnergyReadingDailyRow, EnergyReadingDailyRow.park_name == ParkRow.name)
+        .join(
+            MeasurementRow,
+            and_(MeasurementRow.station_id == ParkRow.station_id, MeasurementRow.date == EnergyReadingDailyRow.date),
+        )
+        .group_by(ParkRow.name, StationRow.code)
+        .order_by(ParkRow.name)
+        .execution_options(query_name="park_weather_correlation")
     )
-    stmt = add_park_and_energy_readings_where_condition(
+    return add_park_and_daily_rollup_where_condition(
         stmt=stmt,
         park_names=park_names,
         timezones=timezones,
         energy_types=energy_types,
         start_date=start_date,
         end_date=end_date,
+        tz_mode=tz_mode,
     )
-    stmt = stmt.group_by(ParkRow.energy_type, EnergyReadingRow.timestamp.cast(DATE))
-    stmt = stmt.order_by(EnergyReadingRow.timestamp.cast(DATE))
+
+
+def select_parks(
+    session: Session, timezones: List[Timezone], energy_types: List[EnergyType], offset: int, limit: int
+) -> Sequence[RowMapping]:
+    stmt = parks_stmt(timezones=timezones, energy_types=energy_types, offset=offset, limit=limit)
     return session.execute(stmt).mappings().all()
+
+
+async def async_select_parks(
+    session: AsyncSession, timezones: List[Timezone], energy_types: List[EnergyType], offset: int, limit: int
+) -> Sequence[RowMapping]:
+    stmt = parks_stmt(timezones=timezones, energy_types=energy_types, offset=offset, limit=limit)
+    return (await session.execute(stmt)).mappings().all()
+
+
+def select_parks_with_energy_readings(session: Session, **kwargs) -> Sequence[ParkEnergyReadingsRow]:
+    """
+    See ``parks_with_energy_readings_stmt`` for the accepted filters.
+    """
+    results = session.execute(parks_with_energy_readings_stmt(**kwargs)).mappings().all()
+    return [ParkEnergyReadingsRow(**row) for row in results]
+
+
+async def async_select_parks_with_energy_readings(session: AsyncSession, **kwargs) -> Sequence[Row]:
+    """
+    Plain rows, with the fields of ``ParkEnergyReadingsRow``. See ``parks_with_energy_readings_stmt`` for the accepted
+    filters.
+    """
+    return (await session.execute(parks_with_energy_readings_stmt(**kwargs))).all()
+
+
+async def async_stream_parks_with_energy_readings(
+    session: AsyncSession, batch_size: int, **kwargs
+) -> AsyncIterator[Sequence[Row]]:
+    """
+    Yield batches of readings through a server-side cursor, so memory is bounded by ``batch_size``.
+
+    See ``parks_with_energy_readings_stmt`` for the accepted filters.
+    """
+    stmt = parks_with_energy_readings_stmt(offset=0, limit=None, **kwargs)
+    result = await session.stream(stmt, execution_options={"yield_per": batch_size})
+    async for rows in result.partitions():
+        yield rows
+
+
+async def async_select_park_partials(session: AsyncSession, **kwargs) -> Sequence[RowMapping]:
+    """
+    See ``park_partials_stmt`` for the accepted filters.
+    """
+    return (await session.execute(park_partials_stmt(**kwargs))).mappings().all()
+
+
+def select_stats_by_park_and_date(session: Session, **kwargs) -> Sequence[RowMapping]:
+    """
+    See ``stats_by_park_and_date_stmt`` for the accepted filters.
+    """
+    return session.execute(stats_by_park_and_date_stmt(**kwargs)).mappings().all()
+
+
+async def async_select_stats_by_park_and_date(session: AsyncSession, **kwargs) -> Sequence[RowMapping]:
+    """
+    See ``stats_by_park_and_date_stmt`` for the accepted filters.
+    """
+    return (await session.execute(stats_by_park_and_date_stmt(**kwargs))).mappings().all()
+
+
+def select_stats_by_energy_type_and_date(session: Session, **kwargs) -> Sequence[RowMapping]:
+    """
+    See ``stats_by_energy_type_and_date_stmt`` for the accepted filters.
+    """
+    return session.execute(stats_by_energy_type_and_date_stmt(**kwargs)).mappings().all()
+
+
+async def async_select_stats_by_energy_type_and_date(session: AsyncSession, **kwargs) -> Sequence[RowMapping]:
+    """
+    See ``stats_by_energy_type_and_date_stmt`` for the accepted filters.
+    """
+    return (await session.execute(stats_by_energy_type_and_date_stmt(**kwargs))).mappings().all()
+
+
+async def async_select_stations(
+    session: AsyncSession, codes: List[str], offset: int, limit: int
+) -> Sequence[RowMapping]:
+    return (await session.execute(stations_stmt(codes=codes, offset=offset, limit=limit))).mappings().all()
+
+
+async def async_select_measurements(session: AsyncSession, **kwargs) -> Sequence[RowMapping]:
+    """
+    See ``measurements_stmt`` for the accepted filters.
+    """
+    return (await session.execute(measurements_stmt(**kwargs))).mappings().all()
+
+
+async def async_select_park_weather_correlation(session: AsyncSession, **kwargs) -> Sequence[RowMapping]:
+    """
+    See ``park_weather_correlation_stmt`` for the accepted filters.
+    """
+    return (await session.execute(park_weather_correlation_stmt(**kwargs))).mappings().all()
@@ -0,0 +1,205 @@
+# -*-coding:utf8-*-
+"""
+Read replicas of the primary database.
+
+Replicas are listed in ``POSTGRES_REPLICA_HOSTS`` (``host[:port]``, comma separated) and share the credentials and
+database name of the primary. The read endpoints take their sessions from a ``ReadRouter``, which hands out the
+healthy replicas in turn and falls back to the primary when none is. Writes, admin reads and the ingestion workers
+always use the primary.
+
+Replicas are checked every ``DB_REPLICA_HEALTH_INTERVAL`` seconds, and each check records the WAL position of the
+primary. The lag of a replica is the time since the newest of those positions it has replayed, so a replica falling
+behind is noticed whether or not the primary is busy. One that cannot be reached, whose WAL receiver is not
+streaming, or that lags more than ``DB_REPLICA_MAX_LAG`` seconds is skipped until a later check passes. Reading
+``pg_stat_wal_receiver`` needs the ``pg_monitor`` role.
+"""
+
+import asyncio
+from collections import deque
+from contextlib import asynccontextmanager
+from itertools import count
+import logging
+from math import inf
+import os
+from time import monotonic
+from typing import AsyncIterator, Deque, Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+from prometheus_client import Gauge
+from sqlalchemy import text
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker
+from sqlalchemy.pool import Pool
+
+logger = logging.getLogger(__name__)
+
+REPLICA_HOSTS = [host.strip() for host in os.environ.get("POSTGRES_REPLICA_HOSTS", "").split(",") if host.strip()]
+REPLICA_HEALTH_INTERVAL = float(os.environ.get("DB_REPLICA_HEALTH_INTERVAL", 5))
+REPLICA_MAX_LAG = float(os.environ.get("DB_REPLICA_MAX_LAG", 30))
+
+PRIMARY_LSN_SQL = text("SELECT pg_wal_lsn_diff(pg_current_wal_lsn(), '0/0')")
+REPLICA_STATUS_SQL = text(
+    """
+    SELECT
+        pg_is_in_recovery() AS standby,
+        pg_wal_lsn_diff(pg_last_wal_replay_lsn(), '0/0') AS replayed,
+        EXISTS (SELECT FROM pg_stat_wal_receiver WHERE status = 'streaming') AS streaming
+    """
+)
+
+# A replica is reported unhealthy while any worker skips it
+REPLICA_HEALTHY = Gauge(
+    "db_replica_healthy", "Whether a read replica receives reads.", ["replica"], multiprocess_mode="livemin"
+)
+
+
+def replica_url(url: str, host: str) -> str:
+    """
+    URL of the replica at ``host[:port]``, given the URL of the primary. The port defaults to the primary's.
+    """
+    name, _, port = host.partition(":")
+    primary = make_url(url)
+    return primary.set(host=name, port=int(port) if port else primary.port).render_as_string(hide_password=False)
+
+
+def replica_name(engine: AsyncEngine) -> str:
+    return f"{engine.url.host}:{engine.url.port or 5432}"
+
+
+class ReplicaStatus(NamedTuple):
+    standby: bool  # False for a server that is not replicating, e.g. a stand-in for a replica in tests
+    replayed: Optional[int]  # WAL position replayed, in bytes
+    streaming: bool  # Whether the WAL receiver is connected to the primary
+
+
+class ReadRouter:
+    """
+    Round-robin read sessions over the healthy ``replicas``, falling back to ``primary`` when none is healthy.
+
+    Replicas are assumed healthy until ``check`` says otherwise, and a replica whose connection fails in a request is
+    skipped until the next check.
+    """
+
+    def __init__(
+        self,
+        primary: AsyncEngine,
+        replicas: Sequence[AsyncEngine] = (),
+        max_lag: float = REPLICA_MAX_LAG,
+    ) -> None:
+        self.primary = primary
+        self.replicas = list(replicas)
+        self.max_lag = max_lag
+        self.healthy = list(self.replicas)
+        self.turns = count()
+        self.primary_lsns: Deque[Tuple[float, int]] = deque()  # (monotonic time, WAL position) of the primary
+        self.sessionmakers: Dict[AsyncEngine, async_sessionmaker[AsyncSession]] = {
+            engine: async_sessionmaker(engine, expire_on_commit=False) for engine in [primary, *self.replicas]
+        }
+        for engine in self.replicas:
+            REPLICA_HEALTHY.labels(replica_name(engine)).set(1)
+
+    def engine(self) -> AsyncEngine:
+        """
+        Engine of the next read.
+        """
+        healthy = self.healthy
+        return healthy[next(self.turns) % len(healthy)] if healthy else self.primary
+
+    def sessionmaker(self) -> async_sessionmaker[AsyncSession]:
+        return self.sessionmakers[self.engine()]
+
+    def pools(self) -> List[Pool]:
+        """
+        Pools the next reads may use.
+        """
+        return [engine.pool for engine in self.healthy] or [self.primary.pool]
+
+    def set_healthy(self, engine: AsyncEngine, healthy: bool) -> None:
+        if healthy == (engine in self.healthy):
+            return
+        if healthy:
+            logger.info("Replica %s is back, routing reads to it", replica_name(engine))
+            self.healthy = [replica for replica in self.replicas if replica in self.healthy or replica is engine]
+        else:
+            logger.warning("Replica %s is unhealthy, skipping it", replica_name(engine))
+            self.healthy = [replica for replica in self.healthy if replica is not engine]
+        REPLICA_HEALTHY.labels(replica_name(engine)).set(int(healthy))
+
+    async def primary_lsn(self) -> int:
+        async with self.primary.connect() as connection:
+            return int((await connection.execute(PRIMARY_LSN_SQL)).scalar_one())
+
+    async def status(self, engine: AsyncEngine) -> ReplicaStatus:
+        async with engine.connect() as connection:
+            row = (await connection.execute(REPLICA_STATUS_SQL)).one()
+        return ReplicaStatus(row.standby, None if row.replayed is None else int(row.replayed), row.streaming)
+
+    def lag(self, status: ReplicaStatus, now: float) -> float:
+        """
+        Seconds since the primary was at the newest recorded position the replica has replayed. Infinite when its
+        WAL receiver is down, since it won't replay anything new.
+        """
+        if not status.standby:
+            return 0.0
+        if not status.streaming or status.replayed is None:
+            return inf
+        if not self.primary_lsns:  # The primary could not be reached yet
+            return 0.0
+        caught_up = [at for at, lsn in self.primary_lsns if lsn <= status.replayed]
+        return now - (caught_up[-1] if caught_up else self.primary_lsns[0][0])
+
+    async def check(self, timeout: float = REPLICA_HEALTH_INTERVAL) -> None:
+        """
+        Record the WAL position of the primary, then check every replica at once, each within ``timeout`` seconds.
+        """
+        now = monotonic()
+        try:
+            self.primary_lsns.append((now, await asyncio.wait_for(self.primary_lsn(), timeout)))
+        except Exception as exc:
+            logger.warning("Could not read the WAL position of the primary: %r", exc)
+        # Older positions only tell that a replica is more than max_lag behind, which the oldest kept one already does
+        while len(self.primary_lsns) > 1 and self.primary_lsns[1][0] <= now - self.max_lag:
+            self.primary_lsns.popleft()
+        results = await asyncio.gather(
+            *(asyncio.wait_for(self.status(engine), timeout) for engine in self.replicas), return_exceptions=True
+        )
+        for engine, status in zip(self.replicas, results):
+            if isinstance(status, BaseException):
+                logger.debug("Health check of replica %s failed: %r", replica_name(engine), status)
+                self.set_healthy(engine, False)
+            else:
+                self.set_healthy(engine, self.lag(status, now) <= self.max_lag)
+
+    @asynccontextmanager
+    async def monitor(self, interval: float = REPLICA_HEALTH_INTERVAL) -> AsyncIterator[None]:
+        """
+        Check the replicas every ``interval`` seconds while in the context.
+        """
+        if not self.replicas:
+            yield
+            return
+
+        async def run() -> None:
+            while True:
+                await self.check(timeout=interval)
+                await asyncio.sleep(interval)
+
+        task = asyncio.create_task(run())
+        try:
+            yield
+        finally:
+            task.cancel()
+
+    @asynccontextmanager
+    async def session(self) -> AsyncIterator[AsyncSession]:
+        """
+        Read session on the next engine. A replica whose connection fails is skipped until the next check.
+        """
+        engine = self.engine()
+        async with self.sessionmakers[engine]() as session:
+            try:
+                yield session
+            except (OSError, DBAPIError) as exc:
+                if engine is not self.primary and (isinstance(exc, OSError) or exc.connection_invalidated):
+                    self.set_healthy(engine, False)
+                raise
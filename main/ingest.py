@@ -0,0 +1,194 @@
+# -*-coding:utf8-*-
+"""
+Batch ingestion of energy readings files, parsed and loaded in parallel by a pool of worker processes.
+
+Each file is parsed by a worker process and streamed over that worker's own database connection, so a backfill of
+every park keeps ``INGEST_WORKERS`` cores (all of them by default) and as many connections busy. Files of the same
+park are staged in parallel but merged one after the other, see ``merge_staged_energy_readings``.
+"""
+
+import asyncio
+from concurrent.futures import Executor, ProcessPoolExecutor
+from csv import DictReader
+from datetime import date
+from functools import lru_cache
+import multiprocessing
+import os
+from pathlib import PurePath
+import shutil
+from time import perf_counter
+from typing import Any, BinaryIO, Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Sequence
+import zipfile
+
+from sqlalchemy import create_engine
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import NullPool
+from starlette.requests import Request
+
+from main.constraints import ParkName
+from main.db.bulk import (
+    UpsertCounts,
+    merge_staged_energy_readings,
+    stage_energy_readings,
+    staged_energy_readings_date_range,
+)
+from main.db.partitions import ensure_energy_readings_partitions
+from main.utils import gen_upload_file_as_string
+
+# Not split between the server workers: the processes are only started by uploads, which are seldom concurrent
+INGEST_WORKERS = int(os.environ.get("INGEST_WORKERS", 0)) or os.cpu_count() or 1
+PROGRESS_EVERY_ROWS = 10_000
+
+# Called with the rows and bytes read so far
+ProgressCallback = Callable[[int, int], None]
+
+
+class IngestFile(NamedTuple):
+    filename: str
+    path: str
+    park_name: Optional[str]  # None when the filename does not name a park
+
+
+class IngestResult(NamedTuple):
+    filename: str
+    park_name: Optional[str]
+    counts: Optional[UpsertCounts] = None
+    first: Optional[date] = None
+    last: Optional[date] = None
+    seconds: float = 0.0
+    error: Optional[str] = None
+
+    def as_dict(self) -> Dict[str, Any]:
+        n = sum(self.counts) if self.counts else 0
+        return {
+            "filename": self.filename,
+            "park_name": self.park_name,
+            "status": "error" if self.error else "ok",
+            **(self.counts._asdict() if self.counts else {}),
+            "rows_per_second": round(n / self.seconds, 2) if self.seconds else 0.0,
+            "error": self.error,
+        }
+
+
+def park_name_of(filename: str) -> Optional[str]:
+    """
+    Park named by a file, e.g. ``netterden.csv`` or ``readings/Netterden.csv`` for Netterden.
+    """
+    stem = PurePath(filename).stem.lower()
+    return next((park.value for park in ParkName if park.value.lower() == stem), None)
+
+
+def spool_upload(filename: str, file: BinaryIO, directory: str) -> List[IngestFile]:
+    """
+    Write an uploaded CSV file to ``directory``, or every file of an uploaded zip archive.
+
+    Worker processes cannot share the upload's file object, so files are handed over by path.
+    """
+    files = []
+    if zipfile.is_zipfile(file):
+        file.seek(0)
+        with zipfile.ZipFile(file) as archive:
+            for member in archive.infolist():
+                name = PurePath(member.filename)
+                if member.is_dir() or name.name.startswith(".") or "__MACOSX" in name.parts:
+                    continue
+                path = os.path.join(directory, f"{len(os.listdir(directory))}-{name.name}")
+                with archive.open(member) as source, open(path, "wb") as target:
+                    shutil.copyfileobj(source, target)
+                files.append(IngestFile(member.filename, path, park_name_of(member.filename)))
+        return files
+    file.seek(0)
+    path = os.path.join(directory, f"{len(os.listdir(directory))}-{PurePath(filename).name}")
+    with open(path, "wb") as target:
+        shutil.copyfileobj(file, target)
+    return [IngestFile(filename, path, park_name_of(filename))]
+
+
+def describe_error(exc: Exception) -> str:
+    if isinstance(exc, KeyError):
+        return "Invalid row format. Upload aborted."
+    if isinstance(exc, DBAPIError):
+        return f"{type(exc).__name__}: {exc.orig}".strip()
+    return f"{type(exc).__name__}: {exc}"
+
+
+def gen_with_progress(
+    rows: Iterable[Dict[str, str]], file: BinaryIO, on_progress: ProgressCallback, every: int = PROGRESS_EVERY_ROWS
+) -> Iterator[Dict[str, str]]:
+    """
+    Yield rows, reporting every ``every`` rows and at the end how many rows and bytes of ``file`` were read.
+    """
+    n = 0
+    for n, row in enumerate(rows, 1):
+        yield row
+        if n % every == 0:
+            on_progress(n, file.tell())
+    on_progress(n, file.tell())
+
+
+@lru_cache(maxsize=None)
+def worker_engine(db_url: str) -> Engine:
+    """
+    Engine of a worker process, kept for the life of the process. Connections are not pooled across files.
+    """
+    return create_engine(db_url, future=True, poolclass=NullPool)
+
+
+def load_energy_readings_file(
+    db_url: str, file: IngestFile, on_progress: Optional[ProgressCallback] = None
+) -> IngestResult:
+    """
+    Parse and load one file of readings, in a worker process. Errors are reported in the result, not raised.
+
+    The monthly partitions of the file are created in a short transaction of their own, so loads of other files are
+    not held up by the partitions lock while this one merges.
+    """
+    start = perf_counter()
+    engine = worker_engine(db_url)
+    assert file.park_name is not None
+    try:
+        with Session(engine, future=True) as session, open(file.path, "rb") as f:
+            rows: Iterable[Dict[str, str]] = DictReader(gen_upload_file_as_string(f), delimiter=",")
+            if on_progress:
+                rows = gen_with_progress(rows, f, on_progress)
+            total = stage_energy_readings(session, file.park_name, rows)
+            first, last = staged_energy_readings_date_range(session)
+            if first and last:
+                with Session(engine, future=True) as partitions_session:
+                    ensure_energy_readings_partitions(partitions_session, first, last)
+                    partitions_session.commit()
+            counts = merge_staged_energy_readings(session, file.park_name, total)
+            session.commit()
+    except Exception as exc:
+        return IngestResult(file.filename, file.park_name, seconds=perf_counter() - start, error=describe_error(exc))
+    return IngestResult(file.filename, file.park_name, counts, first, last, perf_counter() - start)
+
+
+async def ingest_energy_readings_files(pool: Executor, db_url: str, files: Sequence[IngestFile]) -> List[IngestResult]:
+    """
+    Load files in parallel on ``pool``, returning one result per file in the same order.
+    """
+    loop = asyncio.get_running_loop()
+
+    async def ingest(file: IngestFile) -> IngestResult:
+        if file.park_name is None:
+            return IngestResult(file.filename, None, error="The filename does not name a known park.")
+        return await loop.run_in_executor(pool, load_energy_readings_file, db_url, file)
+
+    return list(await asyncio.gather(*(ingest(file) for file in files)))
+
+
+def create_ingest_pool(max_workers: int = INGEST_WORKERS) -> ProcessPoolExecutor:
+    """
+    Process pool for the ingestion workers. Processes are spawned rather than forked from the running server.
+    """
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn"))
+
+
+def get_ingest_pool(request: Request) -> Executor:
+    """
+    Return the ingestion process pool of the application.
+    """
+    return request.app.state.ingest_pool
@@ -0,0 +1,172 @@
+# -*-coding:utf8-*-
+"""
+Asynchronous ingestion jobs.
+
+Uploads are spooled to disk and queued on the ingestion process pool as one job per file, and the request returns
+with their ids at once. The event loop only copies the upload to disk, parsing and database writes happen in the
+worker processes. Workers record their progress in the ``ingestion_jobs`` table, so any API process can report it.
+
+Jobs only live in the process pool of the server that accepted them: the ones a restart interrupts are marked failed
+on startup, see ``fail_interrupted_jobs``.
+"""
+
+import asyncio
+from concurrent.futures import Executor, Future
+from datetime import datetime, timezone
+import os
+from time import monotonic
+from typing import Any, Dict, Optional
+from uuid import UUID
+
+from sqlalchemy import func, update
+from sqlalchemy.engine import Connection, Engine
+
+from main.cache import CacheBackend
+from main.constraints import JobStatus
+from main.db.models import IngestionJobRow
+from main.ingest import IngestFile, IngestResult, load_energy_readings_file, worker_engine
+
+JOB_PROGRESS_INTERVAL = float(os.environ.get("JOB_PROGRESS_INTERVAL", 1.0))
+SPOOL_DIR = os.environ.get("INGEST_SPOOL_DIR") or None  # The system temporary directory by default
+INTERRUPTED_JOB_ERROR = "Interrupted by a server restart"
+
+
+def update_job(engine: Engine, job_id: UUID, **values: Any) -> None:
+    with engine.begin() as connection:
+        connection.execute(update(IngestionJobRow).where(IngestionJobRow.id == job_id).values(**values))
+
+
+class ProgressReporter:
+    """
+    Record the progress of a job, at most once every ``interval`` seconds.
+    """
+
+    def __init__(self, engine: Engine, job_id: UUID, interval: float = JOB_PROGRESS_INTERVAL) -> None:
+        self.engine = engine
+        self.job_id = job_id
+        self.interval = interval
+        self.reported_at = monotonic()
+
+    def __call__(self, rows: int, processed_bytes: int) -> None:
+        if monotonic() - self.reported_at < self.interval:
+            return
+        update_job(self.engine, self.job_id, rows_processed=rows, processed_bytes=processed_bytes)
+        self.reported_at = monotonic()
+
+
+def run_energy_readings_job(db_url: str, job_id: UUID, file: IngestFile) -> IngestResult:
+    """
+    Load the file of a job, in a worker process, recording its progress and outcome. The spooled file is removed.
+    """
+    engine = worker_engine(db_url)
+    try:
+        update_job(engine, job_id, status=JobStatus.running.value, started_at=func.now())
+        result = load_energy_readings_file(db_url, file, on_progress=ProgressReporter(engine, job_id))
+        if result.error:
+            update_job(engine, job_id, status=JobStatus.failed.value, error=result.error, finished_at=func.now())
+        else:
+            assert result.counts is not None
+            update_job(
+                engine,
+                job_id,
+                status=JobStatus.succeeded.value,
+                rows_processed=sum(result.counts),
+                processed_bytes=IngestionJobRow.total_bytes,
+                finished_at=func.now(),
+                **result.counts._asdict(),
+            )
+        return result
+    finally:
+        remove_spooled_file(file.path)
+
+
+def remove_spooled_file(path: str) -> None:
+    try:
+        os.remove(path)
+        os.rmdir(os.path.dirname(path))  # Last file of the upload
+    except OSError:
+        pass
+
+
+def fail_interrupted_jobs(connection: Connection) -> int:
+    """
+    Mark the jobs left queued or running by a previous run of the server failed, and remove their spooled files.
+    Meant to run once on startup, before any job is submitted.
+
+    Args:
+        connection: A connection with an open transaction, e.g. from ``engine.begin()``.
+
+    Returns:
+        The number of jobs marked failed.
+    """
+    paths = connection.execute(
+        update(IngestionJobRow)
+        .where(IngestionJobRow.status.in_([JobStatus.queued.value, JobStatus.running.value]))
+        .values(status=JobStatus.failed.value, error=INTERRUPTED_JOB_ERROR, finished_at=func.now())
+        .returning(IngestionJobRow.spool_path)
+    ).scalars()
+    count = 0
+    for path in paths:
+        if path:
+            remove_spooled_file(path)
+        count += 1
+    return count
+
+
+def submit_energy_readings_job(
+    pool: Executor, engine: Engine, cache: CacheBackend, job_id: UUID, file: IngestFile
+) -> Future:
+    """
+    Queue a job on ``pool`` without waiting for it. The job outlives the request, and the response cache is
+    invalidated for the park and days of the file once it is done.
+    """
+    loop = asyncio.get_running_loop()
+    future = pool.submit(run_energy_readings_job, engine.url.render_as_string(hide_password=False), job_id, file)
+
+    def done(future: Future) -> None:
+        if future.cancelled():
+            return update_job(engine, job_id, status=JobStatus.failed.value, error="Cancelled", finished_at=func.now())
+        if exc := future.exception():  # The worker died, e.g. BrokenProcessPool
+            error = f"{type(exc).__name__}: {exc}"
+            return update_job(engine, job_id, status=JobStatus.failed.value, error=error, finished_at=func.now())
+        result = future.result()
+        if result.counts and (result.counts.inserted or result.counts.updated):
+            invalidate = cache.invalidate(result.park_name, result.first, result.last)
+            try:
+                asyncio.run_coroutine_threadsafe(invalidate, loop)
+            except RuntimeError:  # The loop is gone, entries expire after CACHE_TTL
+                invalidate.close()
+
+    future.add_done_callback(done)
+    return future
+
+
+def job_status(job: IngestionJobRow, now: Optional[datetime] = None) -> Dict[str, Any]:
+    """
+    Progress of a job: rows processed, throughput and, while it runs, the estimated seconds left from the bytes read.
+    """
+    now = now or datetime.now(timezone.utc)
+    elapsed = ((job.finished_at or now) - job.started_at).total_seconds() if job.started_at else 0.0
+    progress = min(job.processed_bytes / job.total_bytes, 1.0) if job.total_bytes else 0.0
+    eta = None
+    if job.status == JobStatus.running.value and 0 < progress:
+        eta = round(elapsed * (1 - progress) / progress, 1)
+    return {
+        "id": str(job.id),
+        "park_name": job.park_name,
+        "filename": job.filename,
+        "status": job.status,
+        "rows_processed": job.rows_processed,
+        "bytes_processed": job.processed_bytes,
+        "total_bytes": job.total_bytes,
+        "progress": round(progress, 4),
+        "rows_per_second": round(job.rows_processed / elapsed, 2) if elapsed else 0.0,
+        "eta_seconds": eta,
+        "inserted": job.inserted,
+        "updated": job.updated,
+        "unchanged": job.unchanged,
+        "error": job.error,
+        "created_at": job.created_at.isoformat(),
+        "started_at": job.started_at.isoformat() if job.started_at else None,
+        "finished_at": job.finished_at.isoformat() if job.finished_at else None,
+    }
@@ -0,0 +1,250 @@
+# -*-coding:utf8-*-
+"""
+Prometheus metrics of the hot path, next to the per path request latency of ``PrometheusMiddleware``.
+
+- ``db_query_duration_seconds`` and ``db_query_rows``: time and rows of every statement, by route and query name.
+- ``db_pool_checkout_wait_seconds``: time spent waiting for a pooled connection, by route and pool.
+- ``request_stage_duration_seconds``: time spent by the core routers querying and serializing, by route and stage.
+- ``db_pool_*`` gauges: occupancy, overflow, queued checkouts and recent wait and hold times of the pools, updated on
+  every checkout and return.
+
+Under gunicorn the metrics of the workers are shared through ``PROMETHEUS_MULTIPROC_DIR`` (see ``main.server``), so
+gauges declare how the values of the live workers are combined.
+
+Queries are named with the ``query_name`` execution option, or after their verb and first table. Statements slower
+than ``DB_SLOW_QUERY_MS`` are logged, with their ``EXPLAIN ANALYZE`` plan if ``DB_SLOW_QUERY_EXPLAIN`` is set.
+"""
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import lru_cache
+import logging
+import os
+import re
+import threading
+from time import perf_counter
+from typing import Any, Iterator, Optional
+from weakref import WeakSet
+
+from prometheus_client import Gauge, Histogram
+from sqlalchemy import event
+from sqlalchemy.engine import Connection, Engine, ExecutionContext
+from sqlalchemy.pool import AsyncAdaptedQueuePool, ConnectionPoolEntry, PoolProxiedConnection, QueuePool
+from starlette.requests import Request
+
+logger = logging.getLogger(__name__)
+
+SLOW_QUERY_SECONDS = float(os.environ.get("DB_SLOW_QUERY_MS", 0)) / 1000  # 0 disables the slow query log
+SLOW_QUERY_EXPLAIN = os.environ.get("DB_SLOW_QUERY_EXPLAIN", "false").lower() in ("1", "true", "yes")
+FAST_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+ROWS_BUCKETS = (0, 1, 10, 100, 1_000, 10_000, 100_000, 1_000_000)
+EWMA_WEIGHT = 0.2  # Weight of the latest observation in the moving averages of pool wait and hold times
+
+DB_QUERY_SECONDS = Histogram(
+    "db_query_duration_seconds", "Statement execution time.", ["route", "query"], buckets=FAST_BUCKETS
+)
+DB_QUERY_ROWS = Histogram(
+    "db_query_rows", "Rows returned or affected by a statement.", ["route", "query"], buckets=ROWS_BUCKETS
+)
+DB_POOL_WAIT_SECONDS = Histogram(
+    "db_pool_checkout_wait_seconds", "Time waiting for a pooled connection.", ["route", "pool"], buckets=FAST_BUCKETS
+)
+STAGE_SECONDS = Histogram(
+    "request_stage_duration_seconds", "Time spent in a stage of a request.", ["route", "stage"], buckets=FAST_BUCKETS
+)
+# Name -> (documentation, how the values of the pools of a name and of the workers are combined)
+POOL_GAUGES = {
+    "size": ("Connections kept open by the pool.", "livesum"),
+    "checked_out": ("Connections in use.", "livesum"),
+    "overflow": ("Connections open on top of the pool size.", "livesum"),
+    "waiting": ("Checkouts waiting for a connection.", "livesum"),
+    "wait_seconds": ("Moving average of the checkout wait.", "livemax"),
+    "hold_seconds": ("Moving average of the time a connection is held.", "livemax"),
+    "estimated_wait_seconds": ("Expected wait of the next checkout.", "livemax"),
+}
+DB_POOL = {
+    name: Gauge(f"db_pool_{name}", documentation, ["pool"], multiprocess_mode=mode)
+    for name, (documentation, mode) in POOL_GAUGES.items()
+}
+
+# Route template of the request being served, e.g. /stats/parks. Empty outside requests (startup, workers).
+ROUTE: ContextVar[str] = ContextVar("route", default="")
+
+
+async def track_route(request: Request) -> None:
+    """
+    App dependency recording the route of the request, for the labels of the metrics it produces.
+    """
+    route = request.scope.get("route")
+    ROUTE.set(getattr(route, "path", request.url.path))
+
+
+@contextmanager
+def span(stage: str) -> Iterator[None]:
+    """
+    Time a stage of the current request, e.g. ``query`` or ``serialize``.
+    """
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.labels(ROUTE.get(), stage).observe(perf_counter() - start)
+
+
+@lru_cache(maxsize=1024)
+def query_name_of(statement: str) -> str:
+    """
+    Name of a statement without a ``query_name``, e.g. ``select energy_readings`` or ``insert measurements``.
+    """
+    verb = re.match(r"\s*(\w+)", statement)
+    table = re.search(r"\b(?:FROM|INTO|UPDATE|TABLE|COPY)\s+([\w.]+)", statement, re.IGNORECASE)
+    return " ".join(match.group(1).lower() for match in (verb, table) if match) or "unknown"
+
+
+def before_cursor_execute(
+    conn: Connection, cursor: Any, statement: str, parameters: Any, context: ExecutionContext, executemany: bool
+) -> None:
+    context.query_start = perf_counter()  # type:ignore[attr-defined]
+
+
+def after_cursor_execute(
+    conn: Connection, cursor: Any, statement: str, parameters: Any, context: ExecutionContext, executemany: bool
+) -> None:
+    seconds = perf_counter() - context.query_start  # type:ignore[attr-defined]
+    route = ROUTE.get()
+    name = context.execution_options.get("query_name") or query_name_of(statement)
+    DB_QUERY_SECONDS.labels(route, name).observe(seconds)
+    if cursor.rowcount is not None and cursor.rowcount >= 0:
+        DB_QUERY_ROWS.labels(route, name).observe(cursor.rowcount)
+    if SLOW_QUERY_SECONDS and seconds >= SLOW_QUERY_SECONDS:
+        plan = None
+        if SLOW_QUERY_EXPLAIN and not executemany and statement.lstrip()[:6].upper() == "SELECT":
+            plan = explain_analyze(conn, statement, parameters)
+        logger.warning(
+            "Slow query %s on %s: %.1f ms\n%s%s",
+            name,
+            route or "-",
+            seconds * 1000,
+            statement,
+            f"\n{plan}" if plan else "",
+        )
+
+
+def explain_analyze(conn: Connection, statement: str, parameters: Any) -> Optional[str]:
+    """
+    ``EXPLAIN ANALYZE`` plan of a statement, run again on the same connection inside a savepoint, so a failure does
+    not abort the transaction of the request. Only meant for read statements, as the statement is executed again.
+    """
+    cursor = conn.connection.dbapi_connection.cursor()
+    try:
+        cursor.execute("SAVEPOINT slow_query_explain")
+        try:
+            cursor.execute(f"EXPLAIN ANALYZE {statement}", parameters)
+            return "\n".join(row[0] for row in cursor.fetchall())
+        finally:
+            cursor.execute("ROLLBACK TO SAVEPOINT slow_query_explain")
+    except Exception as exc:
+        return f"EXPLAIN ANALYZE failed: {exc}"
+    finally:
+        cursor.close()
+
+
+def instrument_engine(engine: Engine) -> None:
+    """
+    Record the metrics of every statement run by ``engine``. Pass ``AsyncEngine.sync_engine`` for async engines.
+    """
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", after_cursor_execute)
+
+
+def ewma(average: float, value: float) -> float:
+    return average + EWMA_WEIGHT * (value - average)
+
+
+class InstrumentedQueuePool(QueuePool):
+    """
+    ``QueuePool`` recording how long checkouts wait for a connection and how long connections are held, from which
+    ``estimated_wait`` predicts the wait of the next checkout.
+    """
+
+    pool_name = "sync"
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self.stats_lock = threading.Lock()
+        self.waiting = 0  # Checkouts in progress
+        self.wait_seconds = 0.0
+        self.hold_seconds = 0.0
+        POOLS.add(self)
+
+    def connect(self) -> PoolProxiedConnection:
+        with self.stats_lock:
+            self.waiting += 1
+        start = perf_counter()
+        try:
+            connection = super().connect()
+        finally:
+            seconds = perf_counter() - start
+            with self.stats_lock:
+                self.waiting -= 1
+                self.wait_seconds = ewma(self.wait_seconds, seconds)
+            DB_POOL_WAIT_SECONDS.labels(ROUTE.get(), self.pool_name).observe(seconds)
+            report_pools(self.pool_name)
+        connection.info["checked_out_at"] = perf_counter()
+        return connection
+
+    def _do_return_conn(self, record: ConnectionPoolEntry) -> None:
+        checked_out_at = record.info.pop("checked_out_at", None)
+        if checked_out_at is not None:
+            with self.stats_lock:
+                self.hold_seconds = ewma(self.hold_seconds, perf_counter() - checked_out_at)
+        super()._do_return_conn(record)
+        report_pools(self.pool_name)
+
+    def recreate(self) -> QueuePool:
+        pool = super().recreate()
+        pool.pool_name = self.pool_name  # type:ignore[attr-defined]
+        return pool
+
+    def capacity(self) -> int:
+        """
+        Connections the pool may open, -1 if unbounded.
+        """
+        return self.size() + self._max_overflow if self._max_overflow > -1 else -1
+
+    def estimated_wait(self) -> float:
+        """
+        Seconds the next checkout is expected to wait: none while a connection is free or may be opened, otherwise
+        its place in the queue times the average hold time, spread over the connections.
+        """
+        capacity = self.capacity()
+        demand = self.checkedout() + self.waiting
+        if capacity <= 0 or demand < capacity:
+            return 0.0
+        return max((demand - capacity + 1) * self.hold_seconds / capacity, self.wait_seconds)
+
+
+class InstrumentedAsyncAdaptedQueuePool(InstrumentedQueuePool, AsyncAdaptedQueuePool):
+    pool_name = "async"
+
+
+POOLS: "WeakSet[InstrumentedQueuePool]" = WeakSet()  # Disposed engines replace their pool, the old one is dropped
+
+
+def report_pools(pool_name: str) -> None:
+    """
+    Set the gauges of the pools named ``pool_name``. Pools of the same name (e.g. engines made by tests) are added up.
+    """
+    values = dict.fromkeys(POOL_GAUGES, 0.0)
+    for pool in list(POOLS):
+        if pool.pool_name != pool_name:
+            continue
+        values["size"] += pool.size()
+        values["checked_out"] += pool.checkedout()
+        values["overflow"] += max(pool.overflow(), 0)
+        values["waiting"] += pool.waiting
+        values["wait_seconds"] = max(values["wait_seconds"], pool.wait_seconds)
+        values["hold_seconds"] = max(values["hold_seconds"], pool.hold_seconds)
+        values["estimated_wait_seconds"] = max(values["estimated_wait_seconds"], pool.estimated_wait())
+    for name, value in values.items():
+        DB_POOL[name].labels(pool_name).set(value)
@@ -1,6 +1,54 @@
-from urllib.parse import parse_qsl, urlencode
+# -*-coding:utf8-*-
+"""
+Pure ASGI middlewares of the request pipeline.
 
-from starlette.types import ASGIApp, Receive, Scope, Send
+They only touch the ``scope`` and the response messages, so a request that needs no work costs a couple of byte
+comparisons: no ``Request`` object, no header parsing beyond the one header they look for.
+"""
+
+from functools import lru_cache
+import gzip
+from math import ceil
+import os
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from prometheus_client import Counter
+from starlette.responses import JSONResponse
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from main.metrics import InstrumentedQueuePool
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+COMPRESSION_MIN_SIZE = int(os.environ.get("COMPRESSION_MIN_SIZE", 1024))
+# Prometheus scrapes are tiny and frequent, exports are streamed and compressed by the clients' choice of format
+COMPRESSION_EXCLUDED_PATHS = ("/metrics", "/parks/energy-readings/export")
+COMPRESSIBLE_TYPES = {b"application/json", b"application/x-ndjson", b"application/vnd.apache.arrow.stream"}
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 4
+ZSTD_LEVEL = 3
+ADMISSION_WAIT_BUDGET = float(os.environ.get("DB_ADMISSION_WAIT_BUDGET_MS", 0)) / 1000  # 0 disables shedding
+# Writes and job status polls go through the sync pool, the others do not query the database
+ADMISSION_EXCLUDED_PATHS = ("/admin", "/metrics", "/docs", "/redoc", "/openapi.json")
+
+ADMISSION_REJECTED = Counter("db_admission_rejected_total", "Read requests shed while the pool is saturated.", ["pool"])
+
+
+def filter_empty_query_params(query_string: bytes) -> bytes:
+    """
+    Drop ``key=`` and bare ``key`` parameters, as ``parse_qsl(keep_blank_values=False)`` does, without decoding and
+    re-encoding the others. The query string is returned as is when it has none.
+    """
+    pairs = query_string.split(b"&")
+    kept = [pair for pair in pairs if pair.partition(b"=")[2]]
+    return query_string if len(kept) == len(pairs) else b"&".join(kept)
 
 
 class FilterEmptyQueryParamsMiddleware:
@@ -9,9 +57,170 @@ class FilterEmptyQueryParamsMiddleware:
 
     async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
         if scope and scope.get("query_string"):
-            filtered_query_params = parse_qsl(
-                qs=scope["query_string"].decode("latin-1"),
-                keep_blank_values=False,
-            )
-            scope["query_string"] = urlencode(filtered_query_params).encode("latin-1")
+            scope["query_string"] = filter_empty_query_params(scope["query_string"])
         await self.app(scope, receive, send)
+
+
+def gen_compressors() -> Dict[str, Callable[[bytes], bytes]]:
+    """
+    Available encodings, most preferred first.
+    """
+    compressors: Dict[str, Callable[[bytes], bytes]] = {}
+    if zstandard is not None:
+        compressors["zstd"] = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress
+    if brotli is not None:
+        compressors["br"] = lambda body: brotli.compress(body, quality=BROTLI_QUALITY)
+    compressors["gzip"] = lambda body: gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+    return compressors
+
+
+COMPRESSORS = gen_compressors()
+
+
+@lru_cache(maxsize=256)
+def negotiate_encoding(accept_encoding: bytes) -> Optional[str]:
+    """
+    Encoding of the highest quality in an ``Accept-Encoding`` header, our preference breaking ties. Clients send a
+    handful of distinct headers, so results are cached.
+    """
+    qualities = {}
+    for item in accept_encoding.decode("latin-1").split(","):
+        name, _, params = item.partition(";")
+        quality = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[name.strip().lower()] = quality
+    candidates = [(qualities[name], -i, name) for i, name in enumerate(COMPRESSORS) if qualities.get(name, 0) > 0]
+    return max(candidates)[2] if candidates else None
+
+
+def is_compressible(headers: List[Tuple[bytes, bytes]]) -> bool:
+    """
+    Whether response headers announce an uncompressed body of a compressible content type.
+    """
+    compressible = False
+    for name, value in headers:
+        if name == b"content-encoding":
+            return False
+        if name == b"content-type":
+            media_type = value.split(b";", 1)[0].strip().lower()
+            compressible = media_type.startswith(b"text/") or media_type in COMPRESSIBLE_TYPES
+    return compressible
+
+
+def weaken_etag(headers: List[Tuple[bytes, bytes]]) -> List[Tuple[bytes, bytes]]:
+    """
+    Headers with a weak ``ETag``: the validator of the identity body must not be reused as is for an encoded one.
+    """
+    return [(name, value if name != b"etag" or value.startswith(b"W/") else b"W/" + value) for name, value in headers]
+
+
+class CompressionMiddleware:
+    """
+    Compress responses with zstd, brotli or gzip, as negotiated with ``Accept-Encoding``.
+
+    Only responses sent in one body message, of a compressible content type and of at least ``minimum_size`` bytes
+    are compressed. Streamed responses are sent as produced, and ``excluded_paths`` skip the middleware altogether.
+    When an encoding is negotiated, ``ETag``s are made weak, whether the body is compressed or not: a ``304`` cannot
+    tell whether the body it stands for would have been.
+    zstd and brotli need the optional ``zstandard`` and ``brotli`` packages (``poetry install -E compression``).
+    """
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        minimum_size: int = COMPRESSION_MIN_SIZE,
+        excluded_paths: Tuple[str, ...] = COMPRESSION_EXCLUDED_PATHS,
+    ) -> None:
+        self.app = app
+        self.minimum_size = minimum_size
+        self.excluded_paths = excluded_paths
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or scope["path"].startswith(self.excluded_paths):
+            await self.app(scope, receive, send)
+            return
+        encoding = next((negotiate_encoding(v) for k, v in scope["headers"] if k == b"accept-encoding"), None)
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start: Optional[Message] = None
+        passthrough = False
+
+        async def send_compressed(message: Message) -> None:
+            nonlocal start, passthrough
+            if message["type"] == "http.response.start":
+                start = {**message, "headers": weaken_etag(message.get("headers", []))}
+                return
+            if passthrough or start is None or message["type"] != "http.response.body":
+                await send(message)
+                return
+            body = message.get("body", b"")
+            if message.get("more_body") or len(body) < self.minimum_size or not is_compressible(start["headers"]):
+                passthrough = True
+                await send(start)
+                await send(message)
+                return
+            compressed = COMPRESSORS[encoding](body)
+            headers = [(k, v) for k, v in start["headers"] if k != b"content-length"]
+            headers += [
+                (b"content-encoding", encoding.encode()),
+                (b"content-length", str(len(compressed)).encode()),
+                (b"vary", b"Accept-Encoding"),
+            ]
+            await send({**start, "headers": headers})
+            await send({"type": "http.response.body", "body": compressed})
+
+        await self.app(scope, receive, send_compressed)
+
+
+class AdmissionControlMiddleware:
+    """
+    Shed read requests with a fast ``503 Service Unavailable`` while the pools returned by ``get_pools`` are so
+    saturated that their checkout is expected to wait more than ``wait_budget`` seconds in the least busy one.
+    ``Retry-After`` is set to that wait.
+
+    Requests within the budget queue in the pool as usual, so latency grows up to the budget and the excess load is
+    turned away instead of piling up until every request times out. Place it inside the ``ResponseCacheMiddleware``,
+    cache hits need no connection.
+    """
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        get_pools: Callable[[], Iterable[object]],
+        wait_budget: float = ADMISSION_WAIT_BUDGET,
+        excluded_paths: Tuple[str, ...] = ADMISSION_EXCLUDED_PATHS,
+    ) -> None:
+        self.app = app
+        self.get_pools = get_pools
+        self.wait_budget = wait_budget
+        self.excluded_paths = excluded_paths
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if (
+            self.wait_budget <= 0
+            or scope["type"] != "http"
+            or scope["method"] not in ("GET", "HEAD")
+            or scope["path"].startswith(self.excluded_paths)
+        ):
+            await self.app(scope, receive, send)
+            return
+        waits = {pool: pool.estimated_wait() for pool in self.get_pools() if isinstance(pool, InstrumentedQueuePool)}
+        pool = min(waits, key=waits.__getitem__, default=None)
+        if pool is None or waits[pool] <= self.wait_budget:
+            await self.app(scope, receive, send)
+            return
+        ADMISSION_REJECTED.labels(pool.pool_name).inc()
+        response = JSONResponse(
+            {"detail": "The database is saturated, retry later"},
+            status_code=503,
+            headers={"Retry-After": str(max(ceil(waits[pool]), 1))},
+        )
+        await response(scope, receive, send)
@@ -1,5 +1,5 @@
 from datetime import date, datetime
-from typing import List
+from typing import List, Optional
 
 from pydantic import BaseModel, ConfigDict, Field
 
@@ -24,10 +24,16 @@ class StatsBase(BaseModel):
     model_config = ConfigDict(from_attributes=True)
 
     date: date
+    bucket: datetime
     min: float
     max: float
     sum: float
     count: int
+    avg: float
+    stddev: Optional[float] = None
+    p50: Optional[float] = None
+    p90: Optional[float] = None
+    p99: Optional[float] = None
 
 
 class ParkStats(StatsBase):
@@ -36,3 +42,66 @@ class ParkStats(StatsBase):
 
 class EnergyTypeStats(StatsBase):
     energy_type: EnergyType
+
+
+class TimezoneStats(StatsBase):
+    timezone: Timezone
+
+
+class StatsViews(BaseModel):
+    parks: Optional[List[ParkStats]] = None
+    energy_types: Optional[List[EnergyTypeStats]] = None
+    timezones: Optional[List[TimezoneStats]] = None
+    all: Optional[List[StatsBase]] = None
+
+
+class Station(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
+    code: str
+    name: str
+    province: str
+    latitude: str
+    longitude: str
+    altitude: str
+
+
+class Measurement(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
+    station_code: str
+    date: date
+    avg_temp: Optional[float] = None
+    min_temp: Optional[float] = None
+    max_temp: Optional[float] = None
+    min_temp_time: Optional[str] = None
+    max_temp_time: Optional[str] = None
+    precipitation: Optional[float] = None
+    wind_direction: Optional[int] = None
+    avg_wind_speed: Optional[float] = None
+    max_gust: Optional[float] = None
+    max_gust_time: Optional[str] = None
+    sunshine: Optional[float] = None
+    max_pressure: Optional[float] = None
+    max_pressure_time: Optional[str] = None
+    min_pressure: Optional[float] = None
+    min_pressure_time: Optional[str] = None
+    avg_humidity: Optional[float] = None
+    max_humidity: Optional[float] = None
+    max_humidity_time: Optional[str] = None
+    min_humidity: Optional[float] = None
+    min_humidity_time: Optional[str] = None
+
+
+class ParkWeatherCorrelation(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
+    name: ParkName
+    station_code: str
+    days: int
+    avg_production: Optional[float] = None
+    avg_temp: Optional[float] = None
+    temperature_correlation: Optional[float] = None
+    temperature_slope: Optional[float] = None
+    sunshine_correlation: Optional[float] = None
+    wind_speed_correlation: Optional[float] = None
@@ -1,19 +1,43 @@
 # -*-coding:utf8-*-
+from concurrent.futures import Executor
 from csv import DictReader
-from datetime import date, datetime
+from datetime import date
+import os
+from tempfile import TemporaryDirectory, mkdtemp
+from time import perf_counter
+from typing import List, Optional, Tuple
+from uuid import UUID, uuid4
 
-from fastapi import APIRouter, BackgroundTasks, Depends, Query, UploadFile
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, Path, Query, UploadFile
 from fastapi.responses import JSONResponse
-from sqlalchemy import select
+from sqlalchemy import select, update
+from sqlalchemy.engine import Engine
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
 from starlette.status import (
     HTTP_200_OK,
+    HTTP_202_ACCEPTED,
+    HTTP_404_NOT_FOUND,
 )
 
-from main.constraints import ParkName
-from main.db import get_session
-from main.db.models import EnergyReadingRow, MeasurementRow, ParkRow, StationRow
-from main.utils import gen_upload_file_as_string
+from main.cache import CacheBackend, get_cache
+from main.constraints import JobStatus, ParkName
+from main.db import get_async_session, get_engine, get_session
+from main.db.bulk import (
+    UpsertCounts,
+    copy_energy_readings,
+    copy_measurements,
+    drop_energy_readings_month,
+    refresh_local_energy_readings_daily,
+    staged_energy_readings_date_range,
+    upsert_rows,
+)
+from main.db.models import IngestionJobRow, ParkRow, StationRow
+from main.db.partitions import list_energy_readings_partitions, partition_of
+from main.ingest import get_ingest_pool, ingest_energy_readings_files, spool_upload
+from main.jobs import SPOOL_DIR, job_status, submit_energy_readings_job
+from main.utils import gen_batches, gen_upload_file_as_string
 from main.routers.exceptions import handle_upsert
 
 router = APIRouter(prefix="/admin", tags=["ADMIN"])
@@ -24,6 +48,7 @@ async def insert_parks_from_file(
     *,
     background_tasks: BackgroundTasks,
     session: Session = Depends(get_session),
+    cache: CacheBackend = Depends(get_cache),
     upload_file: UploadFile,
 ) -> JSONResponse:
     """
@@ -37,33 +62,84 @@ async def insert_parks_from_file(
     Args:
         background_tasks: FastAPI's BackgroundTasks instance for managing background tasks.
         session: The database session.
+        cache: The response cache, cleared when parks change.
         upload_file: The uploaded CSV file.
 
     Returns:
-        A JSON response with the number of rows successfully inserted/updated.
+        A JSON response with the number of rows successfully inserted/updated, split in inserted, updated and
+        unchanged rows.
 
     Example file:
         park_name,timezone,energy_type
         Netterden,Europe/Amsterdam,Wind
         Stadskanaal,Europe/Bucharest,Solar
     """
-    n = 0
-    try:
+
+    def load() -> Tuple[int, UpsertCounts]:
+        n = 0
+        counts = UpsertCounts(inserted=0, updated=0, unchanged=0)
         f = gen_upload_file_as_string(upload_file.file)
         with handle_upsert():
-            for n, row in enumerate(DictReader(f, delimiter=","), start=1):
-                session.add(
-                    ParkRow(
-                        name=row["park_name"],
-                        timezone=row["timezone"],
-                        energy_type=row["energy_type"],
-                    )
-                )
+            rows = (
+                {"name": row["park_name"], "timezone": row["timezone"], "energy_type": row["energy_type"]}
+                for row in DictReader(f, delimiter=",")
+            )
+            moved = set()  # Parks whose timezone changed, their local days move with it
+            for batch in gen_batches(rows):
+                timezones = {row["name"]: row["timezone"] for row in batch}
+                previous = session.execute(
+                    select(ParkRow.name, ParkRow.timezone).where(ParkRow.name.in_(timezones))
+                ).all()
+                counts += upsert_rows(session, ParkRow.__table__, batch, index_elements=["name"])
+                moved.update(name for name, timezone in previous if timezones[name] != timezone)
+                n += len(batch)
+            if moved:
+                refresh_local_energy_readings_daily(session, moved)
             session.commit()
+        return n, counts
+
+    try:
+        n, counts = await run_in_threadpool(load)
     finally:
         background_tasks.add_task(upload_file.file.close)
+    if counts.inserted or counts.updated:
+        await cache.clear()
+
+    content = {"message": f"{n} rows successfully inserted/updated", **counts._asdict()}
+    return JSONResponse(content, status_code=HTTP_200_OK)
+
+
+@router.put("/parks/{park_name}/station")
+async def set_park_station(
+    *,
+    park_name: ParkName = Path(..., description="Park to map a weather station to."),
+    station_code: str = Query(..., description="Code of the nearby weather station, e.g. 0002I."),
+    session: Session = Depends(get_session),
+) -> JSONResponse:
+    """
+    Map a park to the nearby weather station its production is correlated with, see ``/stats/parks/weather``.
+
+    Args:
+        park_name: The name of the park.
+        station_code: The code of the station.
+        session: The database session.
+
+    Returns:
+        A JSON response naming the mapped station.
+    """
+
+    def map_station() -> None:
+        station_id = session.execute(select(StationRow.id).where(StationRow.code == station_code)).scalars().first()
+        if station_id is None:
+            raise HTTPException(status_code=HTTP_404_NOT_FOUND, detail=f"No station {station_code}.")
+        result = session.execute(update(ParkRow).where(ParkRow.name == park_name.value).values(station_id=station_id))
+        if not result.rowcount:
+            raise HTTPException(status_code=HTTP_404_NOT_FOUND, detail=f"No park {park_name.value}.")
+        session.commit()
+
+    await run_in_threadpool(map_station)
 
-    content = {"message": f"{n} rows successfully inserted/updated"}
+    content = {"message": f"{park_name.value} mapped to station {station_code}"}
     return JSONResponse(content, status_code=HTTP_200_OK)
 
 
@@ -73,6 +149,7 @@ async def insert_energy_readings_from_file(
     background_tasks: BackgroundTasks,
     park_name: ParkName = Query(..., description="Park to associate this readings to."),
     session: Session = Depends(get_session),
+    cache: CacheBackend = Depends(get_cache),
     upload_file: UploadFile,
 ):
     """
@@ -86,33 +163,226 @@ async def insert_energy_readings_from_file(
         background_tasks: FastAPI's BackgroundTasks instance for managing background tasks.
         park_name: The name of the park to associate the energy readings with.
         session: The database session.
+        cache: The response cache, invalidated for the park and days of the file.
         upload_file: The uploaded CSV file.
 
     Returns:
-        A JSON response with the number of rows successfully inserted/updated.
+        A JSON response with the number of rows successfully inserted/updated, split in inserted, updated and
+        unchanged rows, and the load throughput.
 
     Example file:
         datetime,MW
         2020-03-01 00:00:00,10.108
         2020-03-01 00:15:00,11.196
     """
-    n = 0
-    try:
+    start = perf_counter()
+
+    def load() -> Tuple[UpsertCounts, Optional[date], Optional[date]]:
         f = gen_upload_file_as_string(upload_file.file)
         with handle_upsert():
-            for n, row in enumerate(DictReader(f, delimiter=","), start=1):
-                session.add(
-                    EnergyReadingRow(
-                        park_name=park_name,
-                        timestamp=datetime.fromisoformat(row["datetime"]),
-                        megawatts=row["MW"],
-                    )
-                )
+            counts = copy_energy_readings(session, park_name=park_name.value, rows=DictReader(f, delimiter=","))
+            first, last = staged_energy_readings_date_range(session)
             session.commit()
+        return counts, first, last
+
+    try:
+        counts, first, last = await run_in_threadpool(load)
     finally:
         background_tasks.add_task(upload_file.file.close)
+    if counts.inserted or counts.updated:
+        await cache.invalidate(park_name.value, first, last)
+    elapsed = perf_counter() - start
+    n = sum(counts)
+
+    content = {
+        "message": f"{n} rows successfully inserted/updated",
+        **counts._asdict(),
+        "rows_per_second": round(n / elapsed, 2) if elapsed else 0.0,
+    }
+    return JSONResponse(content, status_code=HTTP_200_OK)
+
+
+@router.post("/energy-readings/batch-upload")
+async def insert_energy_readings_from_files(
+    *,
+    background_tasks: BackgroundTasks,
+    engine: Engine = Depends(get_engine),
+    pool: Executor = Depends(get_ingest_pool),
+    cache: CacheBackend = Depends(get_cache),
+    upload_files: List[UploadFile],
+) -> JSONResponse:
+    """
+    Insert energy readings of several parks at once, from CSV files or zip archives of CSV files.
+
+    The park of each file is its name without extension (e.g. ``Netterden.csv``), and every file has the columns of
+    ``/admin/energy-readings/upload``. Files are parsed and loaded in parallel by a pool of worker processes, each
+    over its own database connection, and each file is committed on its own: a failed file does not abort the others.
+
+    Args:
+        background_tasks: FastAPI's BackgroundTasks instance for managing background tasks.
+        engine: The database engine the workers connect to.
+        pool: The ingestion process pool.
+        cache: The response cache, invalidated for the parks and days of the loaded files.
+        upload_files: The uploaded CSV files or zip archives.
+
+    Returns:
+        A JSON response with the status of every file: inserted, updated and unchanged rows and load throughput, or
+        the error that aborted it.
+    """
+    try:
+        with TemporaryDirectory(prefix="energy-readings-") as directory:
+            files = []
+            for upload_file in upload_files:
+                files += await run_in_threadpool(spool_upload, upload_file.filename or "", upload_file.file, directory)
+            results = await ingest_energy_readings_files(pool, engine.url.render_as_string(hide_password=False), files)
+    finally:
+        for upload_file in upload_files:
+            background_tasks.add_task(upload_file.file.close)
+    for result in results:
+        if result.counts and (result.counts.inserted or result.counts.updated):
+            await cache.invalidate(result.park_name, result.first, result.last)
+
+    loaded = sum(result.error is None for result in results)
+    content = {
+        "message": f"{loaded} of {len(results)} files successfully loaded",
+        "files": [result.as_dict() for result in results],
+    }
+    return JSONResponse(content, status_code=HTTP_200_OK)
+
+
+@router.post("/jobs/energy-readings", status_code=HTTP_202_ACCEPTED)
+async def create_energy_readings_jobs(
+    *,
+    background_tasks: BackgroundTasks,
+    park_name: Optional[ParkName] = Query(default=None, description="Park of every file, instead of the file names."),
+    engine: Engine = Depends(get_engine),
+    session: AsyncSession = Depends(get_async_session),
+    pool: Executor = Depends(get_ingest_pool),
+    cache: CacheBackend = Depends(get_cache),
+    upload_files: List[UploadFile],
+) -> JSONResponse:
+    """
+    Queue the load of energy readings files in the background, one job per file, and return the job ids at once.
+
+    Files are CSV files or zip archives of CSV files with the columns of ``/admin/energy-readings/upload``. They are
+    spooled to disk and loaded by the ingestion worker processes, so the server keeps answering other requests at
+    full speed. Follow a job with ``/admin/jobs/{job_id}``.
+
+    Args:
+        background_tasks: FastAPI's BackgroundTasks instance for managing background tasks.
+        park_name: The park of every file. Derived from each file name (e.g. ``Netterden.csv``) by default.
+        engine: The database engine the workers connect to.
+        session: The database session.
+        pool: The ingestion process pool.
+        cache: The response cache, invalidated for the park and days of each file once loaded.
+        upload_files: The uploaded CSV files or zip archives.
 
-    content = {"message": f"{n} rows successfully inserted/updated"}
+    Returns:
+        A JSON response with the job id of every file, or why it was not queued.
+    """
+    directory = mkdtemp(prefix="energy-readings-", dir=SPOOL_DIR)
+    try:
+        files = []
+        for upload_file in upload_files:
+            files += await run_in_threadpool(spool_upload, upload_file.filename or "", upload_file.file, directory)
+    finally:
+        for upload_file in upload_files:
+            background_tasks.add_task(upload_file.file.close)
+
+    jobs, queued = [], []
+    for file in files:
+        if park_name:
+            file = file._replace(park_name=park_name.value)
+        if file.park_name is None:
+            os.remove(file.path)
+            jobs.append(
+                {"filename": file.filename, "job_id": None, "error": "The filename does not name a known park."}
+            )
+            continue
+        job_id = uuid4()
+        session.add(
+            IngestionJobRow(
+                id=job_id,
+                park_name=file.park_name,
+                filename=file.filename,
+                status=JobStatus.queued.value,
+                total_bytes=os.path.getsize(file.path),
+                spool_path=file.path,
+            )
+        )
+        queued.append((job_id, file))
+        jobs.append({"filename": file.filename, "park_name": file.park_name, "job_id": str(job_id)})
+    await session.commit()
+    for job_id, file in queued:
+        submit_energy_readings_job(pool, engine, cache, job_id, file)
+    if not queued:
+        os.rmdir(directory)
+
+    return JSONResponse({"jobs": jobs}, status_code=HTTP_202_ACCEPTED)
+
+
+@router.get("/jobs/{job_id}")
+async def read_job(job_id: UUID, session: AsyncSession = Depends(get_async_session)) -> JSONResponse:
+    """
+    Report the progress of an ingestion job.
+
+    Returns:
+        A JSON response with the status of the job (queued, running, succeeded or failed), rows processed,
+        throughput, progress and estimated seconds left from the bytes read, and the error of a failed job.
+    """
+    job = await session.get(IngestionJobRow, job_id)
+    if job is None:
+        raise HTTPException(status_code=HTTP_404_NOT_FOUND, detail=f"No job {job_id}.")
+    return JSONResponse(job_status(job), status_code=HTTP_200_OK)
+
+
+@router.get("/energy-readings/partitions")
+async def read_energy_readings_partitions(session: Session = Depends(get_session)) -> JSONResponse:
+    """
+    List the monthly partitions of the energy readings, oldest first.
+
+    Returns:
+        A JSON response with the name, first day and exclusive last day of every partition.
+    """
+    partitions = await run_in_threadpool(list_energy_readings_partitions, session)
+    content = [{"name": p.name, "start": p.start.isoformat(), "end": p.end.isoformat()} for p in partitions]
+    return JSONResponse(content, status_code=HTTP_200_OK)
+
+
+@router.delete("/energy-readings/partitions/{month}")
+async def delete_energy_readings_month(
+    *,
+    month: date = Path(..., description="Any day of the month to drop, e.g. 2020-03-01."),
+    session: Session = Depends(get_session),
+    cache: CacheBackend = Depends(get_cache),
+) -> JSONResponse:
+    """
+    Drop every energy reading of a month at once, by detaching and dropping its partition.
+
+    The daily rollup is updated for that month and the days around it, and the response cache is cleared.
+
+    Args:
+        month: Any day of the month to drop.
+        session: The database session.
+        cache: The response cache, cleared once the month is dropped.
+
+    Returns:
+        A JSON response with the name of the dropped partition.
+    """
+    partition = partition_of(month)
+
+    def drop() -> None:
+        if partition not in list_energy_readings_partitions(session):
+            raise HTTPException(status_code=HTTP_404_NOT_FOUND, detail=f"No partition for {partition.start:%Y-%m}.")
+        drop_energy_readings_month(session, partition)
+        session.commit()
+
+    try:
+        await run_in_threadpool(drop)
+    finally:
+        await cache.clear()  # Also when the rollup refresh fails, the readings are gone once detached
+
+    content = {"message": f"{partition.name} dropped"}
     return JSONResponse(content, status_code=HTTP_200_OK)
 
 
@@ -124,12 +394,13 @@ async def insert_stations_from_file(
     upload_file: UploadFile,
 ):
     """
-    Insert parks into the database from an uploaded CSV file.
+    Insert weather stations into the database from an uploaded CSV file, updating the stations already known by code.
 
     The CSV file must have the following columns:
-    park_name: The unique name of the park.
-    timezone: The timezone in which the park is located.
-    energy_type: The type of energy produced by the park (e.g., Wind, Solar).
+    code: The unique code of the station, the INDICATIVO of its measurements.
+    name: The name of the station.
+    province: The province in which the station is located.
+    latitude, longitude and altitude: The location of the station.
 
     Args:
         background_tasks: FastAPI's BackgroundTasks instance for managing background tasks.
@@ -137,30 +408,33 @@ async def insert_stations_from_file(
         upload_file: The uploaded CSV file.
 
     Returns:
-        A JSON response with the number of rows successfully inserted/updated.
+        A JSON response with the number of rows successfully inserted/updated, split in inserted, updated and
+        unchanged rows.
 
     Example file:
-        park_name,timezone,energy_type
-        Netterden,Europe/Amsterdam,Wind
-        Stadskanaal,Europe/Bucharest,Solar
+        code,name,province,latitude,longitude,altitude
+        0002I,VANDELLÒS,TARRAGONA,405951N,005216E,32
     """
-    n = 0
-    try:
+    columns = ("code", "name", "province", "latitude", "longitude", "altitude")
+
+    def load() -> Tuple[int, UpsertCounts]:
+        n = 0
+        counts = UpsertCounts(inserted=0, updated=0, unchanged=0)
         f = gen_upload_file_as_string(upload_file.file)
         with handle_upsert():
-            for n, row in enumerate(DictReader(f, delimiter=","), start=1):
-                session.add(
-                    ParkRow(
-                        name=row["park_name"],
-                        timezone=row["timezone"],
-                        energy_type=row["energy_type"],
-                    )
-                )
+            rows = ({name: row[name] for name in columns} for row in DictReader(f, delimiter=","))
+            for batch in gen_batches(rows):
+                counts += upsert_rows(session, StationRow.__table__, batch, index_elements=["code"])
+                n += len(batch)
             session.commit()
+        return n, counts
+
+    try:
+        n, counts = await run_in_threadpool(load)
     finally:
         background_tasks.add_task(upload_file.file.close)
 
-    content = {"message": f"{n} rows successfully inserted/updated"}
+    content = {"message": f"{n} rows successfully inserted/updated", **counts._asdict()}
     return JSONResponse(content, status_code=HTTP_200_OK)
 
 
@@ -168,49 +442,47 @@ async def insert_stations_from_file(
 async def insert_measurements_from_file(
     *,
     background_tasks: BackgroundTasks,
-    station_code: str = Query(..., description="Station to associate this measurements to."),
+    station_code: Optional[str] = Query(
+        None, description="Station to associate this measurements to. The INDICATIVO column of each row by default."
+    ),
     session: Session = Depends(get_session),
     upload_file: UploadFile,
 ) -> JSONResponse:
     """
-    Insert measurements for a given station into the database from an uploaded CSV file.
+    Insert daily measurements of one or many stations into the database from an uploaded AEMET CSV file.
 
-    The CSV file must have the following columns:
-    datetime: The timestamp of the energy reading (ISO 8601 format).
-    MW: The energy production in megawatts at the given timestamp.
+    The CSV file is ``;`` separated, with the AEMET OpenData daily columns:
+    FECHA: The day of the measurements (ISO 8601 format).
+    INDICATIVO: The code of the station.
+    TMEDIA, TMIN, TMAX, PRECIPITACION, DIR, VELMEDIA, RACHA, SOL, PRESMAX, PRESMIN, HRMEDIA, HRMAX, HRMIN and their
+    HORA* times, all optional. Decimal commas are accepted.
 
     Args:
         background_tasks: FastAPI's BackgroundTasks instance for managing background tasks.
-        station_code: The code of the station to associate the measurements with.
+        station_code: The code of the station to associate every measurement with, instead of INDICATIVO.
         session: The database session.
         upload_file: The uploaded CSV file.
 
     Returns:
-        A JSON response with the number of rows successfully inserted/updated.
+        A JSON response with the number of rows successfully inserted/updated, split in inserted, updated and
+        unchanged rows.
 
     Example file:
         FECHA;INDICATIVO;NOMBRE;PROVINCIA;ALTITUD;TMEDIA;PRECIPITACION;TMIN;HORATMIN;TMAX;HORATMAX;DIR;VELMEDIA;RACHA;HORARACHA;SOL;PRESMAX;HORAPRESMAX;PRESMIN;HORAPRESMIN
         1968-03-01;0002I;VANDELLÒS;TARRAGONA;32;8.9;21.0;6.6;03:00;11.2;18:00;05;1.9;6.7;10:55;0.0;;;;
     """
-    n = 0
-    try:
+
+    def load() -> UpsertCounts:
         f = gen_upload_file_as_string(upload_file.file)
         with handle_upsert():
-            for n, row in enumerate(DictReader(f, delimiter=","), start=1):
-                stmt = select(StationRow.id).where(StationRow.code == station_code)
-                station_id = session.execute(stmt).one()
-                session.add(
-                    MeasurementRow(
-                        station_id=station_id,
-                        date=date.fromisoformat(row["FECHA"]),
-                        avg_temp=row["TMEDIA"],
-                        min_temp=row["TMIN"],
-                        max_temp=row["TMAX"],
-                    )
-                )
+            counts = copy_measurements(session, DictReader(f, delimiter=";"), station_code)
             session.commit()
+        return counts
+
+    try:
+        counts = await run_in_threadpool(load)
     finally:
         background_tasks.add_task(upload_file.file.close)
 
-    content = {"message": f"{n} rows successfully inserted/updated"}
+    content = {"message": f"{sum(counts)} rows successfully inserted/updated", **counts._asdict()}
     return JSONResponse(content, status_code=HTTP_200_OK)
@@ -1,25 +1,74 @@
-from datetime import date
-from functools import reduce
-from typing import Dict, List, Optional, Sequence
+from datetime import date, datetime
+from typing import Any, AsyncIterator, List, Mapping, Optional, Sequence
 
-from fastapi import APIRouter, Depends, Query
-from fastapi.responses import RedirectResponse
-from sqlalchemy.orm import Session
-from sqlalchemy.engine.row import RowMapping
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Response
+from fastapi.responses import ORJSONResponse, RedirectResponse, StreamingResponse
+from pydantic import TypeAdapter
+from sqlalchemy.engine.row import Row
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+from starlette.status import HTTP_400_BAD_REQUEST
 
-from main.constraints import EnergyType, ParkName, Timezone
-from main.db import get_session
+from main.arrow import READINGS_COLUMNS, STATS_COLUMNS, ArrowFormat, gen_serialized, negotiate, serialize
+from main.constraints import Bucket, EnergyType, ExportFormat, ParkName, StatsView, Timezone, TzMode
+from main.db import get_read_session, get_read_sessionmaker
 from main.db.queries import (
-    select_parks,
-    select_parks_with_energy_readings,
-    select_stats_by_energy_type_and_date,
-    select_stats_by_park_and_date,
+    ParkEnergyReadingsRow,
+    async_select_measurements,
+    async_select_park_partials,
+    async_select_park_weather_correlation,
+    async_select_parks,
+    async_select_parks_with_energy_readings,
+    async_select_stations,
+    async_select_stats_by_energy_type_and_date,
+    async_select_stats_by_park_and_date,
+    async_stream_parks_with_energy_readings,
 )
-from main.models import EnergyTypeStats, Park, ParkStats
-from main.utils import pack
+from main.metrics import span
+from main.models import (
+    EnergyTypeStats,
+    Measurement,
+    Park,
+    ParkStats,
+    ParkWeatherCorrelation,
+    Station,
+    StatsViews,
+)
+from main.routers.exceptions import handle_cursor
+from main.utils import decode_cursor, encode_cursor, group_readings, merge_partials, rows_as_csv, rows_as_ndjson
 
 router = APIRouter()
 
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+EXPORT_BATCH_SIZE = 10_000
+EXPORT_MEDIA_TYPES = {
+    ExportFormat.ndjson: "application/x-ndjson",
+    ExportFormat.csv: "text/csv",
+    ExportFormat.arrow: ArrowFormat.arrow.value,
+    ExportFormat.parquet: ArrowFormat.parquet.value,
+}
+ACCEPT_DESCRIPTION = f"{ArrowFormat.arrow.value} or {ArrowFormat.parquet.value} for a flat table instead of JSON."
+STATS_VIEWS_MAX_PARTIALS = 10_000
+STATS_VIEW_KEYS = {StatsView.parks: "name", StatsView.energy_types: "energy_type", StatsView.timezones: "timezone"}
+PARKS = TypeAdapter(List[Park])
+PARK_STATS = TypeAdapter(List[ParkStats])
+ENERGY_TYPE_STATS = TypeAdapter(List[EnergyTypeStats])
+STATS_VIEWS = TypeAdapter(StatsViews)
+PARK_WEATHER_CORRELATIONS = TypeAdapter(List[ParkWeatherCorrelation])
+STATIONS = TypeAdapter(List[Station])
+MEASUREMENTS = TypeAdapter(List[Measurement])
+
+
+def json_response(
+    content: Any, adapter: TypeAdapter, headers: Optional[Mapping[str, str]] = None, exclude_none: bool = False
+) -> Response:
+    """
+    Validate ``content`` against the response model and serialize it, as FastAPI does for a ``response_model``, but
+    timed as the ``serialize`` stage of the request.
+    """
+    with span("serialize"):
+        body = adapter.dump_json(adapter.validate_python(content, from_attributes=True), exclude_none=exclude_none)
+    return Response(body, media_type="application/json", headers=headers)
+
 
 @router.head("/")
 @router.get("/")
@@ -31,94 +80,338 @@ def redirect_to_docs() -> RedirectResponse:
 
 
 @router.get("/parks", response_model=List[Park], response_model_exclude_none=True)
-def read_parks(
-    session: Session = Depends(get_session),
+async def read_parks(
+    session: AsyncSession = Depends(get_read_session),
     energy_types: List[EnergyType] = Query(default=[]),
     timezones: List[Timezone] = Query(default=[]),
     offset: int = 0,
     limit: int = Query(default=100, lte=100),
-) -> Sequence[RowMapping]:
+) -> Response:
     """
     Get parks in database
     """
-    return select_parks(session=session, timezones=timezones, energy_types=energy_types, offset=offset, limit=limit)
+    with span("query"):
+        rows = await async_select_parks(
+            session=session, timezones=timezones, energy_types=energy_types, offset=offset, limit=limit
+        )
+    return json_response(rows, PARKS, exclude_none=True)
 
 
 @router.get("/parks/energy-readings", response_model=List[Park])
-def read_parks_with_energy_readings(
-    session: Session = Depends(get_session),
+async def read_parks_with_energy_readings(
+    session: AsyncSession = Depends(get_read_session),
     park_names: List[ParkName] = Query(default=[]),
     energy_types: List[EnergyType] = Query(default=[]),
     timezones: List[Timezone] = Query(default=[]),
     start_date: Optional[date] = Query(default=None),
     end_date: Optional[date] = Query(default=None),
-    offset: int = 0,
+    offset: int = Query(default=0, deprecated=True, description="Prefer cursor pagination."),
     limit: int = Query(default=100, lte=100),
-) -> Sequence[RowMapping]:
+    cursor: Optional[str] = Query(default=None, description=f"Value of the {NEXT_CURSOR_HEADER} response header."),
+    accept: Optional[str] = Header(default=None, description=ACCEPT_DESCRIPTION),
+) -> Response:
+    """
+    Get park energy production readings, ordered by park and timestamp. ``limit`` counts readings.
+
+    When more readings are available, the ``X-Next-Cursor`` response header holds the cursor of the next page. With an
+    Arrow or Parquet ``Accept`` header, readings are returned as a flat table, one row per reading.
+
+    Rows are grouped by park in one pass and serialized with orjson, skipping the validation of every reading against
+    the response model, which only documents the shape.
     """
-    Get park energy production readings.
+    arrow_format = negotiate(accept)
+    with handle_cursor():
+        after = decode_cursor(cursor, str, datetime.fromisoformat) if cursor else None
+    with span("query"):
+        rows = await async_select_parks_with_energy_readings(
+            session,
+            park_names=park_names,
+            timezones=timezones,
+            energy_types=energy_types,
+            offset=offset,
+            limit=limit,
+            start_date=start_date,
+            end_date=end_date,
+            after=after,
+        )
+    headers = {}
+    if len(rows) == limit:
+        headers[NEXT_CURSOR_HEADER] = encode_cursor(rows[-1].name, rows[-1].timestamp)
+    with span("serialize"):
+        if arrow_format:
+            content = serialize(rows, READINGS_COLUMNS, arrow_format)
+            return Response(content, media_type=arrow_format.value, headers=headers)
+        return ORJSONResponse(group_readings(rows), headers=headers)
+
+
+@router.get("/parks/energy-readings/export", response_class=StreamingResponse)
+async def export_parks_with_energy_readings(
+    sessionmaker: async_sessionmaker[AsyncSession] = Depends(get_read_sessionmaker),
+    park_names: List[ParkName] = Query(default=[]),
+    energy_types: List[EnergyType] = Query(default=[]),
+    timezones: List[Timezone] = Query(default=[]),
+    start_date: Optional[date] = Query(default=None),
+    end_date: Optional[date] = Query(default=None),
+    format: Optional[ExportFormat] = Query(default=None, description="Defaults to the Accept header, or ndjson."),
+    accept: Optional[str] = Header(default=None, description=ACCEPT_DESCRIPTION),
+) -> StreamingResponse:
     """
-    rows = select_parks_with_energy_readings(
-        session,
+    Stream every matching energy reading, one flat row per reading, as NDJSON, CSV, Arrow IPC stream or Parquet.
+
+    Rows are read through a server-side cursor and written as they arrive, so there is no upper limit. Arrow and
+    Parquet get one record batch or row group per cursor batch.
+    """
+    if format is None:
+        arrow_format = negotiate(accept)
+        format = ExportFormat[arrow_format.name] if arrow_format else ExportFormat.ndjson
+    elif format in (ExportFormat.arrow, ExportFormat.parquet):
+        negotiate(EXPORT_MEDIA_TYPES[format])
+    filters = dict(
         park_names=park_names,
         timezones=timezones,
         energy_types=energy_types,
-        offset=offset,
-        limit=limit,
         start_date=start_date,
         end_date=end_date,
     )
-    packed_rows: Dict = reduce(pack, rows, {})
-    return [packed_rows[key] for key in packed_rows]
+
+    async def gen_rows() -> AsyncIterator[Sequence[Row]]:
+        async with sessionmaker() as session:
+            async for rows in async_stream_parks_with_energy_readings(session, EXPORT_BATCH_SIZE, **filters):
+                yield rows
+
+    async def gen_export() -> AsyncIterator[str]:
+        if format == ExportFormat.csv:
+            yield rows_as_csv([], header=ParkEnergyReadingsRow._fields)
+        async for rows in gen_rows():
+            if format == ExportFormat.csv:
+                yield rows_as_csv(rows)
+            else:
+                yield rows_as_ndjson(rows, fields=ParkEnergyReadingsRow._fields)
+
+    if format in (ExportFormat.arrow, ExportFormat.parquet):
+        content = gen_serialized(gen_rows(), READINGS_COLUMNS, ArrowFormat[format.name])
+    else:
+        content = gen_export()
+    return StreamingResponse(
+        content,
+        media_type=EXPORT_MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="energy-readings.{format.value}"'},
+    )
 
 
 @router.get("/stats/parks", response_model=List[ParkStats])
-def read_park_stats(
-    session: Session = Depends(get_session),
+async def read_park_stats(
+    session: AsyncSession = Depends(get_read_session),
     park_names: List[ParkName] = Query(default=[]),
     energy_types: List[EnergyType] = Query(default=[]),
     timezones: List[Timezone] = Query(default=[]),
     start_date: Optional[date] = Query(default=None),
     end_date: Optional[date] = Query(default=None),
-    offset: int = 0,
+    offset: int = Query(default=0, deprecated=True, description="Prefer cursor pagination."),
     limit: int = Query(default=100, lte=100),
-) -> Sequence[RowMapping]:
+    cursor: Optional[str] = Query(default=None, description=f"Value of the {NEXT_CURSOR_HEADER} response header."),
+    tz_mode: TzMode = Query(default=TzMode.utc, description="Cut days at UTC midnight or in the park's timezone."),
+    bucket: Bucket = Query(default=Bucket.day),
+    percentiles: bool = Query(default=False, description="Add p50, p90 and p99. Reads the raw readings."),
+    accept: Optional[str] = Header(default=None, description=ACCEPT_DESCRIPTION),
+) -> Response:
     """
-    Get park stats
+    Get park stats by ``bucket`` (15min, hour, day, week or month), ordered by name and bucket. With ``tz_mode=local``
+    buckets follow the park's timezone.
+
+    When more rows are available, the ``X-Next-Cursor`` response header holds the cursor of the next page.
     """
-    return select_stats_by_park_and_date(
-        session,
-        park_names=park_names,
-        energy_types=energy_types,
-        timezones=timezones,
-        offset=offset,
-        limit=limit,
-        start_date=start_date,
-        end_date=end_date,
-    )
+    arrow_format = negotiate(accept)
+    with handle_cursor():
+        after = decode_cursor(cursor, str, datetime.fromisoformat) if cursor else None
+    with span("query"):
+        rows = await async_select_stats_by_park_and_date(
+            session,
+            park_names=park_names,
+            energy_types=energy_types,
+            timezones=timezones,
+            offset=offset,
+            limit=limit,
+            start_date=start_date,
+            end_date=end_date,
+            after=after,
+            tz_mode=tz_mode,
+            bucket=bucket,
+            percentiles=percentiles,
+        )
+    headers = {}
+    if len(rows) == limit:
+        headers[NEXT_CURSOR_HEADER] = encode_cursor(rows[-1]["name"], rows[-1]["bucket"])
+    if arrow_format:
+        with span("serialize"):
+            content = serialize(rows, [("name", "string"), *STATS_COLUMNS], arrow_format)
+        return Response(content, media_type=arrow_format.value, headers=headers)
+    return json_response(rows, PARK_STATS, headers)
 
 
 @router.get("/stats/energy_types", response_model=List[EnergyTypeStats])
-def read_energy_type_stats(
-    session: Session = Depends(get_session),
+async def read_energy_type_stats(
+    session: AsyncSession = Depends(get_read_session),
+    park_names: List[ParkName] = Query(default=[]),
+    energy_types: List[EnergyType] = Query(default=[]),
+    timezones: List[Timezone] = Query(default=[]),
+    start_date: Optional[date] = Query(default=None),
+    end_date: Optional[date] = Query(default=None),
+    offset: int = Query(default=0, deprecated=True, description="Prefer cursor pagination."),
+    limit: int = Query(default=100, lte=100),
+    cursor: Optional[str] = Query(default=None, description=f"Value of the {NEXT_CURSOR_HEADER} response header."),
+    tz_mode: TzMode = Query(default=TzMode.utc, description="Cut days at UTC midnight or in each park's timezone."),
+    bucket: Bucket = Query(default=Bucket.day),
+    percentiles: bool = Query(default=False, description="Add p50, p90 and p99. Reads the raw readings."),
+    accept: Optional[str] = Header(default=None, description=ACCEPT_DESCRIPTION),
+) -> Response:
+    """
+    Get energy_type stats by ``bucket`` (15min, hour, day, week or month), ordered by energy_type and bucket. With
+    ``tz_mode=local`` every park contributes the buckets of its own timezone.
+
+    When more rows are available, the ``X-Next-Cursor`` response header holds the cursor of the next page.
+    """
+    arrow_format = negotiate(accept)
+    with handle_cursor():
+        after = decode_cursor(cursor, str, datetime.fromisoformat) if cursor else None
+    with span("query"):
+        rows = await async_select_stats_by_energy_type_and_date(
+            session,
+            park_names=park_names,
+            energy_types=energy_types,
+            timezones=timezones,
+            offset=offset,
+            limit=limit,
+            start_date=start_date,
+            end_date=end_date,
+            after=after,
+            tz_mode=tz_mode,
+            bucket=bucket,
+            percentiles=percentiles,
+        )
+    headers = {}
+    if len(rows) == limit:
+        headers[NEXT_CURSOR_HEADER] = encode_cursor(rows[-1]["energy_type"], rows[-1]["bucket"])
+    if arrow_format:
+        with span("serialize"):
+            content = serialize(rows, [("energy_type", "string"), *STATS_COLUMNS], arrow_format)
+        return Response(content, media_type=arrow_format.value, headers=headers)
+    return json_response(rows, ENERGY_TYPE_STATS, headers)
+
+
+@router.get("/stats", response_model=StatsViews, response_model_exclude_none=True)
+async def read_stats_views(
+    session: AsyncSession = Depends(get_read_session),
+    views: List[StatsView] = Query(default=[StatsView.parks, StatsView.energy_types]),
+    park_names: List[ParkName] = Query(default=[]),
+    energy_types: List[EnergyType] = Query(default=[]),
+    timezones: List[Timezone] = Query(default=[]),
+    start_date: Optional[date] = Query(default=None),
+    end_date: Optional[date] = Query(default=None),
+    tz_mode: TzMode = Query(default=TzMode.utc, description="Cut days at UTC midnight or in each park's timezone."),
+    bucket: Bucket = Query(default=Bucket.day),
+) -> Response:
+    """
+    Get several stats views at once, each ordered by its key and bucket: by park, energy type, timezone and of all
+    parks together.
+
+    Every view is merged from the same per (park, bucket) aggregates, read in a single query. Views are not paginated,
+    so the filters must select at most 10000 park buckets.
+    """
+    with span("query"):
+        partials = await async_select_park_partials(
+            session,
+            park_names=park_names,
+            energy_types=energy_types,
+            timezones=timezones,
+            offset=0,
+            limit=STATS_VIEWS_MAX_PARTIALS + 1,
+            start_date=start_date,
+            end_date=end_date,
+            tz_mode=tz_mode,
+            bucket=bucket,
+        )
+    if len(partials) > STATS_VIEWS_MAX_PARTIALS:
+        raise HTTPException(
+            status_code=HTTP_400_BAD_REQUEST, detail="Too many buckets, narrow the filters or use a coarser bucket."
+        )
+    with span("merge"):
+        content = {view.value: merge_partials(partials, key=STATS_VIEW_KEYS.get(view)) for view in views}
+    return json_response(content, STATS_VIEWS, exclude_none=True)
+
+
+@router.get("/stats/parks/weather", response_model=List[ParkWeatherCorrelation])
+async def read_park_weather_correlation(
+    session: AsyncSession = Depends(get_read_session),
     park_names: List[ParkName] = Query(default=[]),
     energy_types: List[EnergyType] = Query(default=[]),
     timezones: List[Timezone] = Query(default=[]),
     start_date: Optional[date] = Query(default=None),
     end_date: Optional[date] = Query(default=None),
+    tz_mode: TzMode = Query(default=TzMode.local, description="Cut days at UTC midnight or in the park's timezone."),
+) -> Response:
+    """
+    Correlate the daily production (sum of readings) of each park with the weather measured by its station: average
+    temperature, sunshine and wind speed, with the production change per degree. Parks without a station are left out.
+
+    Computed by the database in a single aggregate over the daily rollup and the measurements, whatever the range.
+    Days default to the park's timezone, as weather stations report local days.
+    """
+    with span("query"):
+        rows = await async_select_park_weather_correlation(
+            session,
+            park_names=park_names,
+            energy_types=energy_types,
+            timezones=timezones,
+            start_date=start_date,
+            end_date=end_date,
+            tz_mode=tz_mode,
+        )
+    return json_response(rows, PARK_WEATHER_CORRELATIONS)
+
+
+@router.get("/stations", response_model=List[Station])
+async def read_stations(
+    session: AsyncSession = Depends(get_read_session),
+    codes: List[str] = Query(default=[]),
     offset: int = 0,
     limit: int = Query(default=100, lte=100),
-) -> Sequence[RowMapping]:
+) -> Response:
     """
-    Get energy_type stats
+    Get weather stations in database, ordered by code
     """
-    return select_stats_by_energy_type_and_date(
-        session,
-        park_names=park_names,
-        energy_types=energy_types,
-        timezones=timezones,
-        offset=offset,
-        limit=limit,
-        start_date=start_date,
-        end_date=end_date,
-    )
+    with span("query"):
+        rows = await async_select_stations(session=session, codes=codes, offset=offset, limit=limit)
+    return json_response(rows, STATIONS)
+
+
+@router.get("/stations/measurements", response_model=List[Measurement])
+async def read_station_measurements(
+    session: AsyncSession = Depends(get_read_session),
+    station_codes: List[str] = Query(default=[]),
+    start_date: Optional[date] = Query(default=None),
+    end_date: Optional[date] = Query(default=None),
+    limit: int = Query(default=100, lte=1000),
+    cursor: Optional[str] = Query(default=None, description=f"Value of the {NEXT_CURSOR_HEADER} response header."),
+) -> Response:
+    """
+    Get daily station measurements, ordered by station code and date. Date bounds are inclusive.
+
+    When more rows are available, the ``X-Next-Cursor`` response header holds the cursor of the next page.
+    """
+    with handle_cursor():
+        after = decode_cursor(cursor, str, date.fromisoformat) if cursor else None
+    with span("query"):
+        rows = await async_select_measurements(
+            session,
+            offset=0,
+            limit=limit,
+            station_codes=station_codes,
+            start_date=start_date,
+            end_date=end_date,
+            after=after,
+        )
+    headers = {}
+    if len(rows) == limit:
+        headers[NEXT_CURSOR_HEADER] = encode_cursor(rows[-1]["station_code"], rows[-1]["date"])
+    return json_response(rows, MEASUREMENTS, headers)
@@ -31,3 +31,17 @@ def handle_upsert():
         raise HTTPException(status_code=HTTP_409_CONFLICT, detail=repr(e))
     except Exception:
         raise HTTPException(status_code=HTTP_500_INTERNAL_SERVER_ERROR, detail="There was an error uploading the file")
+
+
+@contextmanager
+def handle_cursor():
+    """
+    A context manager for handling exceptions while decoding a pagination cursor.
+
+    Raises:
+        HTTPException: HTTP_400_BAD_REQUEST for a malformed cursor.
+    """
+    try:
+        yield
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=HTTP_400_BAD_REQUEST, detail="Invalid cursor.")
@@ -0,0 +1,147 @@
+# -*-coding:utf8-*-
+"""
+Production server: gunicorn managing one uvicorn worker (uvloop, httptools) per CPU.
+
+The app is imported once by the gunicorn master and the workers are forked from it (``preload_app``), so they start
+without importing anything. The database is prepared by the master before forking, rather than by every worker on
+startup, and the pool sizes are split between the workers, see ``main.db``. Ingestion jobs interrupted by the last
+shutdown are marked failed then too. The Prometheus metrics of the workers are written to
+``PROMETHEUS_MULTIPROC_DIR`` and ``/metrics`` adds them up, whichever worker serves it.
+
+Configuration:
+- ``WEB_CONCURRENCY`` (default: CPUs available to the process): worker processes.
+- ``HOST`` (default 0.0.0.0) and ``PORT`` (default 8000): address to listen on.
+- ``RUN_MIGRATIONS_ON_STARTUP`` (default true): prepare the database before starting the workers. Turn it off when
+  migrations are run as a separate release step (``make migrate``).
+- ``PROMETHEUS_MULTIPROC_DIR`` (default: a new directory in ``/dev/shm``): where the workers write their metrics.
+  Its files are removed on startup.
+- ``GUNICORN_CMD_ARGS``: any other gunicorn setting, e.g. ``--timeout 60 --max-requests 10000``.
+
+Usage:
+    python -m main.server
+"""
+
+from glob import glob
+import logging
+import os
+import shlex
+import tempfile
+from time import perf_counter
+from typing import Any, Dict
+
+from gunicorn.app.base import BaseApplication
+
+logger = logging.getLogger("gunicorn.error")
+
+
+def available_cpus() -> int:
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:  # pragma: no cover, not on Linux
+        return os.cpu_count() or 1
+
+
+def prepare_metrics_dir() -> str:
+    """
+    Set up ``PROMETHEUS_MULTIPROC_DIR``, emptied of the metrics of a previous run. Must be called before
+    ``prometheus_client`` is imported.
+    """
+    path = os.environ.get("PROMETHEUS_MULTIPROC_DIR") or tempfile.mkdtemp(
+        prefix="prometheus-", dir="/dev/shm" if os.path.isdir("/dev/shm") else None
+    )
+    os.makedirs(path, exist_ok=True)
+    for stale in glob(os.path.join(path, "*.db")):
+        os.remove(stale)
+    os.environ["PROMETHEUS_MULTIPROC_DIR"] = path
+    return path
+
+
+def post_fork(server: Any, worker: Any) -> None:
+    """
+    Give the worker its own connections and ingestion pool. Pooled connections inherited from the master are dropped
+    without closing them, as they belong to the master, and the ingestion pool queues must not be shared.
+    """
+    from main.db import async_engine, engine, replica_engines
+    from main.entrypoint import api
+    from main.ingest import create_ingest_pool
+
+    for sync_engine in (engine, async_engine.sync_engine, *(replica.sync_engine for replica in replica_engines)):
+        sync_engine.dispose(close=False)
+    api.state.ingest_pool = create_ingest_pool()
+
+
+def child_exit(server: Any, worker: Any) -> None:
+    """
+    Drop the gauges of a dead worker from ``/metrics``.
+    """
+    from prometheus_client import multiprocess
+
+    multiprocess.mark_process_dead(worker.pid)
+
+
+class Server(BaseApplication):
+    def __init__(self, options: Dict[str, Any]) -> None:
+        self.options = options
+        super().__init__()
+
+    def load_config(self) -> None:
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+        args = self.cfg.parser().parse_args(shlex.split(os.environ.get("GUNICORN_CMD_ARGS", "")))
+        for key, value in vars(args).items():
+            if value is not None and key in self.cfg.settings:
+                self.cfg.set(key, value)
+
+    def load(self) -> Any:
+        start = perf_counter()
+        from main.entrypoint import api
+
+        logger.info("Loaded the app in %.2f s", perf_counter() - start)
+        return api
+
+
+def main() -> None:
+    workers = int(os.environ.get("WEB_CONCURRENCY") or available_cpus())
+    run_migrations = os.environ.get("RUN_MIGRATIONS_ON_STARTUP", "true").lower() in ("1", "true", "yes")
+    # Read by main.db on import: split the pools between the workers, and don't prepare the database once per worker
+    os.environ["WEB_CONCURRENCY"] = str(workers)
+    os.environ["RUN_MIGRATIONS_ON_STARTUP"] = "false"
+    prepare_metrics_dir()
+    # Until gunicorn sets up its own handlers, in the same format
+    logging.basicConfig(
+        format="[%(asctime)s] [%(process)d] [%(levelname)s] %(message)s", datefmt="%Y-%m-%d %H:%M:%S %z"
+    )
+    logger.setLevel(logging.INFO)
+
+    from main.db import clean_up_interrupted_jobs, engine, prepare_database
+
+    if run_migrations:
+        start = perf_counter()
+        prepare_database()
+        logger.info("Prepared the database in %.2f s", perf_counter() - start)
+    else:
+        clean_up_interrupted_jobs()  # Here rather than in the workers, which would fail the jobs of each other
+    engine.dispose()
+    # The pool gauges of the master are stale once its engine is disposed: only the workers' are reported
+    from prometheus_client import multiprocess
+
+    multiprocess.mark_process_dead(os.getpid())
+
+    Server(
+        {
+            "bind": f"{os.environ.get('HOST', '0.0.0.0')}:{os.environ.get('PORT', 8000)}",
+            "workers": workers,
+            "worker_class": "uvicorn.workers.UvicornWorker",
+            "preload_app": True,
+            "post_fork": post_fork,
+            "child_exit": child_exit,
+            # Heartbeats of the workers, kept off the container's overlay filesystem
+            "worker_tmp_dir": "/dev/shm" if os.path.isdir("/dev/shm") else None,
+            "keepalive": 5,
+            "accesslog": "-",
+        }
+    ).run()
+
+
+if __name__ == "__main__":
+    main()
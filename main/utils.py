@@ -1,8 +1,82 @@
 # -*-coding:utf8-*-
-from typing import BinaryIO, Dict, Iterator
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from codecs import getincrementaldecoder
+import csv
+from datetime import date
+from io import StringIO
+from itertools import groupby, islice
+import json
+from math import sqrt
+from operator import itemgetter
+from typing import (
+    Any,
+    BinaryIO,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Mapping,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Tuple,
+    TypeVar,
+)
 
 from main.db.queries import ParkEnergyReadingsRow
 
+T = TypeVar("T")
+
+UPLOAD_CHUNK_SIZE = 64 * 1024
+UPLOAD_BATCH_SIZE = 5000
+
+
+class PartialStats(NamedTuple):
+    """
+    Mergeable aggregate of a set of readings.
+    """
+
+    min: float
+    max: float
+    sum: float
+    sum_squares: float
+    count: int
+
+    def __add__(self, other: "PartialStats") -> "PartialStats":  # type:ignore[override]
+        return PartialStats(
+            min=min(self.min, other.min),
+            max=max(self.max, other.max),
+            sum=self.sum + other.sum,
+            sum_squares=self.sum_squares + other.sum_squares,
+            count=self.count + other.count,
+        )
+
+    def as_stats(self) -> Dict[str, Any]:
+        """
+        Stats as returned by the API, with the sample standard deviation.
+        """
+        stddev = None
+        if self.count > 1:
+            stddev = sqrt(max((self.sum_squares - self.sum * self.sum / self.count) / (self.count - 1), 0))
+        stats = {"min": self.min, "max": self.max, "sum": self.sum, "count": self.count}
+        return {**stats, "avg": self.sum / self.count, "stddev": stddev}
+
+
+def merge_partials(rows: Iterable[Mapping[str, Any]], key: Optional[str] = None) -> List[Dict[str, Any]]:
+    """
+    Merge per (park, bucket) partial aggregates by ``key`` and bucket, or by bucket only, sorted the same way.
+    """
+    merged: Dict[Tuple, PartialStats] = {}
+    for row in rows:
+        group = (row[key] if key else "", row["bucket"])
+        partial = PartialStats(row["min"], row["max"], row["sum"], row["sum_squares"], row["count"])
+        merged[group] = merged[group] + partial if group in merged else partial
+    return [
+        {**({key: value} if key else {}), "date": bucket.date(), "bucket": bucket, **partial.as_stats()}
+        for (value, bucket), partial in sorted(merged.items())
+    ]
+
 
 def pack(d: Dict, i: ParkEnergyReadingsRow) -> Dict:
     """
@@ -21,9 +95,87 @@ def pack(d: Dict, i: ParkEnergyReadingsRow) -> Dict:
     return d
 
 
-def gen_upload_file_as_string(binary_io: BinaryIO, encoding: str = "utf8") -> Iterator[str]:
+def group_readings(rows: Iterable[Sequence]) -> List[Dict[str, Any]]:
+    """
+    Group readings rows sorted by park into the ``List[Park]`` response shape, in one pass.
+
+    Rows are ``(name, timezone, energy_type, megawatts, timestamp)`` tuples, as ``ParkEnergyReadingsRow``.
+    """
+    return [
+        {
+            "name": name,
+            "timezone": timezone,
+            "energy_type": energy_type,
+            "energy_readings": [{"megawatts": row[3], "timestamp": row[4]} for row in readings],
+        }
+        for (name, timezone, energy_type), readings in groupby(rows, key=itemgetter(0, 1, 2))
+    ]
+
+
+def gen_upload_file_as_string(
+    binary_io: BinaryIO, encoding: str = "utf8", chunk_size: int = UPLOAD_CHUNK_SIZE
+) -> Iterator[str]:
+    """
+    Yield lines for storage.
+
+    The file is read in fixed-size chunks and decoded incrementally, so multi-byte characters and lines split
+    across chunk boundaries are stitched back together while memory stays flat regardless of the file size.
+    """
+    decoder = getincrementaldecoder(encoding)()
+    pending = ""
+    while chunk := binary_io.read(chunk_size):
+        *lines, pending = (pending + decoder.decode(chunk)).split("\n")
+        for line in lines:
+            yield line + "\n"
+    pending += decoder.decode(b"", final=True)
+    if pending:
+        yield pending
+
+
+def gen_batches(iterable: Iterable[T], size: int = UPLOAD_BATCH_SIZE) -> Iterator[List[T]]:
+    """
+    Yield lists of at most ``size`` items, consuming the iterable lazily.
+    """
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+def encode_cursor(*values: Any) -> str:
+    """
+    Opaque pagination token for the sort key of the last row of a page.
+    """
+    payload = json.dumps(values, default=lambda v: v.isoformat() if isinstance(v, date) else str(v))
+    return urlsafe_b64encode(payload.encode()).decode()
+
+
+def decode_cursor(cursor: str, *parsers: Callable[[Any], Any]) -> Tuple:
+    """
+    Inverse of ``encode_cursor``, parsing each value of the sort key.
+
+    Raises:
+        ValueError: if the cursor is malformed.
+    """
+    values = json.loads(urlsafe_b64decode(cursor.encode()))
+    if not isinstance(values, list) or len(values) != len(parsers):
+        raise ValueError(f"Invalid cursor: {cursor}")
+    return tuple(parse(value) for parse, value in zip(parsers, values))
+
+
+def rows_as_ndjson(rows: Iterable[Sequence], fields: Sequence[str]) -> str:
+    """
+    Serialize rows as newline delimited JSON objects.
+    """
+    return "".join(json.dumps(dict(zip(fields, row)), default=lambda v: v.isoformat()) + "\n" for row in rows)
+
+
+def rows_as_csv(rows: Iterable[Sequence], header: Optional[Sequence[str]] = None) -> str:
     """
-    Yield lines for storage
+    Serialize rows as CSV lines, optionally preceded by a header.
     """
-    for line in binary_io.readlines():
-        yield line.decode(encoding)
+    buffer = StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    if header:
+        writer.writerow(header)
+    writer.writerows(rows)
+    return buffer.getvalue()
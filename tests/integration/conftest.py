@@ -6,13 +6,16 @@ import pytest
 from fastapi import FastAPI
 from fastapi.testclient import TestClient
 from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import AsyncEngine, async_sessionmaker, create_async_engine
 from sqlalchemy.orm import Session
+from sqlalchemy.pool import NullPool
 from starlette.routing import Route
 from testcontainers.postgres import PostgresContainer
 
 from main import start_api
 from main.constraints import EnergyType, ParkName, Timezone
-from main.db import get_session
+from main.db import get_async_session, get_engine, get_read_session, get_read_sessionmaker, get_session
+from main.db.bulk import refresh_energy_readings_daily
 from main.db.models import Base, EnergyReadingRow, MeasurementRow, ParkRow, StationRow
 
 
@@ -87,10 +90,26 @@ def session(park_data: List[ParkRow], stations_data: List[StationRow]) -> Iterat
         with Session(engine, future=True) as session:
             session.add_all(park_data)
             session.add_all(stations_data)
+            session.flush()
+            refresh_energy_readings_daily(session)
             session.commit()
             yield session
 
 
+@pytest.fixture(scope="session")
+def replica_db_url() -> Iterator[str]:
+    """
+    Start a second containerized database, standing in for a read replica, and yield its async URL
+    """
+    with PostgresContainer(
+        user=os.environ.get("POSTGRES_USER", "test"),
+        password=os.environ.get("POSTGRES_PASSWORD", "test"),
+        dbname=os.environ.get("POSTGRES_DB", "test"),
+        driver="asyncpg",
+    ) as postgres:
+        yield postgres.get_connection_url()
+
+
 @pytest.fixture
 def api() -> FastAPI:
     return start_api()
@@ -104,8 +123,28 @@ def routes() -> List[str]:
 
 
 @pytest.fixture
-def client(session: Session, api: FastAPI) -> Iterator[TestClient]:
+def async_engine(session: Session) -> AsyncEngine:
+    """
+    Async engine for the same containerized database. Connections are not pooled because every TestClient runs its
+    own event loop.
+    """
+    url = session.get_bind().url.set(drivername="postgresql+asyncpg")
+    return create_async_engine(url, poolclass=NullPool)
+
+
+@pytest.fixture
+def client(session: Session, async_engine: AsyncEngine, api: FastAPI) -> Iterator[TestClient]:
+    sessionmaker = async_sessionmaker(async_engine, expire_on_commit=False)
+
+    async def get_test_async_session():
+        async with sessionmaker() as async_session:
+            yield async_session
+
     api.dependency_overrides[get_session] = lambda: session
+    api.dependency_overrides[get_engine] = lambda: session.get_bind()
+    api.dependency_overrides[get_async_session] = get_test_async_session
+    api.dependency_overrides[get_read_session] = get_test_async_session
+    api.dependency_overrides[get_read_sessionmaker] = lambda: sessionmaker
     client = TestClient(api)
     yield client
     api.dependency_overrides.clear()
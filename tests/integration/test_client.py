@@ -1,8 +1,13 @@
+import json
+import time
+import zipfile
+from io import BytesIO
 from tempfile import SpooledTemporaryFile
 from typing import List
 
 import pytest
 from fastapi.testclient import TestClient
+from sqlalchemy.orm import Session
 
 from main.constraints import ParkName
 
@@ -59,7 +64,7 @@ def test_upload_wrong_filename_returns_error_response(client: TestClient, dummy_
 def test_empty_file_upserts_no_park_rows(client: TestClient, empty_file):
     response = client.post("/admin/parks/upload", files=[("upload_file", empty_file)])
     assert response.is_success
-    assert response.text == '{"message":"0 rows successfully inserted/updated"}'
+    assert response.json()["message"] == "0 rows successfully inserted/updated"
 
 
 def test_empty_file_upserts_no_energy_reading_rows(client: TestClient, empty_file):
@@ -69,13 +74,13 @@ def test_empty_file_upserts_no_energy_reading_rows(client: TestClient, empty_fil
         files=[("upload_file", empty_file)],
     )
     assert response.is_success
-    assert response.text == '{"message":"0 rows successfully inserted/updated"}'
+    assert response.json()["message"] == "0 rows successfully inserted/updated"
 
 
 def test_dummy_park_data(client: TestClient, dummy_park_file):
     response = client.post("/admin/parks/upload", files=[("upload_file", dummy_park_file)])
     assert response.is_success
-    assert response.text == '{"message":"1 rows successfully inserted/updated"}'
+    assert response.json()["message"] == "1 rows successfully inserted/updated"
 
 
 def test_dummy_energy_readings_data(client: TestClient, dummy_energy_readings_file):
@@ -85,4 +90,426 @@ def test_dummy_energy_readings_data(client: TestClient, dummy_energy_readings_fi
         files=[("upload_file", dummy_energy_readings_file)],
     )
     assert response.is_success
-    assert response.text == '{"message":"1 rows successfully inserted/updated"}'
+    assert response.json()["message"] == "1 rows successfully inserted/updated"
+    assert response.json()["rows_per_second"] > 0
+
+
+def test_reuploaded_energy_readings_are_upserted(client: TestClient):
+    def upload(content: str):
+        response = client.post(
+            "/admin/energy-readings/upload",
+            params={"park_name": ParkName.stadskanaal.value},
+            files=[("upload_file", ("readings.csv", content.encode()))],
+        )
+        assert response.is_success
+        return {key: response.json()[key] for key in ("inserted", "updated", "unchanged")}
+
+    header = "datetime,MW\n"
+    assert upload(header + "2021-01-01 00:00:00,1.0\n2021-01-01 00:15:00,2.0") == {
+        "inserted": 2,
+        "updated": 0,
+        "unchanged": 0,
+    }
+    assert upload(header + "2021-01-01 00:00:00,1.0\n2021-01-01 00:15:00,3.0\n2021-01-01 00:30:00,4.0") == {
+        "inserted": 1,
+        "updated": 1,
+        "unchanged": 1,
+    }
+
+
+def test_park_stats_follow_uploaded_readings(client: TestClient):
+    def upload(content: str):
+        response = client.post(
+            "/admin/energy-readings/upload",
+            params={"park_name": ParkName.netterden.value},
+            files=[("upload_file", ("readings.csv", content.encode()))],
+        )
+        assert response.is_success
+
+    def stats():
+        params = {"park_names": ParkName.netterden.value, "start_date": "2022-05-05", "end_date": "2022-05-05"}
+        rows = client.get("/stats/parks", params=params).json()
+        return [{key: row[key] for key in ("min", "max", "sum", "count")} for row in rows]
+
+    upload("datetime,MW\n2022-05-05 00:00:00,1.0\n2022-05-05 23:45:00,2.0\n2022-05-06 00:00:00,5.0")
+    assert stats() == [{"min": 1.0, "max": 2.0, "sum": 3.0, "count": 2}]
+
+    upload("datetime,MW\n2022-05-05 12:00:00,4.0")
+    assert stats() == [{"min": 1.0, "max": 4.0, "sum": 7.0, "count": 3}]
+
+
+def test_energy_readings_cursor_pagination_visits_every_reading_once(client: TestClient):
+    content = "datetime,MW\n" + "\n".join(f"2023-01-01 {hour:02d}:00:00,{hour}" for hour in range(5))
+    client.post(
+        "/admin/energy-readings/upload",
+        params={"park_name": ParkName.netterden.value},
+        files=[("upload_file", ("readings.csv", content.encode()))],
+    )
+
+    params = {"park_names": ParkName.netterden.value, "start_date": "2023-01-01", "end_date": "2023-01-02", "limit": 2}
+    megawatts = []
+    while True:
+        response = client.get("/parks/energy-readings", params=params)
+        assert response.is_success
+        megawatts += [reading["megawatts"] for park in response.json() for reading in park["energy_readings"]]
+        if "X-Next-Cursor" not in response.headers:
+            break
+        params["cursor"] = response.headers["X-Next-Cursor"]
+    assert megawatts == [0.0, 1.0, 2.0, 3.0, 4.0]
+
+
+def test_invalid_cursor_returns_HTTP_400_BAD_REQUEST(client: TestClient):
+    response = client.get("/stats/parks", params={"cursor": "foo"})
+    assert response.status_code == 400
+
+
+def test_export_streams_energy_readings_as_ndjson_and_csv(client: TestClient):
+    content = "datetime,MW\n2024-02-02 00:00:00,1\n2024-02-02 00:15:00,2\n2024-02-02 00:30:00,3"
+    client.post(
+        "/admin/energy-readings/upload",
+        params={"park_name": ParkName.stadskanaal.value},
+        files=[("upload_file", ("readings.csv", content.encode()))],
+    )
+    params = {"park_names": ParkName.stadskanaal.value, "start_date": "2024-02-02", "end_date": "2024-02-03"}
+
+    response = client.get("/parks/energy-readings/export", params=params)
+    assert response.is_success
+    assert response.headers["content-type"] == "application/x-ndjson"
+    rows = [json.loads(line) for line in response.text.splitlines()]
+    assert [row["timestamp"] for row in rows] == ["2024-02-02T00:00:00", "2024-02-02T00:15:00", "2024-02-02T00:30:00"]
+
+    response = client.get("/parks/energy-readings/export", params={**params, "format": "csv"})
+    assert response.is_success
+    lines = response.text.splitlines()
+    assert lines[0] == "name,timezone,energy_type,megawatts,timestamp"
+    assert len(lines) == 1 + len(rows)
+
+
+@pytest.mark.parametrize("media_type", ["application/vnd.apache.arrow.stream", "application/x-parquet"])
+def test_readings_export_and_stats_negotiate_arrow_formats(client: TestClient, media_type: str):
+    pa = pytest.importorskip("pyarrow")
+    import pyarrow.ipc  # noqa: F401
+    import pyarrow.parquet  # noqa: F401
+
+    def read_table(content: bytes):
+        if media_type == "application/x-parquet":
+            return pa.parquet.read_table(pa.BufferReader(content))
+        return pa.ipc.open_stream(content).read_all()
+
+    content = "datetime,MW\n2024-03-03 00:00:00,1\n2024-03-03 00:15:00,2\n2024-03-03 00:30:00,4"
+    client.post(
+        "/admin/energy-readings/upload",
+        params={"park_name": ParkName.stadskanaal.value},
+        files=[("upload_file", ("readings.csv", content.encode()))],
+    )
+    params = {"park_names": ParkName.stadskanaal.value, "start_date": "2024-03-03", "end_date": "2024-03-04"}
+    headers = {"Accept": media_type}
+
+    response = client.get("/parks/energy-readings", params={**params, "limit": 2}, headers=headers)
+    assert response.headers["content-type"] == media_type
+    table = read_table(response.content)
+    assert table.column("megawatts").to_pylist() == [1.0, 2.0]
+    assert table.column_names == ["name", "timezone", "energy_type", "megawatts", "timestamp"]
+    assert "X-Next-Cursor" in response.headers
+
+    response = client.get("/parks/energy-readings/export", params=params, headers=headers)
+    assert response.headers["content-type"] == media_type
+    exported = read_table(response.content)
+    assert exported.column("megawatts").to_pylist() == [1.0, 2.0, 4.0]
+
+    response = client.get("/stats/parks", params=params, headers=headers)
+    assert response.headers["content-type"] == media_type
+    stats = read_table(response.content).to_pylist()
+    expected = client.get("/stats/parks", params=params).json()
+    assert [(row["count"], row["sum"]) for row in stats] == [(row["count"], row["sum"]) for row in expected] == [(3, 7)]
+
+
+def test_dropping_a_month_detaches_its_partition(client: TestClient):
+    content = "datetime,MW\n2019-01-31 12:00:00,1\n2019-02-01 12:00:00,2\n2019-02-28 23:45:00,3"
+    client.post(
+        "/admin/energy-readings/upload",
+        params={"park_name": ParkName.stadskanaal.value},
+        files=[("upload_file", ("readings.csv", content.encode()))],
+    )
+    partitions = [partition["name"] for partition in client.get("/admin/energy-readings/partitions").json()]
+    assert {"energy_readings_2019_01", "energy_readings_2019_02"} <= set(partitions)
+
+    response = client.delete("/admin/energy-readings/partitions/2019-02-15")
+    assert response.is_success
+    assert client.delete("/admin/energy-readings/partitions/2019-02-15").status_code == 404
+
+    params = {"park_names": ParkName.stadskanaal.value, "start_date": "2019-01-01", "end_date": "2019-03-31"}
+    readings = client.get("/parks/energy-readings", params=params).json()
+    assert [reading["megawatts"] for park in readings for reading in park["energy_readings"]] == [1]
+    # Stadskanaal is in Bucharest: the last reading of February fell on March 1st, local time
+    stats = client.get("/stats/parks", params={**params, "tz_mode": "local"}).json()
+    assert [(row["date"], row["count"]) for row in stats] == [("2019-01-31", 1)]
+
+
+def test_batch_upload_loads_files_and_zip_archives_in_parallel(client: TestClient):
+    archive = BytesIO()
+    with zipfile.ZipFile(archive, "w") as zf:
+        zf.writestr("Stadskanaal.csv", "datetime,MW\n2018-06-01 00:00:00,3\n2018-07-01 00:00:00,4")
+        zf.writestr("Atlantis.csv", "datetime,MW\n2018-06-01 00:00:00,5")
+    files = [
+        ("upload_files", ("Netterden.csv", b"datetime,MW\n2018-06-01 00:00:00,1\n2018-06-01 00:15:00,2")),
+        ("upload_files", ("readings.zip", archive.getvalue())),
+        ("upload_files", ("netterden.csv", b"timestamp,MW\n2018-06-02 00:00:00,1")),
+    ]
+
+    response = client.post("/admin/energy-readings/batch-upload", files=files)
+    assert response.is_success
+    statuses = [(file["filename"], file["status"], file.get("inserted")) for file in response.json()["files"]]
+    assert statuses == [
+        ("Netterden.csv", "ok", 2),
+        ("Stadskanaal.csv", "ok", 2),
+        ("Atlantis.csv", "error", None),
+        ("netterden.csv", "error", None),
+    ]
+
+    params = {"start_date": "2018-06-01", "end_date": "2018-07-31"}
+    stats = client.get("/stats/parks", params={**params, "bucket": "month"}).json()
+    assert [(row["name"], row["date"], row["count"]) for row in stats] == [
+        ("Netterden", "2018-06-01", 2),
+        ("Stadskanaal", "2018-06-01", 1),
+        ("Stadskanaal", "2018-07-01", 1),
+    ]
+
+
+def test_upload_jobs_run_in_the_background_and_report_progress(client: TestClient):
+    files = [
+        ("upload_files", ("Bemmel.csv", b"datetime,MW\n2017-03-01 00:00:00,1\n2017-03-01 00:15:00,2")),
+        ("upload_files", ("bad.csv", b"timestamp,MW\n2017-03-01 00:00:00,1")),
+        ("upload_files", ("unknown.txt", b"")),
+    ]
+    response = client.post(
+        "/admin/jobs/energy-readings", params={"park_name": ParkName.netterden.value}, files=files[:2]
+    )
+    assert response.status_code == 202
+    jobs = response.json()["jobs"]
+    assert [job["park_name"] for job in jobs] == ["Netterden", "Netterden"]
+    response = client.post("/admin/jobs/energy-readings", files=files[2:])
+    assert response.json()["jobs"][0]["job_id"] is None
+
+    def wait(job_id: str) -> dict:
+        deadline = time.monotonic() + 60
+        while (job := client.get(f"/admin/jobs/{job_id}").json())["status"] in ("queued", "running"):
+            assert time.monotonic() < deadline
+            time.sleep(0.1)
+        return job
+
+    loaded, failed = (wait(job["job_id"]) for job in jobs)
+    assert loaded["status"] == "succeeded"
+    assert (loaded["inserted"], loaded["rows_processed"], loaded["progress"]) == (2, 2, 1.0)
+    assert loaded["eta_seconds"] is None
+    assert failed["status"] == "failed"
+    assert failed["error"] == "Invalid row format. Upload aborted."
+
+    assert client.get("/admin/jobs/00000000-0000-0000-0000-000000000000").status_code == 404
+
+
+def test_reuploaded_stations_are_upserted_by_code(client: TestClient):
+    def upload(content: str):
+        response = client.post("/admin/stations/upload", files=[("upload_file", ("stations.csv", content.encode()))])
+        assert response.is_success, response.text
+        return {key: response.json()[key] for key in ("inserted", "updated", "unchanged")}
+
+    header = "code,name,province,latitude,longitude,altitude\n"
+    rows = "0002I,VANDELLOS,TARRAGONA,405951N,005216E,32\n0003X,ALMERIA,ALMERIA,365100N,022124W,21\n"
+    assert upload(header + rows) == {"inserted": 2, "updated": 0, "unchanged": 0}
+    assert upload(header + rows.replace(",32", ",33")) == {"inserted": 0, "updated": 1, "unchanged": 1}
+    assert upload(header + rows + rows) == {"inserted": 0, "updated": 1, "unchanged": 1}  # Codes are counted once
+    assert upload(header + rows.replace(",32", ",33")) == {"inserted": 0, "updated": 1, "unchanged": 1}
+    stations = client.get("/stations", params={"codes": ["0002I", "0003X"]}).json()
+    assert [(station["code"], station["altitude"]) for station in stations] == [("0002I", "33"), ("0003X", "21")]
+
+
+def test_measurements_of_many_stations_are_loaded_in_one_upload(client: TestClient, session: Session):
+    def upload(content: str, **params: str):
+        response = client.post(
+            "/admin/measurements/upload", params=params, files=[("upload_file", ("aemet.csv", content.encode()))]
+        )
+        assert response.is_success, response.text
+        return {key: response.json()[key] for key in ("inserted", "updated", "unchanged")}
+
+    header = "FECHA;INDICATIVO;NOMBRE;PROVINCIA;ALTITUD;TMEDIA;PRECIPITACION;TMIN;HORATMIN;TMAX;HORATMAX;DIR\n"
+    rows = "1968-03-01;0000;A;foo;32;8,9;Ip;6,6;03:00;11,2;18:00;05\n1968-03-01;0001;B;foo;10;;;;;;;99\n"
+    assert upload(header + rows) == {"inserted": 2, "updated": 0, "unchanged": 0}
+    assert upload(header + rows.replace("8,9", "9,0")) == {"inserted": 0, "updated": 1, "unchanged": 1}
+    assert upload(header + "1968-03-02;;;;;1;;;;;;\n", station_code="0000") == {
+        "inserted": 1,
+        "updated": 0,
+        "unchanged": 0,
+    }
+
+    response = client.post(
+        "/admin/measurements/upload", files=[("upload_file", ("aemet.csv", (header + "1968-03-01;9999X").encode()))]
+    )
+    assert response.status_code == 404
+    session.rollback()  # The session is shared by the tests, the failed upload left its transaction aborted
+
+
+def test_park_production_is_correlated_with_the_weather_of_its_station(client: TestClient):
+    readings = "datetime,MW\n" + "\n".join(f"2016-08-0{day} 12:00:00,{day}" for day in range(1, 5))
+    response = client.post(
+        "/admin/energy-readings/upload",
+        params={"park_name": ParkName.netterden.value},
+        files=[("upload_file", ("readings.csv", readings.encode()))],
+    )
+    assert response.is_success
+    measurements = "FECHA;INDICATIVO;TMEDIA;SOL\n" + "\n".join(
+        f"2016-08-0{day};0001;{day}0;{5 - day}" for day in range(1, 5)
+    )
+    response = client.post("/admin/measurements/upload", files=[("upload_file", ("aemet.csv", measurements.encode()))])
+    assert response.is_success
+
+    params = {"park_names": ParkName.netterden.value, "start_date": "2016-08-01", "end_date": "2016-08-31"}
+    assert client.get("/stats/parks/weather", params=params).json() == []  # No station yet
+    assert client.put("/admin/parks/Netterden/station", params={"station_code": "9999X"}).status_code == 404
+    assert client.put("/admin/parks/Netterden/station", params={"station_code": "0001"}).is_success
+
+    [correlation] = client.get("/stats/parks/weather", params=params).json()
+    assert (correlation["name"], correlation["station_code"], correlation["days"]) == ("Netterden", "0001", 4)
+    assert correlation["temperature_correlation"] == pytest.approx(1.0)
+    assert correlation["temperature_slope"] == pytest.approx(0.1)
+    assert correlation["sunshine_correlation"] == pytest.approx(-1.0)
+    assert correlation["wind_speed_correlation"] is None
+
+    assert [station["code"] for station in client.get("/stations", params={"codes": "0001"}).json()] == ["0001"]
+    params = {"station_codes": "0001", "start_date": "2016-08-01", "end_date": "2016-08-31", "limit": 3}
+    response = client.get("/stations/measurements", params=params)
+    days = [(row["date"], row["avg_temp"]) for row in response.json()]
+    response = client.get("/stations/measurements", params={**params, "cursor": response.headers["X-Next-Cursor"]})
+    days += [(row["date"], row["avg_temp"]) for row in response.json()]
+    assert days == [("2016-08-01", 10.0), ("2016-08-02", 20.0), ("2016-08-03", 30.0), ("2016-08-04", 40.0)]
+    assert "X-Next-Cursor" not in response.headers
+
+
+def test_repeated_reads_are_served_from_cache_until_an_upload(client: TestClient):
+    params = {"park_names": ParkName.netterden.value, "start_date": "2025-06-01", "end_date": "2025-06-01"}
+
+    response = client.get("/stats/parks", params=params)
+    assert response.headers["X-Cache"] == "MISS"
+    assert response.json() == []
+    etag = response.headers["ETag"]
+    assert etag.startswith('W/"')  # The client accepts gzip
+
+    response = client.get("/stats/parks", params=params, headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.headers["X-Cache"] == "HIT"
+    assert response.headers["ETag"] == etag
+
+    client.post(
+        "/admin/energy-readings/upload",
+        params={"park_name": ParkName.netterden.value},
+        files=[("upload_file", ("readings.csv", b"datetime,MW\n2025-06-01 12:00:00,1.0"))],
+    )
+    response = client.get("/stats/parks", params=params, headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["X-Cache"] == "MISS"
+    assert response.headers["ETag"] != etag
+    assert len(response.json()) == 1
+
+
+def test_local_tz_mode_cuts_days_in_the_park_timezone(client: TestClient):
+    # Stadskanaal is in Europe/Bucharest, UTC+3 in summer
+    client.post(
+        "/admin/energy-readings/upload",
+        params={"park_name": ParkName.stadskanaal.value},
+        files=[("upload_file", ("readings.csv", b"datetime,MW\n2022-07-10 20:30:00,1.0\n2022-07-10 21:30:00,2.0"))],
+    )
+
+    def days(tz_mode: str):
+        params = {
+            "park_names": ParkName.stadskanaal.value,
+            "start_date": "2022-07-10",
+            "end_date": "2022-07-11",
+            "tz_mode": tz_mode,
+        }
+        return [(row["date"], row["count"]) for row in client.get("/stats/parks", params=params).json()]
+
+    assert days("utc") == [("2022-07-10", 2)]
+    assert days("local") == [("2022-07-10", 1), ("2022-07-11", 1)]
+
+    def move(timezone: str):
+        content = f"park_name,timezone,energy_type\n{ParkName.stadskanaal.value},{timezone},Solar\n"
+        response = client.post("/admin/parks/upload", files=[("upload_file", ("parks.csv", content.encode()))])
+        assert response.json()["updated"] == 1
+
+    move("UTC")
+    assert days("local") == [("2022-07-10", 2)]
+    move("Europe/Bucharest")
+    assert days("local") == [("2022-07-10", 1), ("2022-07-11", 1)]
+
+
+def test_stats_are_aggregated_by_bucket(client: TestClient):
+    readings = [
+        f"2021-{month:02d}-01 {hour:02d}:{minute:02d}:00,{hour}"
+        for month in (5, 6)
+        for hour in (0, 1)
+        for minute in (0, 30)
+    ]
+    client.post(
+        "/admin/energy-readings/upload",
+        params={"park_name": ParkName.netterden.value},
+        files=[("upload_file", ("readings.csv", ("datetime,MW\n" + "\n".join(readings)).encode()))],
+    )
+
+    def stats(**params):
+        params = {
+            "park_names": ParkName.netterden.value,
+            "start_date": "2021-01-01",
+            "end_date": "2021-12-31",
+            **params,
+        }
+        response = client.get("/stats/parks", params=params)
+        assert response.is_success
+        return response.json()
+
+    monthly = stats(bucket="month")
+    assert [(row["bucket"], row["count"], row["avg"]) for row in monthly] == [
+        ("2021-05-01T00:00:00", 4, 0.5),
+        ("2021-06-01T00:00:00", 4, 0.5),
+    ]
+    assert monthly[0]["stddev"] == pytest.approx(0.57735, rel=1e-4)
+
+    hourly = stats(bucket="hour", end_date="2021-05-31", percentiles=True)
+    assert [(row["bucket"], row["count"], row["p50"]) for row in hourly] == [
+        ("2021-05-01T00:00:00", 2, 0.0),
+        ("2021-05-01T01:00:00", 2, 1.0),
+    ]
+    assert stats(bucket="15min", tz_mode="local", end_date="2021-05-31")[0]["bucket"] == "2021-05-01T02:00:00"
+
+    client.post(
+        "/admin/energy-readings/upload",
+        params={"park_name": ParkName.netterden.value},
+        files=[("upload_file", ("readings.csv", b"datetime,MW\n2021-07-01 00:00:00,3"))],
+    )
+    single = {"start_date": "2021-07-01", "end_date": "2021-07-01"}
+    for bucket in ("day", "hour"):  # From the daily rollup, and from the raw readings
+        [row] = stats(bucket=bucket, **single)
+        assert (row["count"], row["stddev"]) == (1, None)
+
+
+def test_stats_views_match_the_stats_endpoints(client: TestClient):
+    params = {"start_date": "2021-01-01", "end_date": "2022-12-31", "bucket": "month"}
+
+    response = client.get("/stats", params={**params, "views": ["parks", "energy_types", "all"]})
+    assert response.is_success
+    views = response.json()
+    assert "timezones" not in views
+
+    for view, path in (("parks", "/stats/parks"), ("energy_types", "/stats/energy_types")):
+        expected = client.get(path, params=params).json()
+        assert [row["count"] for row in views[view]] == [row["count"] for row in expected]
+        assert [row["avg"] for row in views[view]] == pytest.approx([row["avg"] for row in expected])
+    assert sum(row["count"] for row in views["all"]) == sum(row["count"] for row in views["parks"])
+
+
+def test_route_query_and_serialization_timings_are_exported(client: TestClient):
+    response = client.get("/stats/parks", params={"start_date": "1999-01-01", "end_date": "1999-01-02"})
+    assert response.is_success
+
+    metrics = client.get("/metrics").text
+    for stage in ("query", "serialize"):
+        assert f'request_stage_duration_seconds_count{{route="/stats/parks",stage="{stage}"}}' in metrics
@@ -1,10 +1,29 @@
 """
 Since we're using PostgreSQL as our Database, only integration tests can be done.
 """
+import asyncio
+from datetime import date, timedelta
 from functools import reduce
+from uuid import uuid4
 
+from prometheus_client import REGISTRY
+from sqlalchemy import create_engine, literal_column, select, text
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import NullPool
+
+from main import metrics
 from main.constraints import EnergyType, ParkName, Timezone
-from main.db.queries import select_parks_with_energy_readings
+from main.db.models import IngestionJobRow
+from main.db.partitions import (
+    Partition,
+    ensure_energy_readings_partitions,
+    list_energy_readings_partitions,
+    partition_of,
+)
+from main.db.queries import parks_with_energy_readings_stmt, select_parks_with_energy_readings
+from main.db.replicas import ReadRouter, replica_url
+from main.jobs import INTERRUPTED_JOB_ERROR, fail_interrupted_jobs
+from main.metrics import InstrumentedQueuePool, instrument_engine
 from main.utils import pack
 
 
@@ -14,9 +33,130 @@ def test_select_parks_returns_expected(session):
     energy_types = [EnergyType.wind, EnergyType.solar]
     park_names = [ParkName.netterden, ParkName.stadskanaal]
     rows = select_parks_with_energy_readings(
-        session, park_names=park_names, timezones=timezones, energy_types=energy_types, offset=0, limit=10
+        session,
+        park_names=park_names,
+        timezones=timezones,
+        energy_types=energy_types,
+        offset=0,
+        limit=10,
+        start_date=date.today(),  # NOTE: only the fixture readings, not the ones uploaded by other tests
     )
     result = reduce(pack, rows, {})  # type:ignore
     for i in result:
         print(i)
     assert len(list(result.values())) == 2
+
+
+def test_ensure_partitions_moves_readings_out_of_the_default_partition(session):
+    partition = partition_of(date.today())  # The fixture readings have no partition yet
+    try:
+        assert ensure_energy_readings_partitions(session, date.today()) == [partition]
+        assert ensure_energy_readings_partitions(session, date.today()) == []
+        tables = session.execute(
+            text("SELECT DISTINCT tableoid::regclass::text FROM energy_readings WHERE timestamp >= :start"),
+            {"start": partition.start},
+        ).scalars()
+        assert list(tables) == [partition.name]
+    finally:
+        session.rollback()
+
+
+def test_partitions_are_listed_by_their_bounds_whatever_their_name(session):
+    try:
+        session.execute(text("CREATE TABLE readings_2001_q1 (LIKE energy_readings INCLUDING DEFAULTS)"))
+        session.execute(
+            text(
+                "ALTER TABLE energy_readings ATTACH PARTITION readings_2001_q1 "
+                "FOR VALUES FROM ('2001-01-01') TO ('2001-04-01')"
+            )
+        )
+        partitions = list_energy_readings_partitions(session)
+        assert Partition("readings_2001_q1", date(2001, 1, 1), date(2001, 4, 1)) in partitions
+        assert ensure_energy_readings_partitions(session, date(2001, 2, 1), date(2001, 3, 31)) == []
+    finally:
+        session.rollback()
+
+
+def test_date_filters_prune_energy_readings_partitions(session):
+    partition = partition_of(date.today())
+    try:
+        ensure_energy_readings_partitions(session, date.today())
+        stmt = parks_with_energy_readings_stmt(
+            offset=0, limit=10, start_date=partition.start, end_date=partition.start + timedelta(days=1)
+        )
+        compiled = stmt.compile(dialect=session.get_bind().dialect)
+        plan = "\n".join(session.connection().exec_driver_sql(f"EXPLAIN {compiled}", compiled.params).scalars())
+        assert partition.name in plan
+        assert "energy_readings_default" not in plan
+    finally:
+        session.rollback()
+
+
+def test_instrumented_engine_records_queries_pool_waits_and_slow_plans(session, monkeypatch, caplog):
+    engine = create_engine(session.get_bind().url, future=True, poolclass=InstrumentedQueuePool)
+    instrument_engine(engine)
+    monkeypatch.setattr(metrics, "SLOW_QUERY_SECONDS", 1e-9)
+    monkeypatch.setattr(metrics, "SLOW_QUERY_EXPLAIN", True)
+    token = metrics.ROUTE.set("/probe")
+    try:
+        with engine.connect() as connection:
+            stmt = select(literal_column("1")).execution_options(query_name="probe")
+            assert connection.execute(stmt).scalar() == 1
+            assert connection.execute(text("SELECT 2")).scalar() == 2  # Still usable after the explain
+    finally:
+        metrics.ROUTE.reset(token)
+        engine.dispose()
+
+    assert REGISTRY.get_sample_value("db_query_rows_sum", {"route": "/probe", "query": "probe"}) == 1
+    assert REGISTRY.get_sample_value("db_query_duration_seconds_count", {"route": "/probe", "query": "probe"}) == 1
+    assert REGISTRY.get_sample_value("db_query_duration_seconds_count", {"route": "/probe", "query": "select"}) == 1
+    assert REGISTRY.get_sample_value("db_pool_checkout_wait_seconds_count", {"route": "/probe", "pool": "sync"}) == 1
+    assert "Slow query probe on /probe" in caplog.text
+    assert "actual time" in caplog.text
+
+
+def test_reads_are_routed_to_healthy_replicas_and_fall_back_to_the_primary(async_engine, replica_db_url):
+    replica = create_async_engine(replica_db_url, poolclass=NullPool)
+    unreachable = create_async_engine(replica_url(replica_db_url, "127.0.0.1:1"), poolclass=NullPool)
+    router = ReadRouter(async_engine, [replica, unreachable])
+
+    async def on_replica() -> bool:
+        async with router.session() as session:
+            return (await session.execute(text("SELECT to_regclass('replica_marker') IS NOT NULL"))).scalar()
+
+    async def run():
+        async with replica.begin() as connection:
+            await connection.execute(text("CREATE TABLE IF NOT EXISTS replica_marker ()"))
+        await router.check(timeout=5)
+        assert router.healthy == [replica]
+        assert len(router.primary_lsns) == 1
+        assert [await on_replica() for _ in range(3)] == [True, True, True]
+
+        router.set_healthy(replica, False)
+        assert router.pools() == [async_engine.pool]
+        assert not await on_replica()
+
+        await router.check(timeout=5)
+        assert await on_replica()
+
+    asyncio.run(run())
+
+
+def test_jobs_interrupted_by_a_restart_are_failed_and_their_files_removed(session, tmp_path):
+    spooled = tmp_path / "upload" / "Netterden.csv"
+    spooled.parent.mkdir()
+    spooled.write_text("datetime,MW\n")
+    job = dict(park_name="Netterden", filename="Netterden.csv", total_bytes=12)
+    interrupted = IngestionJobRow(id=uuid4(), status="running", spool_path=str(spooled), **job)
+    done = IngestionJobRow(id=uuid4(), status="succeeded", **job)
+    try:
+        session.add_all([interrupted, done])
+        session.flush()
+        assert fail_interrupted_jobs(session.connection()) >= 1
+        session.expire_all()
+        assert (interrupted.status, interrupted.error) == ("failed", INTERRUPTED_JOB_ERROR)
+        assert interrupted.finished_at is not None
+        assert (done.status, done.error) == ("succeeded", None)
+        assert not spooled.parent.exists()
+    finally:
+        session.rollback()
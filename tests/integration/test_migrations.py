@@ -0,0 +1,68 @@
+from datetime import datetime
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from main.db.migrations import MIGRATIONS, MIGRATIONS_LOCK_KEY, migrate
+
+
+def test_migrations_are_applied_once_on_an_empty_schema(session: Session):
+    with session.get_bind().connect() as connection:
+        with connection.begin() as transaction:
+            connection.execute(text("CREATE SCHEMA migrations_test"))
+            connection.execute(text("SET LOCAL search_path TO migrations_test"))
+
+            assert migrate(connection) == [migration.version for migration in MIGRATIONS]
+            assert migrate(connection) == []
+
+            indexes = connection.execute(
+                text("SELECT indexname FROM pg_indexes WHERE schemaname = 'migrations_test'")
+            ).scalars()
+            assert {"uq_energy_readings_park_name_timestamp", "ix_energy_readings_timestamp_brin"} <= set(indexes)
+            transaction.rollback()
+
+
+def test_partitioning_migration_keeps_readings_and_ids(session: Session):
+    with session.get_bind().connect() as connection:
+        with connection.begin() as transaction:
+            connection.execute(text("CREATE SCHEMA migrations_test"))
+            connection.execute(text("SET LOCAL search_path TO migrations_test"))
+            migrate(connection, target=6)
+            connection.execute(text("INSERT INTO parks VALUES ('Netterden', 'Europe/Amsterdam', 'Wind')"))
+            connection.execute(
+                text("INSERT INTO energy_readings (park_name, timestamp, megawatts) VALUES ('Netterden', :ts, 1)"),
+                [{"ts": datetime(2020, 1, 31, 23)}, {"ts": datetime(2020, 2, 1)}],
+            )
+
+            assert migrate(connection, target=7) == [7]
+            rows = connection.execute(
+                text("SELECT id, tableoid::regclass::text FROM energy_readings ORDER BY timestamp")
+            ).all()
+            assert [tuple(row) for row in rows] == [(1, "energy_readings_2020_01"), (2, "energy_readings_2020_02")]
+            new_id = connection.execute(
+                text(
+                    "INSERT INTO energy_readings (park_name, timestamp, megawatts) "
+                    "VALUES ('Netterden', now(), 1) RETURNING id"
+                )
+            ).scalar_one()
+            assert new_id == 3
+            transaction.rollback()
+
+
+def test_up_to_date_schema_is_not_locked_again(session: Session):
+    engine = session.get_bind()
+    with engine.connect() as connection, engine.connect() as other:
+        with connection.begin():
+            connection.execute(text("CREATE SCHEMA migrations_lock_test"))
+            connection.execute(text("SET LOCAL search_path TO migrations_lock_test"))
+            migrate(connection)
+        try:
+            with other.begin():  # Another process holding the lock, e.g. migrating another database
+                other.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": MIGRATIONS_LOCK_KEY})
+                with connection.begin():
+                    connection.execute(text("SET LOCAL search_path TO migrations_lock_test"))
+                    connection.execute(text("SET LOCAL lock_timeout = '100ms'"))
+                    assert migrate(connection) == []
+        finally:
+            with connection.begin():
+                connection.execute(text("DROP SCHEMA migrations_lock_test CASCADE"))
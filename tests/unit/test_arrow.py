@@ -0,0 +1,66 @@
+import asyncio
+from datetime import date, datetime
+from io import BytesIO
+
+import pytest
+
+from main.arrow import READINGS_COLUMNS, STATS_COLUMNS, ArrowFormat, gen_serialized, negotiate, serialize
+
+pa = pytest.importorskip("pyarrow")
+import pyarrow.ipc  # noqa: E402, F401
+import pyarrow.parquet  # noqa: E402, F401
+
+READINGS = [
+    ("Netterden", "Europe/Amsterdam", "Wind", 1.5, datetime(2020, 3, 1, 0, 0)),
+    ("Netterden", "Europe/Amsterdam", "Wind", 2.5, datetime(2020, 3, 1, 0, 15)),
+]
+
+
+def read_table(data: bytes, arrow_format: ArrowFormat) -> "pa.Table":
+    if arrow_format == ArrowFormat.arrow:
+        return pa.ipc.open_stream(data).read_all()
+    return pa.parquet.read_table(BytesIO(data))
+
+
+@pytest.mark.parametrize(
+    "accept, expected",
+    [
+        (None, None),
+        ("application/json", None),
+        ("application/vnd.apache.arrow.stream", ArrowFormat.arrow),
+        ("text/html, application/x-parquet;q=0.9", ArrowFormat.parquet),
+    ],
+)
+def test_negotiate(accept, expected):
+    assert negotiate(accept) == expected
+
+
+@pytest.mark.parametrize("arrow_format", list(ArrowFormat))
+def test_serialize_round_trips_typed_columns(arrow_format: ArrowFormat):
+    table = read_table(serialize(READINGS, READINGS_COLUMNS, arrow_format), arrow_format)
+    assert table.column_names == [name for name, _ in READINGS_COLUMNS]
+    assert table.schema.field("megawatts").type == pa.float64()
+    assert table.schema.field("timestamp").type == pa.timestamp("us")
+    assert [tuple(row.values()) for row in table.to_pylist()] == READINGS
+
+
+def test_serialize_fills_missing_mapping_keys_with_nulls():
+    rows = [{"date": date(2020, 3, 1), "bucket": datetime(2020, 3, 1), "min": 1.0, "max": 2.0, "sum": 3.0, "count": 2}]
+    table = read_table(serialize(rows, STATS_COLUMNS, ArrowFormat.arrow), ArrowFormat.arrow)
+    assert table.to_pylist()[0]["count"] == 2
+    assert table.to_pylist()[0]["p99"] is None
+
+
+@pytest.mark.parametrize("arrow_format", list(ArrowFormat))
+def test_gen_serialized_writes_one_batch_per_chunk(arrow_format: ArrowFormat):
+    async def batches():
+        for row in READINGS:
+            yield [row]
+
+    async def run():
+        return b"".join([chunk async for chunk in gen_serialized(batches(), READINGS_COLUMNS, arrow_format)])
+
+    data = asyncio.run(run())
+    assert read_table(data, arrow_format).num_rows == len(READINGS)
+    if arrow_format == ArrowFormat.parquet:
+        assert pa.parquet.ParquetFile(BytesIO(data)).num_row_groups == len(READINGS)
@@ -0,0 +1,81 @@
+import pytest
+from sqlalchemy.exc import NoResultFound
+
+from main.db.bulk import (
+    CopyBuffer,
+    UpsertCounts,
+    gen_energy_reading_copy_lines,
+    gen_measurement_copy_lines,
+    parse_aemet_direction,
+    parse_aemet_number,
+)
+
+
+def test_copy_buffer_reads_lines_in_requested_sizes():
+    buffer = CopyBuffer(iter(["abc\n", "de\n", "f\n"]))
+    assert buffer.read(2) == b"ab"
+    assert buffer.read(4) == b"c\nde"
+    assert buffer.read(100) == b"\nf\n"
+    assert buffer.read(100) == b""
+
+
+def test_copy_buffer_reads_everything_without_size():
+    buffer = CopyBuffer(iter(["abc\n", "de\n"]))
+    assert buffer.read() == b"abc\nde\n"
+
+
+def test_copy_buffer_keeps_the_error_raised_by_its_lines():
+    buffer = CopyBuffer(gen_energy_reading_copy_lines("Netterden", [{"datetime": "2020-03-01 00:15:00"}]))
+    with pytest.raises(KeyError):
+        buffer.read(10)
+    assert isinstance(buffer.error, KeyError)
+
+
+def test_gen_energy_reading_copy_lines_formats_copy_text_rows():
+    rows = [{"datetime": "2020-03-01 00:15:00", "MW": "11.196"}]
+    assert list(gen_energy_reading_copy_lines("Netterden", rows)) == ["Netterden\t2020-03-01T00:15:00\t11.196\n"]
+
+
+def test_gen_energy_reading_copy_lines_raises_KeyError_on_missing_column():
+    with pytest.raises(KeyError):
+        list(gen_energy_reading_copy_lines("Netterden", [{"datetime": "2020-03-01 00:15:00"}]))
+
+
+def test_upsert_counts_add_up_field_by_field():
+    total = UpsertCounts(inserted=1, updated=2, unchanged=3) + UpsertCounts(inserted=10, updated=20, unchanged=30)
+    assert total == UpsertCounts(inserted=11, updated=22, unchanged=33)
+
+
+@pytest.mark.parametrize(
+    "value, expected", [("8,9", 8.9), ("21.0", 21.0), ("Ip", 0.0), ("Acum", None), ("", None), (None, None)]
+)
+def test_parse_aemet_number(value, expected):
+    assert parse_aemet_number(value) == expected
+
+
+@pytest.mark.parametrize("value, expected", [("05", 5), ("36", 36), ("99", None), ("88", None), ("", None)])
+def test_parse_aemet_direction(value, expected):
+    assert parse_aemet_direction(value) == expected
+
+
+def test_gen_measurement_copy_lines_resolves_the_station_of_each_row():
+    rows = [
+        {"FECHA": "1968-03-01", "INDICATIVO": "0002I", "TMEDIA": "8,9", "HORATMIN": "03:00", "DIR": "05"},
+        {"FECHA": "1968-03-01", "INDICATIVO": "0016A", "PRECIPITACION": "Ip"},
+    ]
+    lines = list(gen_measurement_copy_lines(rows, {"0002I": 1, "0016A": 2}))
+    assert lines[0].split("\t")[:7] == ["1", "1968-03-01", "8.9", "\\N", "\\N", "03:00", "\\N"]
+    assert lines[0].split("\t")[8] == "5"
+    assert lines[1].split("\t")[:2] == ["2", "1968-03-01"]
+    assert lines[1].split("\t")[7] == "0.0"
+    assert all(line.count("\t") == 21 and line.endswith("\n") for line in lines)
+
+
+def test_gen_measurement_copy_lines_uses_the_given_station_for_every_row():
+    lines = list(gen_measurement_copy_lines([{"FECHA": "1968-03-01"}], {"0002I": 1}, station_code="0002I"))
+    assert lines[0].startswith("1\t1968-03-01\t")
+
+
+def test_gen_measurement_copy_lines_raises_NoResultFound_on_unknown_station():
+    with pytest.raises(NoResultFound):
+        list(gen_measurement_copy_lines([{"FECHA": "1968-03-01", "INDICATIVO": "9999X"}], {"0002I": 1}))
@@ -0,0 +1,199 @@
+import asyncio
+import fnmatch
+from datetime import date
+from typing import Dict, Set
+
+import pytest
+
+import main.cache
+from main.cache import (
+    CacheBackend,
+    CacheEntry,
+    CacheTags,
+    MemoryCache,
+    RedisCache,
+    create_cache_backend,
+    dump_entry,
+    load_entry,
+)
+
+
+def entry(body: bytes = b"[]", **tags) -> CacheEntry:
+    return CacheEntry(
+        status=200, headers=[("content-type", "application/json")], body=body, etag='"x"', tags=CacheTags(**tags)
+    )
+
+
+class FakeRedis:
+    """
+    In memory stand-in for the subset of ``redis.asyncio.Redis`` used by ``RedisCache``. Expiry is not simulated.
+    """
+
+    def __init__(self) -> None:
+        self.values: Dict[str, str] = {}
+        self.sets: Dict[str, Set[str]] = {}
+
+    async def get(self, name):
+        return self.values.get(name)
+
+    async def set(self, name, value, ex=None, px=None):
+        self.values[name] = value
+
+    async def exists(self, *names):
+        return sum(name in self.values for name in names)
+
+    async def mget(self, names):
+        return [self.values.get(name) for name in names]
+
+    async def incr(self, name):
+        self.values[name] = str(int(self.values.get(name, 0)) + 1)
+
+    async def delete(self, *names):
+        return sum(self.values.pop(name, None) is not None or self.sets.pop(name, None) is not None for name in names)
+
+    async def sadd(self, name, *values):
+        self.sets.setdefault(name, set()).update(values)
+
+    async def srem(self, name, *values):
+        self.sets.get(name, set()).difference_update(values)
+
+    async def smembers(self, name):
+        return set(self.sets.get(name, set()))
+
+    async def expire(self, name, seconds):
+        pass
+
+    async def scan_iter(self, match):
+        for name in [*self.values, *self.sets]:
+            if fnmatch.fnmatch(name, match):
+                yield name
+
+
+def test_cache_tags_match_park_and_overlapping_dates():
+    tags = CacheTags(readings=True, park_names=("Netterden",), start_date=date(2020, 3, 1), end_date=date(2020, 3, 31))
+    assert tags.matches("Netterden", date(2020, 3, 15), date(2020, 3, 15))
+    assert tags.matches("Netterden", date(2020, 2, 29), date(2020, 2, 29))  # Within the margin
+    assert not tags.matches("Netterden", date(2020, 5, 1), date(2020, 5, 2))
+    assert not tags.matches("Stadskanaal", date(2020, 3, 15), date(2020, 3, 15))
+    assert CacheTags(readings=True).matches("Stadskanaal", date(2020, 3, 15), date(2020, 3, 15))
+    assert not CacheTags(readings=False).matches("Stadskanaal", date(2020, 3, 15), date(2020, 3, 15))
+
+
+def test_cache_entry_survives_serialization():
+    cached = entry(b"\x00{}", readings=True, park_names=("Netterden",), start_date=date(2020, 3, 1))
+    assert load_entry(dump_entry(cached)) == cached
+
+
+def test_memory_cache_evicts_least_recently_used_entries():
+    async def run():
+        cache = MemoryCache(max_entries=2)
+        for key in "abc":
+            if key == "c":
+                await cache.get("a")
+            await cache.set(key, entry(readings=True), await cache.version())
+        return [key for key in "abc" if await cache.get(key)]
+
+    assert asyncio.run(run()) == ["a", "c"]
+
+
+def test_memory_cache_expires_entries():
+    now = [0.0]
+    cache = MemoryCache(ttl=10, clock=lambda: now[0])
+
+    async def run():
+        await cache.set("a", entry(readings=True), await cache.version())
+        hit = await cache.get("a")
+        now[0] = 10.0
+        return hit, await cache.get("a")
+
+    hit, miss = asyncio.run(run())
+    assert hit is not None
+    assert miss is None
+
+
+def test_memory_cache_invalidates_matching_entries_only():
+    async def run():
+        cache = MemoryCache()
+        await cache.set("parks", entry(readings=False), 0)
+        await cache.set("netterden", entry(readings=True, park_names=("Netterden",)), 0)
+        await cache.set("stadskanaal", entry(readings=True, park_names=("Stadskanaal",)), 0)
+        await cache.set("all", entry(readings=True), 0)
+        deleted = await cache.invalidate("Netterden", date(2020, 3, 1), date(2020, 3, 1))
+        return deleted, [key for key in ("parks", "netterden", "stadskanaal", "all") if await cache.get(key)]
+
+    assert asyncio.run(run()) == (2, ["parks", "stadskanaal"])
+
+
+def test_memory_cache_ignores_responses_computed_before_an_invalidation():
+    async def run():
+        cache = MemoryCache()
+        version = await cache.version()
+        await cache.invalidate("Netterden", date(2020, 3, 1), date(2020, 3, 1))
+        await cache.set("a", entry(readings=True), version)
+        return await cache.get("a")
+
+    assert asyncio.run(run()) is None
+
+
+def test_memory_cache_ignores_responses_computed_while_replicas_may_lag():
+    now = [0.0]
+    cache = MemoryCache(settle=30, clock=lambda: now[0])
+
+    async def run():
+        await cache.invalidate("Netterden", date(2020, 3, 1), date(2020, 3, 1))
+        await cache.set("a", entry(readings=True), await cache.version())
+        now[0] = 30.0
+        await cache.set("b", entry(readings=True), await cache.version())
+        return await cache.get("a"), await cache.get("b")
+
+    lagging, settled = asyncio.run(run())
+    assert lagging is None
+    assert settled is not None
+
+
+def test_redis_cache_invalidates_matching_entries_only():
+    async def run():
+        cache = RedisCache(FakeRedis())
+        await cache.set("netterden", entry(readings=True, park_names=("Netterden",), end_date=date(2019, 1, 1)), 0)
+        await cache.set("stadskanaal", entry(readings=True, park_names=("Stadskanaal",)), 0)
+        await cache.set("all", entry(readings=True), 0)
+        deleted = await cache.invalidate("Netterden", date(2020, 3, 1), date(2020, 3, 1))
+        await cache.set("late", entry(readings=True), 0)  # Computed before the invalidation
+        return deleted, [key for key in ("netterden", "stadskanaal", "all", "late") if await cache.get(key)]
+
+    assert asyncio.run(run()) == (1, ["netterden", "stadskanaal"])
+
+
+def test_redis_cache_clear_keeps_the_version():
+    async def run():
+        cache = RedisCache(FakeRedis())
+        await cache.set("a", entry(readings=False), 0)
+        await cache.clear()
+        return await cache.get("a"), await cache.version()
+
+    assert asyncio.run(run()) == (None, 1)
+
+
+def test_redis_cache_ignores_responses_computed_while_replicas_may_lag():
+    async def run():
+        client = FakeRedis()
+        cache = RedisCache(client, settle=30)
+        await cache.clear()
+        await cache.set("a", entry(readings=True), await cache.version())
+        lagging = await cache.get("a")
+        del client.values[cache._key("settling")]  # Expired
+        await cache.set("a", entry(readings=True), await cache.version())
+        return lagging, await cache.get("a")
+
+    lagging, settled = asyncio.run(run())
+    assert lagging is None
+    assert settled is not None
+
+
+def test_memory_cache_is_not_used_by_several_server_workers(monkeypatch):
+    monkeypatch.delenv("CACHE_URL", raising=False)
+    assert isinstance(create_cache_backend(), MemoryCache)
+    monkeypatch.setattr(main.cache, "WORKERS", 4)
+    assert type(create_cache_backend()) is CacheBackend
+    with pytest.raises(ValueError):
+        create_cache_backend("memory://")
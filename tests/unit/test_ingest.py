@@ -0,0 +1,56 @@
+from io import BytesIO
+import zipfile
+
+import pytest
+
+from main.ingest import IngestResult, park_name_of, spool_upload
+from main.db.bulk import UpsertCounts
+
+
+@pytest.mark.parametrize(
+    "filename, expected",
+    [
+        ("Netterden.csv", "Netterden"),
+        ("readings/stadskanaal.CSV", "Stadskanaal"),
+        ("Bemmel", "Bemmel"),
+        ("Netterden-2020.csv", None),
+    ],
+)
+def test_park_name_of(filename, expected):
+    assert park_name_of(filename) == expected
+
+
+def test_spool_upload_writes_plain_files_and_zip_members(tmp_path):
+    archive = BytesIO()
+    with zipfile.ZipFile(archive, "w") as zf:
+        zf.writestr("readings/Netterden.csv", "datetime,MW\n")
+        zf.writestr("readings/", "")
+        zf.writestr("__MACOSX/readings/._Netterden.csv", "")
+        zf.writestr("Unknown.csv", "datetime,MW\n")
+
+    files = spool_upload("parks.zip", archive, str(tmp_path))
+    files += spool_upload("Bemmel.csv", BytesIO(b"datetime,MW\n2020-03-01 00:00:00,1\n"), str(tmp_path))
+
+    assert [(file.filename, file.park_name) for file in files] == [
+        ("readings/Netterden.csv", "Netterden"),
+        ("Unknown.csv", None),
+        ("Bemmel.csv", "Bemmel"),
+    ]
+    assert len({file.path for file in files}) == 3
+    with open(files[-1].path) as f:
+        assert f.read() == "datetime,MW\n2020-03-01 00:00:00,1\n"
+
+
+def test_ingest_result_as_dict():
+    ok = IngestResult("Netterden.csv", "Netterden", UpsertCounts(inserted=3, updated=1, unchanged=0), seconds=2.0)
+    assert ok.as_dict() == {
+        "filename": "Netterden.csv",
+        "park_name": "Netterden",
+        "status": "ok",
+        "inserted": 3,
+        "updated": 1,
+        "unchanged": 0,
+        "rows_per_second": 2.0,
+        "error": None,
+    }
+    assert IngestResult("foo.csv", None, error="boom").as_dict()["status"] == "error"
@@ -0,0 +1,40 @@
+from datetime import datetime, timedelta, timezone
+from uuid import uuid4
+
+from main.db.models import IngestionJobRow
+from main.jobs import job_status
+
+NOW = datetime(2024, 3, 1, 12, tzinfo=timezone.utc)
+
+
+def job(**values) -> IngestionJobRow:
+    defaults = dict(
+        id=uuid4(),
+        park_name="Netterden",
+        filename="Netterden.csv",
+        status="running",
+        total_bytes=1000,
+        processed_bytes=250,
+        rows_processed=5000,
+        created_at=NOW - timedelta(seconds=20),
+        started_at=NOW - timedelta(seconds=10),
+    )
+    return IngestionJobRow(**{**defaults, **values})
+
+
+def test_job_status_estimates_the_time_left_from_the_bytes_read():
+    status = job_status(job(), now=NOW)
+    assert (status["progress"], status["rows_per_second"], status["eta_seconds"]) == (0.25, 500.0, 30.0)
+
+
+def test_job_status_has_no_estimate_before_the_first_progress_report():
+    status = job_status(job(status="queued", processed_bytes=0, rows_processed=0, started_at=None), now=NOW)
+    assert (status["progress"], status["rows_per_second"], status["eta_seconds"]) == (0.0, 0.0, None)
+
+
+def test_job_status_of_a_finished_job_uses_its_duration():
+    finished = job(
+        status="succeeded", processed_bytes=1000, rows_processed=8000, finished_at=NOW - timedelta(seconds=6)
+    )
+    status = job_status(finished, now=NOW)
+    assert (status["progress"], status["rows_per_second"], status["eta_seconds"]) == (1.0, 2000.0, None)
@@ -0,0 +1,53 @@
+from unittest.mock import MagicMock
+
+import pytest
+from prometheus_client import REGISTRY
+
+from main.metrics import ROUTE, InstrumentedQueuePool, query_name_of, span
+
+
+@pytest.mark.parametrize(
+    "statement, expected",
+    [
+        ("SELECT id FROM energy_readings WHERE park_name = %(name)s", "select energy_readings"),
+        ("\n  insert into measurements (station_id) VALUES (%s)", "insert measurements"),
+        ("UPDATE ingestion_jobs SET status = %(status)s", "update ingestion_jobs"),
+        ("COPY measurements_staging FROM STDIN", "copy measurements_staging"),
+        ("SELECT 1", "select"),
+        ("", "unknown"),
+    ],
+)
+def test_query_name_of_uses_the_verb_and_first_table(statement: str, expected: str):
+    assert query_name_of(statement) == expected
+
+
+def test_span_records_the_stage_under_the_current_route():
+    labels = {"route": "/unit", "stage": "serialize"}
+    before = REGISTRY.get_sample_value("request_stage_duration_seconds_count", labels) or 0
+    token = ROUTE.set("/unit")
+    try:
+        with pytest.raises(ValueError), span("serialize"):
+            raise ValueError
+    finally:
+        ROUTE.reset(token)
+    assert REGISTRY.get_sample_value("request_stage_duration_seconds_count", labels) == before + 1
+
+
+def test_pool_estimates_the_wait_of_the_next_checkout_once_saturated():
+    pool = InstrumentedQueuePool(MagicMock, pool_size=1, max_overflow=1)
+    first = pool.connect()
+    assert pool.estimated_wait() == 0.0
+    second = pool.connect()
+    pool.hold_seconds = 2.0
+    assert pool.estimated_wait() == 1.0  # First in the queue of 2 connections held 2 seconds on average
+
+    pool.waiting = 1
+    assert pool.estimated_wait() == 2.0
+    assert REGISTRY.get_sample_value("db_pool_checked_out", {"pool": "sync"}) >= 2
+    assert REGISTRY.get_sample_value("db_pool_overflow", {"pool": "sync"}) >= 1
+    pool.waiting = 0
+
+    first.close()
+    second.close()
+    assert pool.estimated_wait() == 0.0
+    assert pool.hold_seconds < 2.0
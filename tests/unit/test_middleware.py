@@ -0,0 +1,133 @@
+import asyncio
+import gzip
+from typing import List, Optional
+from unittest.mock import MagicMock
+from urllib.parse import parse_qsl, urlencode
+
+import pytest
+from starlette.types import Message
+
+from main.metrics import InstrumentedQueuePool
+from main.middleware import (
+    AdmissionControlMiddleware,
+    CompressionMiddleware,
+    filter_empty_query_params,
+    negotiate_encoding,
+    weaken_etag,
+)
+
+
+@pytest.mark.parametrize(
+    "query_string",
+    [b"", b"a=1", b"a=1&b=", b"a=&b=2", b"a&b=2", b"a=1&&b=2", b"a=1&b=2&", b"a==&b=", b"park_names=&limit=10"],
+)
+def test_filter_empty_query_params_drops_the_params_parse_qsl_drops(query_string: bytes):
+    expected = parse_qsl(urlencode(parse_qsl(query_string.decode(), keep_blank_values=False)))
+    assert parse_qsl(filter_empty_query_params(query_string).decode(), keep_blank_values=True) == expected
+
+
+def test_filter_empty_query_params_returns_the_same_query_string_without_empty_params():
+    query_string = b"park_names=Netterden&park_names=Bemmel&limit=10"
+    assert filter_empty_query_params(query_string) is query_string
+
+
+@pytest.mark.parametrize(
+    "accept_encoding, expected",
+    [
+        (b"gzip, deflate, br, zstd", "zstd"),
+        (b"gzip, br", "br"),
+        (b"gzip;q=1.0, br;q=0.5", "gzip"),
+        (b"br;q=0, gzip", "gzip"),
+        (b"identity", None),
+        (b"", None),
+    ],
+)
+def test_negotiate_encoding_prefers_the_highest_quality(accept_encoding: bytes, expected: Optional[str]):
+    pytest.importorskip("brotli")
+    pytest.importorskip("zstandard")
+    assert negotiate_encoding(accept_encoding) == expected
+
+
+def call(path: str, body: bytes, content_type: bytes = b"application/json", more_body: bool = False) -> List[Message]:
+    async def app(scope, receive, send):
+        await send({"type": "http.response.start", "status": 200, "headers": [(b"content-type", content_type)]})
+        await send({"type": "http.response.body", "body": body, "more_body": more_body})
+        if more_body:
+            await send({"type": "http.response.body", "body": b""})
+
+    messages: List[Message] = []
+
+    async def send(message: Message) -> None:
+        messages.append(message)
+
+    scope = {"type": "http", "path": path, "headers": [(b"accept-encoding", b"gzip")]}
+    asyncio.run(CompressionMiddleware(app, minimum_size=100)(scope, None, send))
+    return messages
+
+
+def test_compression_middleware_compresses_large_json_responses():
+    body = b"[" + b",".join(b'{"megawatts": 1.0}' for _ in range(100)) + b"]"
+    start, message = call("/parks", body)
+    headers = dict(start["headers"])
+    assert headers[b"content-encoding"] == b"gzip"
+    assert headers[b"vary"] == b"Accept-Encoding"
+    assert int(headers[b"content-length"]) == len(message["body"])
+    assert gzip.decompress(message["body"]) == body
+
+
+def test_etags_are_made_weak_once_an_encoding_is_negotiated():
+    headers = [(b"content-type", b"application/json"), (b"etag", b'"abc"')]
+    assert dict(weaken_etag(headers))[b"etag"] == b'W/"abc"'
+    assert dict(weaken_etag(weaken_etag(headers)))[b"etag"] == b'W/"abc"'
+
+
+@pytest.mark.parametrize(
+    "path, body, content_type, more_body",
+    [
+        ("/parks", b"[]", b"application/json", False),  # Too small
+        ("/metrics", b"# HELP" * 100, b"text/plain", False),  # Excluded
+        ("/parks", b"PAR1" * 100, b"application/x-parquet", False),  # Already compressed
+        ("/stats", b"{}" * 100, b"application/json", True),  # Streamed
+    ],
+    ids=["small", "excluded", "parquet", "streamed"],
+)
+def test_compression_middleware_passes_other_responses_through(
+    path: str, body: bytes, content_type: bytes, more_body: bool
+):
+    start, message, *_ = call(path, body, content_type, more_body)
+    assert b"content-encoding" not in dict(start["headers"])
+    assert message["body"] == body
+
+
+def test_admission_control_sheds_reads_while_the_pool_is_saturated():
+    pool = InstrumentedQueuePool(MagicMock, pool_size=1, max_overflow=0)
+    connection = pool.connect()
+    pool.hold_seconds = 2.5
+    calls = []
+
+    async def app(scope, receive, send):
+        calls.append(scope["path"])
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": b""})
+
+    def call(method: str, path: str, wait_budget: float) -> Message:
+        messages: List[Message] = []
+
+        async def send(message: Message) -> None:
+            messages.append(message)
+
+        middleware = AdmissionControlMiddleware(app, get_pools=lambda: [pool], wait_budget=wait_budget)
+        scope = {"type": "http", "method": method, "path": path, "headers": []}
+        asyncio.run(middleware(scope, None, send))
+        return messages[0]
+
+    shed = call("GET", "/stats/parks", wait_budget=1.0)
+    assert shed["status"] == 503
+    assert dict(shed["headers"])[b"retry-after"] == b"3"
+    assert call("GET", "/stats/parks", wait_budget=5.0)["status"] == 200
+    assert call("POST", "/admin/parks/upload", wait_budget=1.0)["status"] == 200
+    assert call("GET", "/admin/jobs", wait_budget=1.0)["status"] == 200
+    assert calls == ["/stats/parks", "/admin/parks/upload", "/admin/jobs"]
+
+    connection.close()
+    assert call("GET", "/stats/parks", wait_budget=1.0)["status"] == 200
@@ -8,7 +8,7 @@ from starlette.status import (
 )
 import pytest
 
-from main.routers.exceptions import handle_upsert
+from main.routers.exceptions import handle_cursor, handle_upsert
 
 
 def test_handle_upsert_maps_KeyError_to_HTTP_400_BAD_REQUEST():
@@ -38,3 +38,10 @@ def test_handle_upsert_maps_generic_Exception_to_HTTP_500_INTERNAL_SERVER_ERROR(
         with handle_upsert():
             raise Exception
     assert e.value.status_code == HTTP_500_INTERNAL_SERVER_ERROR
+
+
+def test_handle_cursor_maps_ValueError_to_HTTP_400_BAD_REQUEST():
+    with pytest.raises(HTTPException) as e:
+        with handle_cursor():
+            raise ValueError
+    assert e.value.status_code == HTTP_400_BAD_REQUEST
@@ -0,0 +1,20 @@
+import pytest
+
+pytest.importorskip("gunicorn")
+
+from main.server import Server, available_cpus, prepare_metrics_dir  # noqa: E402
+
+
+def test_server_options_can_be_overridden_with_gunicorn_cmd_args(monkeypatch):
+    monkeypatch.setenv("GUNICORN_CMD_ARGS", "--workers 3 --timeout 60")
+    server = Server({"workers": available_cpus(), "preload_app": True, "timeout": 30})
+    assert server.cfg.workers == 3
+    assert server.cfg.timeout == 60
+    assert server.cfg.preload_app is True
+
+
+def test_metrics_dir_is_emptied_on_startup(monkeypatch, tmp_path):
+    (tmp_path / "counter_123.db").write_bytes(b"stale")
+    monkeypatch.setenv("PROMETHEUS_MULTIPROC_DIR", str(tmp_path))
+    assert prepare_metrics_dir() == str(tmp_path)
+    assert list(tmp_path.iterdir()) == []
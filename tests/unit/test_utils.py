@@ -0,0 +1,85 @@
+from datetime import datetime
+from functools import reduce
+from io import BytesIO
+import statistics
+
+import pytest
+
+from main.db.queries import ParkEnergyReadingsRow
+from main.utils import (
+    decode_cursor,
+    encode_cursor,
+    gen_batches,
+    gen_upload_file_as_string,
+    group_readings,
+    merge_partials,
+    pack,
+)
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 5, 64 * 1024])
+def test_gen_upload_file_as_string_stitches_lines_across_chunks(chunk_size):
+    content = "datetime,MW\r\n2020-03-01 00:00:00,10.108\r\nZwartenbergseweg,Europe/Volgograd,Añbc"
+    lines = list(gen_upload_file_as_string(BytesIO(content.encode()), chunk_size=chunk_size))
+    assert lines == ["datetime,MW\r\n", "2020-03-01 00:00:00,10.108\r\n", "Zwartenbergseweg,Europe/Volgograd,Añbc"]
+
+
+def test_gen_upload_file_as_string_yields_nothing_for_empty_file():
+    assert list(gen_upload_file_as_string(BytesIO(b""))) == []
+
+
+def test_gen_upload_file_as_string_keeps_trailing_newline():
+    assert list(gen_upload_file_as_string(BytesIO(b"a\nb\n"), chunk_size=1)) == ["a\n", "b\n"]
+
+
+def test_gen_batches_splits_iterable_lazily():
+    assert list(gen_batches(iter(range(5)), size=2)) == [[0, 1], [2, 3], [4]]
+    assert list(gen_batches([], size=2)) == []
+
+
+def test_cursor_round_trips_sort_key():
+    cursor = encode_cursor("Netterden", datetime(2020, 3, 1, 0, 15))
+    assert decode_cursor(cursor, str, datetime.fromisoformat) == ("Netterden", datetime(2020, 3, 1, 0, 15))
+
+
+@pytest.mark.parametrize("cursor", ["not base64!", encode_cursor("Netterden"), encode_cursor("Netterden", "foo")])
+def test_decode_cursor_raises_ValueError_on_malformed_cursor(cursor):
+    with pytest.raises(ValueError):
+        decode_cursor(cursor, str, datetime.fromisoformat)
+
+
+def test_merge_partials_matches_stats_of_all_readings():
+    bucket = datetime(2020, 3, 1)
+    readings = {"Netterden": [1.0, 2.0], "Stadskanaal": [4.0, 8.0, 16.0]}
+    partials = [
+        {
+            "name": name,
+            "energy_type": "Wind",
+            "bucket": bucket,
+            "min": min(values),
+            "max": max(values),
+            "sum": sum(values),
+            "sum_squares": sum(v * v for v in values),
+            "count": len(values),
+        }
+        for name, values in readings.items()
+    ]
+    values = [v for park_values in readings.values() for v in park_values]
+
+    (merged,) = merge_partials(partials, key="energy_type")
+    assert merged["energy_type"] == "Wind"
+    assert (merged["min"], merged["max"], merged["sum"], merged["count"]) == (1.0, 16.0, 31.0, 5)
+    assert merged["avg"] == pytest.approx(statistics.mean(values))
+    assert merged["stddev"] == pytest.approx(statistics.stdev(values))
+    assert [row["name"] for row in merge_partials(partials, key="name")] == ["Netterden", "Stadskanaal"]
+    assert "name" not in merge_partials(partials)[0]
+
+
+def test_group_readings_matches_pack():
+    rows = [
+        ParkEnergyReadingsRow("Netterden", "Europe/Amsterdam", "Wind", 1.0, datetime(2020, 3, 1)),
+        ParkEnergyReadingsRow("Netterden", "Europe/Amsterdam", "Wind", 2.0, datetime(2020, 3, 1, 0, 15)),
+        ParkEnergyReadingsRow("Stadskanaal", "Europe/Bucharest", "Solar", 3.0, datetime(2020, 3, 1)),
+    ]
+    assert group_readings(rows) == list(reduce(pack, rows, {}).values())
+    assert group_readings([]) == []